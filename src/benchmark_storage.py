@@ -0,0 +1,17 @@
+import os
+import sys
+import geopandas as gpd
+
+import io_functions as iof
+
+# layer to benchmark - pass a file path, or use the highways network from the build
+layer_file = sys.argv[1] if len(sys.argv) > 1 else '../data/os-highways/os_highways_data.geojson'
+
+if __name__ == '__main__':
+    os.makedirs('../data/interim/', exist_ok=True)
+
+    layer = gpd.read_file(layer_file)
+    results = iof.benchmark_storage(layer, out_dir='../data/interim/')
+
+    print(results.to_string(index=False))
+    results.to_json('../data/interim/storage_benchmark.json', orient='records', indent=2)
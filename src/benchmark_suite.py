@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyproj
+
+import geo_functions as gf
+import synthetic_functions as sf
+import build_road_reference_data as bb
+
+# network sizes (number of links) to benchmark
+scales = [1000, 10000, 100000]
+
+# the row by row stretch metrics are slow, so they are skipped for networks larger than this
+max_rowwise = 100000
+
+out_dir = '../data/benchmarks/'
+
+stretch_functions = {
+    'stretch_gradient': lambda row: gf.stretch_gradient(row, 'length'),
+    'stretch_key_coords': gf.stretch_key_coords,
+    'stretch_sinuosity': lambda row: gf.stretch_sinuosity(row, 'length'),
+    'stretch_bearing': gf.stretch_bearing,
+    'stretch_location': gf.stretch_location
+}
+
+def time_call(function, *args, repeat=1, **kwargs):
+    """
+    Best time (seconds) of repeat calls of a function, and the result of the last call
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+def run_info(workers):
+    """
+    Describe the machine, packages and commit a benchmark was run on
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'workers': workers,
+        'packages': {module.__name__: module.__version__ for module in [np, pd, gpd, shapely, pyproj]}
+    }
+
+def benchmark_scale(n_links, data_dir, repeat=3, workers=1, pipeline=True, seed=0):
+    """
+    Generate synthetic data with n_links links in data_dir and time the matching, the stretch
+    metrics and the full build against it. Returns a list of results
+    """
+    results = []
+
+    def record(name, seconds, rows):
+        print(f'{n_links:>9} {name:<30} {seconds:>9.3f} s {rows:>10} rows')
+        results.append({'scale': n_links, 'benchmark': name, 'seconds': seconds, 'rows': int(rows)})
+
+    seconds, network = time_call(sf.write_synthetic_data, data_dir, n_links, seed=seed)
+    record('synthetic_data', seconds, len(network))
+
+    points = sf.synthetic_points(network, n_links // 2, seed=seed + 1)
+    lines, _ = sf.synthetic_lines(network, max(n_links // 20, 1), seed=seed + 5)
+    line_columns = ['TOID', 'identifier']
+
+    seconds, _ = time_call(gf.match_point_to_line, network, line_columns, points, buffer=bb.buffer, workers=workers, repeat=repeat)
+    record('match_point_to_line', seconds, len(points))
+
+    seconds, _ = time_call(gf.match_point_to_nearest_lines, network, points, k=3, buffer=bb.buffer, workers=workers, repeat=repeat)
+    record('match_point_to_nearest_lines', seconds, len(points))
+
+    # the same matching and metrics on a saved index, as the build runs them
+    index_path = os.path.join(os.path.dirname(data_dir), 'network.index')
+    gf.RoadNetworkIndex.from_network(network).save(index_path)
+    seconds, index = time_call(gf.RoadNetworkIndex.load, index_path, repeat=repeat)
+    record('load_index', seconds, n_links)
+
+    seconds, _ = time_call(gf.match_point_to_line, index, line_columns, points, buffer=bb.buffer, workers=workers, repeat=repeat)
+    record('match_point_to_line_index', seconds, len(points))
+
+    seconds, _ = time_call(gf.match_line_to_line, network[line_columns + ['geometry']], lines, buffer=5, workers=workers, repeat=repeat)
+    record('match_line_to_line', seconds, len(lines))
+
+    if n_links <= max_rowwise:
+        for name, function in stretch_functions.items():
+            seconds, _ = time_call(network.apply, function, axis=1, repeat=repeat)
+            record(name, seconds, n_links)
+
+    seconds, _ = time_call(gf.compute_stretch_metrics, network, repeat=repeat)
+    record('compute_stretch_metrics', seconds, n_links)
+
+    seconds, _ = time_call(gf.compute_profile_metrics, network, repeat=repeat)
+    record('compute_profile_metrics', seconds, n_links)
+
+    seconds, _ = time_call(gf.compute_stretch_metrics, index, repeat=repeat)
+    record('compute_stretch_metrics_index', seconds, n_links)
+
+    seconds, _ = time_call(gf.compute_profile_metrics, index, repeat=repeat)
+    record('compute_profile_metrics_index', seconds, n_links)
+
+    if pipeline:
+        # the build reads ../data, so run it from a folder next to the data
+        src_dir = os.path.join(os.path.dirname(data_dir), 'src')
+        os.makedirs(src_dir, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(src_dir)
+
+        try:
+            seconds, _ = time_call(bb.main, ['--workers', str(workers)])
+            record('build_pipeline', seconds, n_links)
+
+            seconds, _ = time_call(bb.main, ['--workers', str(workers)])
+            record('build_pipeline_cached', seconds, n_links)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+def compare_results(results, baseline_file):
+    """
+    Compare the times of a run against an earlier results file, as the ratio of the new time to the old
+    """
+    with open(baseline_file) as file:
+        baseline = pd.DataFrame(json.load(file)['results'])
+
+    current = pd.DataFrame(results)
+    compared = current.merge(baseline[['scale', 'benchmark', 'seconds']], on=['scale', 'benchmark'], how='left', suffixes=('', '_baseline'))
+    compared['ratio'] = (compared['seconds'] / compared['seconds_baseline']).round(2)
+
+    return compared[['scale', 'benchmark', 'seconds', 'seconds_baseline', 'ratio']]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the matching, stretch metrics and build on synthetic road networks')
+    parser.add_argument('--scales', type=int, nargs='+', default=scales, help='network sizes (links) to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of each benchmark, keeping the best time')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used for matching')
+    parser.add_argument('--no-pipeline', action='store_true', help='skip the full build')
+    parser.add_argument('--baseline', default=None, help='earlier results file to compare against')
+    parser.add_argument('--out', default=None, help='results file (default: a timestamped file in ../data/benchmarks/)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data')
+    args = parser.parse_args(argv)
+
+    os.makedirs(out_dir, exist_ok=True)
+    info = run_info(args.workers)
+    results = []
+
+    for n_links in args.scales:
+        root = tempfile.mkdtemp(prefix=f'synthetic_{n_links}_', dir=out_dir)
+
+        try:
+            results += benchmark_scale(n_links, os.path.join(root, 'data'), repeat=args.repeat, workers=args.workers, pipeline=not args.no_pipeline)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+    out_file = args.out or os.path.join(out_dir, f'benchmark_{time.strftime("%Y%m%d_%H%M%S")}.json')
+    with open(out_file, 'w') as file:
+        json.dump({**info, 'results': results}, file, indent=2)
+
+    print(f'Results written to {out_file}')
+
+    if args.baseline is not None:
+        print(compare_results(results, args.baseline).to_string(index=False))
+
+    return results
+
+# the process pool used for matching re-imports this script, so only run when called directly
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,9 +3,16 @@ import pandas as pd
 import numpy as np
 from shapely.geometry import Point
 import os
+import argparse
 import matplotlib.pyplot as plt
 
 import geo_functions as gf
+import io_functions as iof
+import pipeline_functions as pf
+import clean_functions as cf
+import network_functions as nf
+import feature_functions as fe
+import profile_functions as prf
 import get_road_environment as gre
 
 latlong = 'epsg:4326'
@@ -13,117 +20,439 @@ ukgrid = 'epsg:27700'
 
 refresh_ref_data = False
 
-# create interim folder
-os.makedirs('../data/interim/', exist_ok=True)
+# storage backend for the interim and final outputs - 'parquet', 'feather' or 'geojson'
+storage = 'parquet'
 
-## Retreive Data
 # Highways network - todo: switch to open data, e.g. OS Open Roads or OpenStreetMap
-highway = gpd.read_file('../data/os-highways/os_highways_data.geojson')
-
-# Import Reference Data
-if refresh_ref_data:
-    bus_stop_gdf = gre.get_bus_stop_data('bus_stops')
-    crossing_gdf = gre.get_crossing_data('crossings')
-
-else:
-    bus_stop_gdf = gpd.read_file('../data/osm/bus_stops.geojson')
-    crossing_gdf = gpd.read_file('../data/osm/crossings.geojson')
-
-cyclelane_gdf = gre.get_cycle_lane_layer(download=refresh_ref_data)
-traffic_calming_gdf = gre.get_traffic_calming_layer(download=refresh_ref_data)
-# bus_lanes_gdf # - find suitable source for bus lane data...OSM?
-
-## set GeoDataframes to UKGRID (EPSG=27700)
-for shape_layer in [highway, bus_stop_gdf, crossing_gdf, cyclelane_gdf, traffic_calming_gdf]:
-    shape_layer.to_crs(ukgrid, inplace=True)
-
-## Match Crossings to network
-crossing_matched_gdf = gf.match_point_to_line(highway, ['TOID','identifier'], crossing_gdf, buffer=15)
-crossing_matched_gdf.to_file('../data/interim/crossings_matched.geojson', driver='GeoJSON')
-del crossing_gdf
-
-# set crossing types
-crossing_matched_gdf['type'] = 'unmarked_crossing'
-crossing_matched_gdf.loc[crossing_matched_gdf['crossing'].isin(['traffic_signals','signals','pedestrian_signals','controlled','traffic_signals;marked','pelican']),'type'] = 'signalled_crossing'
-crossing_matched_gdf.loc[crossing_matched_gdf['crossing'].isin(['uncontrolled','marked','zebra','uncontrolled;marked','pelican']),'type'] = 'marked_crossing'
-crossing_matched_gdf['value'] = 1
-
-# pivot crossings to get types on each stretch
-crossing_matched_gdf = pd.crosstab(index=crossing_matched_gdf.TOID, columns=crossing_matched_gdf['type'],values=crossing_matched_gdf.value, aggfunc='max').reset_index().fillna(0)
-
-## Match Bus Stops to network
-bus_stop_matched_gdf = gf.match_point_to_line(highway, ['TOID','identifier'], bus_stop_gdf, buffer=15)
-bus_stop_matched_gdf.to_file('../data/interim/bus_stop_matched.geojson', driver='GeoJSON')
-del bus_stop_gdf
-
-## Match Bus Lanes to network
-# Convert multi-part geometrieese to single part ready for looping over
-# bus_lanes_gdf = bus_lanes_gdf.explode().reset_index(drop=True)
-# bus_lane_matched = gf.match_line_to_line(highway[~highway.routeHierarchy.isin(['Restricted Local Access Road','Local Access Road','Secondary Access Road','Restricted Secondary Access Road'])], bus_lanes_gdf, buffer=5)
-# bus_lane_matched = bus_lane_matched[['TOID','identifier','DIRECTION','ROAD_NAME','LANE_TYPE']]
-
-## Match Traffic Calming to network
-traffic_calming_matched_gdf = gf.match_point_to_line(highway, ['TOID','identifier'], traffic_calming_gdf, buffer=15)
-traffic_calming_matched_gdf.to_file('../data/interim/traffic_calming_matched.geojson', driver='GeoJSON')
-del traffic_calming_gdf
-
-# the traffic calming values are the wrong format. Let's change them
-tc_cols = ['TRF_RAISED','TRF_ENTRY','TRF_CUSHI','TRF_HUMP','TRF_SINUSO','TRF_BARIER','TRF_NAROW','TRF_CALM']
-for col in tc_cols:
-    traffic_calming_matched_gdf[col] = traffic_calming_matched_gdf[col].apply(lambda x: 1 if x == 'TRUE' else 0)
-
-# group traffic calming to get values per stretch
-traffic_calming_matched_gdf = traffic_calming_matched_gdf.drop(['FEATURE_ID','SVDATE','BOROUGH','PHOTO1_URL','PHOTO2_URL','identifier','geometry'], axis=1).groupby(['TOID'], as_index=False).max()
-
-## Match CID to network
-cid_cols = ['CLT_CARR','CLT_SEGREG','CLT_STEPP','CLT_PARSEG','CLT_SHARED','CLT_MANDAT',
-       'CLT_ADVIS','CLT_PRIORI','CLT_CONTRA','CLT_BIDIRE','CLT_CBYPAS',
-       'CLT_BBYPAS','CLT_PARKR','CLT_WATERR','CLT_PTIME']
-
-for col in cid_cols:
-    cyclelane_gdf[col] = cyclelane_gdf[col].apply(lambda x:1 if x == 'TRUE' else 0)
-cyclelane_gdf = cyclelane_gdf.drop(['OBJECTID','FEATURE_ID','FEAT_TYPE','SVDATE','BOROUGH',
-       'CLT_COLOUR','FWD','Highways_P','Road_Name','Road_Class','OSM_ID','OS_Highw_1','SHAPE_Leng','geometry'],axis=1).groupby(['OS_Highway'], as_index=False).max()
-
-## Determine Highway features
-highway['gradient'] = highway.apply(lambda x: gf.stretch_gradient(x, 'length'), axis=1)
-highway['sinuosity'] = highway.apply(lambda x: gf.stretch_sinuosity(x, 'length'), axis=1)
-highway['bearing'] = highway.apply(lambda x: gf.stretch_bearing(x), axis=1)
-highway['relative_location'] = highway.apply(lambda x: gf.stretch_location(x), axis=1)
-highway['roadWidthMinimum'] = highway['roadWidthMinimum'].apply(lambda x: float(x.replace('m','')) if len(x) > 0 else np.nan)
-highway['roadWidthAverage'] = highway['roadWidthAverage'].apply(lambda x: float(x.replace('m','')) if len(x) > 0 else np.nan)
-highway['start_x'], highway['end_x'], highway['start_y'], highway['end_y'] = highway.apply(lambda x: gf.stretch_key_coords(x), axis=1, result_type='expand').T.values
-
-# check existance of bus stop on link
-highway['bus_stop'] = highway['TOID'].isin(bus_stop_matched_gdf.TOID.unique()).astype('uint16')
-
-# check existance of bus lane on link
-# highway['bus_lane'] = highway['TOID'].isin(bus_lane_matched.TOID.unique()).astype('uint16')
-
-# join crossings to network data
-highway = highway.join(crossing_matched_gdf.set_index('TOID'), how='left', on='TOID')
-
-# join traffic calming to network data
-highway = highway.join(traffic_calming_matched_gdf.set_index('TOID'), how='left', on='TOID')
-
-# join cid data by TOID
-highway = highway.join(cyclelane_gdf.set_index('OS_Highway'), how='left', on='TOID')
-
-## Fill in NaN on joined columns with 0
-# gather names of joined columns as a set (will not repeat column names)
-fill_cols = set()
-for item in [crossing_matched_gdf, traffic_calming_matched_gdf, cyclelane_gdf]:
-    fill_cols = fill_cols.union(item.columns.values.tolist())
-
-# remove TOID and OS_Highway from the set - use discard to avoid any name not found errors
-fill_cols.discard('TOID')
-fill_cols.discard('OS_Highway')
-
-# convert the set to a list
-fill_cols = list(fill_cols)
-
-# for all column names in the list, set the NaN values to 0
-highway.loc[:, fill_cols] = highway.loc[:, fill_cols].fillna(0)
-
-## Export the road environment data
-highway.to_file('../data/interim/road_environment.geojson', driver='GeoJSON')
\ No newline at end of file
+highway_file = '../data/os-highways/os_highways_data.geojson'
+
+# bus lane layer, matched to the network when the file is available
+bus_lane_file = '../data/tfl/bus_lanes.geojson'
+
+# number of processes used to match reference data to the network
+workers = os.cpu_count()
+
+# radius (m) used to match reference points to the network
+buffer = 15
+
+# radius (m) used to match bus lanes to the network
+bus_lane_buffer = 5
+
+# number of nodes sampled as sources for the network centrality (None for every node)
+centrality_samples = 1000
+
+# hashes of the network used for the last build, compared against new releases for delta updates
+hashes_file = '../data/interim/highway_hashes.csv'
+
+# timings, memory and row counts of the last build (Chrome trace format)
+trace_file = '../data/interim/build_trace.json'
+
+# reference point layers: matched file name and the id column of each point
+reference_points = {
+    'crossings': ('crossings_matched', 'id'),
+    'bus_stops': ('bus_stop_matched', 'id'),
+    'traffic_calming': ('traffic_calming_matched', 'FEATURE_ID')
+}
+
+# 0 / 1 flags added by road_environment, which are 0 for links without the feature
+feature_flags = ['bus_stop', 'bus_lane', 'marked_crossing', 'signalled_crossing', 'unmarked_crossing'] + list(cf.traffic_calming_schema) + list(cf.cycle_lane_schema)
+
+## Stages
+def load_highway_index(path, crs=ukgrid):
+    """
+    Load the highways network and its spatial index. The network is reprojected and indexed
+    once, then reloaded from the saved index on later runs
+    """
+    return gf.RoadNetworkIndex.from_file(path, crs=crs)
+
+def load_reference_layer(path, crs=ukgrid, columns=None, source=None, schema=None, storage=storage):
+    """
+    Load a reference layer in UKGRID (EPSG=27700) and clean its columns with a schema (see clean_functions.schemas).
+    The reprojected layer is stored with the backend, so it is only reprojected when the source changes
+    """
+    layer = iof.load_layer(path, storage, columns=columns, source=source, crs=crs)
+
+    if schema is not None:
+        layer = cf.clean_frame(layer, cf.schemas[schema], name=os.path.basename(path))
+
+    return gf.reproject(layer, crs)
+
+def match_reference_points(highway_index, points, line_columns=['TOID','identifier'], buffer=buffer, name=None, storage=storage, workers=workers):
+    """
+    Match reference points to the network, keeping a copy of the matched points in the interim folder
+    """
+    matched = gf.match_point_to_line(highway_index, line_columns, points, buffer=buffer, workers=workers)
+    iof.write_layer(matched, f'../data/interim/{name}', storage)
+
+    return matched
+
+def match_bus_lanes(highway_index, bus_lanes_gdf, buffer=bus_lane_buffer, workers=workers, path='../data/interim/bus_lane_matched.csv'):
+    """
+    Match bus lanes to the network (a GeoDataFrame or RoadNetworkIndex). Every part of multi-part
+    geometries is matched, so there is no need to explode them first. Only the geometry of the
+    links that can have bus lanes is created from the index
+    """
+    highway = gf.line_attributes(highway_index)
+    roads = ~highway.routeHierarchy.isin(['Restricted Local Access Road','Local Access Road','Secondary Access Road','Restricted Secondary Access Road']).to_numpy()
+
+    if isinstance(highway_index, gf.RoadNetworkIndex):
+        highway = highway_index.geodataframe(rows=np.flatnonzero(roads))
+    else:
+        highway = highway[roads]
+
+    # the bus lane (its index in the layer) is kept, so its matches can be replaced when the network is updated
+    bus_lane_matched = gf.match_line_to_line(highway, bus_lanes_gdf, buffer=buffer, workers=workers)
+    bus_lane_matched = bus_lane_matched.rename(columns={'line2_idx': 'bus_lane'})[['bus_lane','TOID','identifier','DIRECTION','ROAD_NAME','LANE_TYPE']]
+
+    if path is not None:
+        bus_lane_matched.to_csv(path, index=False)
+
+    return bus_lane_matched
+
+def crossing_features(crossing_matched_gdf):
+    """
+    Flag the type of each matched crossing - marked takes priority over signalled (e.g. pelican)
+    """
+    crossing = crossing_matched_gdf['crossing']
+    marked = crossing.isin(['uncontrolled','marked','zebra','uncontrolled;marked','pelican']).to_numpy()
+    signalled = crossing.isin(['traffic_signals','signals','pedestrian_signals','controlled','traffic_signals;marked','pelican']).to_numpy() & ~marked
+
+    return pd.DataFrame({
+        'TOID': crossing_matched_gdf['TOID'].to_numpy(),
+        'marked_crossing': marked.astype('uint8'),
+        'signalled_crossing': signalled.astype('uint8'),
+        'unmarked_crossing': (~marked & ~signalled).astype('uint8')
+    })
+
+def traffic_calming_features(traffic_calming_matched_gdf):
+    """
+    Keep the traffic calming flags of each matched feature. The flags are converted to 0 / 1 when
+    loaded (clean_functions.traffic_calming_schema)
+    """
+    return pd.DataFrame(traffic_calming_matched_gdf[['TOID'] + list(cf.traffic_calming_schema)])
+
+def cycle_lane_features(cyclelane_gdf):
+    """
+    Keep the CID flags of each cycle lane / track. CID is joined to the network by TOID (OS_Highway),
+    so the geometry is not needed. The flags are converted to 0 / 1 when loaded (clean_functions.cycle_lane_schema)
+    """
+    return pd.DataFrame(cyclelane_gdf[['OS_Highway'] + list(cf.cycle_lane_schema)])
+
+def highway_features(highway_index):
+    """
+    Determine Highway features for the network (a GeoDataFrame or RoadNetworkIndex). For an index
+    the metrics are calculated on its geometry store and the features are returned without
+    geometry, which is attached on export
+    """
+    highway = gf.line_attributes(highway_index).copy()
+
+    stretch_metrics = gf.compute_stretch_metrics(highway_index, ['gradient','sinuosity','bearing','relative_location','key_coords'], shape_length='length')
+    for col in stretch_metrics.columns:
+        highway[col] = stretch_metrics[col]
+
+    # gradient and curvature along the whole stretch, not just between its ends
+    profile_metrics = gf.compute_profile_metrics(highway_index)
+    for col in profile_metrics.columns:
+        highway[col] = profile_metrics[col]
+
+    # road widths, metrics and route hierarchy to compact types
+    return cf.clean_frame(highway, cf.highway_schema, name='highway')
+
+def network_centrality(highway_index, samples=centrality_samples, seed=0, workers=workers):
+    """
+    Calculate the betweenness and closeness centrality of each link, weighted by length
+    """
+    graph = nf.RoadGraph.from_lines(highway_index, weight='length', key='TOID')
+
+    return graph.centrality(samples=samples, seed=seed, workers=workers)
+
+def road_environment(highway, bus_stop_matched_gdf, crossing_matched_gdf, traffic_calming_matched_gdf, cyclelane_gdf, centrality, bus_lane_matched=None):
+    """
+    Aggregate the matched reference data onto the network in one pass, and add the network centrality.
+    Links without any features are given 0
+    """
+    # presence of a bus stop / bus lane on link
+    layers = [fe.feature_layer(bus_stop_matched_gdf, 'TOID', {'bus_stop': (None, 'any')})]
+    if bus_lane_matched is not None:
+        layers.append(fe.feature_layer(bus_lane_matched, 'TOID', {'bus_lane': (None, 'any')}))
+
+    # crossing types, traffic calming and cid flags on each link
+    layers += [
+        fe.feature_layer(crossing_matched_gdf, 'TOID', {col: (col, 'max') for col in ['marked_crossing','signalled_crossing','unmarked_crossing']}),
+        fe.feature_layer(traffic_calming_matched_gdf, 'TOID', {col: (col, 'max') for col in cf.traffic_calming_schema}),
+        fe.feature_layer(cyclelane_gdf, 'OS_Highway', {col: (col, 'max') for col in cf.cycle_lane_schema})
+    ]
+
+    highway = fe.aggregate_features(highway, layers, key='TOID')
+
+    # network centrality has one row per link
+    codes = fe.key_codes(centrality['TOID'], highway['TOID'])
+    for col in ['betweenness', 'closeness']:
+        highway[col] = np.where(codes >= 0, centrality[col].to_numpy()[codes], np.nan).astype('float32')
+
+    return highway
+
+def highway_hashes(highway_index):
+    """
+    Hash the geometry and attributes of each link, to find the links that change in the next release
+    """
+    return gf.line_hashes(highway_index, key='TOID')
+
+def export_road_environment(highway, hashes, highway_index=None, path='../data/interim/road_environment', storage=storage):
+    """
+    Export the road environment data, along with the hashes of the network it was built from.
+    The link geometry is created from the index (if given) by TOID, only for the export
+    """
+    if highway_index is not None:
+        highway = pd.DataFrame(highway.drop(columns=highway_index.geometry, errors='ignore'))
+        rows = fe.key_codes(highway_index.attributes['TOID'], highway['TOID'])
+        assert (rows >= 0).all(), 'Some links are not in the network'
+
+        highway = highway_index.geodataframe(highway, rows=rows)
+
+    iof.write_layer(highway, path, storage)
+    hashes.to_csv(hashes_file, index=False)
+
+def build_stages(storage=storage, workers=workers, highways=highway_file):
+    """
+    Define the stages of the build as a DAG:
+    load -> reproject -> match per layer -> aggregate -> join -> export
+    """
+    settings = {'storage': storage}
+    match_settings = {'storage': storage, 'workers': workers}
+
+    # the load stages convert (and reproject) the reference data when its source changes, so key them on the sources
+    crossing_file = iof.layer_path('../data/osm/crossings', 'geojson')
+    bus_stop_file = iof.layer_path('../data/osm/bus_stops', 'geojson')
+    cyclelane_file = '../data/cid/cycle_lane_track.json'
+    traffic_calming_file = '../data/cid/traffic_calming.json'
+
+    # the converted copies are the cache of the load stages, so they are only kept in the stage cache for geojson
+    load_cache = storage == 'geojson'
+
+    # modules whose code changes the output of the stages, beyond the stage function itself
+    load_files = [iof.__file__, cf.__file__, gf.__file__]
+    match_files = [gf.__file__, iof.__file__]
+
+    def matched_file(name):
+        return iof.layer_path(f'../data/interim/{name}', storage)
+
+    export_path = '../data/interim/road_environment'
+
+    stages = [
+        pf.Stage('highway_index', load_highway_index, files=[highways], params={'path': highways, 'crs': ukgrid}, cache=False),
+        pf.Stage('highway_hashes', highway_hashes, inputs=['highway_index'], files=[gf.__file__]),
+        pf.Stage('crossings', load_reference_layer, files=[crossing_file] + load_files, params={'path': '../data/osm/crossings', 'columns': ['id','crossing','crossing_ref'], 'schema': 'crossing'}, settings=settings, cache=load_cache),
+        pf.Stage('bus_stops', load_reference_layer, files=[bus_stop_file] + load_files, params={'path': '../data/osm/bus_stops', 'columns': ['id','naptan:AtcoCode','naptan:Bearing'], 'schema': 'bus_stop'}, settings=settings, cache=load_cache),
+        pf.Stage('traffic_calming', load_reference_layer, files=[traffic_calming_file] + load_files, params={'path': '../data/cid/traffic_calming', 'source': '../data/cid/traffic_calming.json', 'schema': 'traffic_calming'}, settings=settings, cache=load_cache),
+        pf.Stage('cycle_lanes', load_reference_layer, files=[cyclelane_file] + load_files, params={'path': '../data/cid/cycle_lane_track', 'source': '../data/cid/cycle_lane_track.json', 'schema': 'cycle_lane'}, settings=settings, cache=load_cache),
+        pf.Stage('crossings_matched', match_reference_points, inputs=['highway_index', 'crossings'], files=match_files, params={'buffer': buffer, 'name': 'crossings_matched'}, settings=match_settings, outputs=[matched_file('crossings_matched')]),
+        pf.Stage('bus_stops_matched', match_reference_points, inputs=['highway_index', 'bus_stops'], files=match_files, params={'buffer': buffer, 'name': 'bus_stop_matched'}, settings=match_settings, outputs=[matched_file('bus_stop_matched')]),
+        pf.Stage('traffic_calming_matched', match_reference_points, inputs=['highway_index', 'traffic_calming'], files=match_files, params={'buffer': buffer, 'name': 'traffic_calming_matched'}, settings=match_settings, outputs=[matched_file('traffic_calming_matched')]),
+        pf.Stage('crossing_features', crossing_features, inputs=['crossings_matched']),
+        pf.Stage('traffic_calming_features', traffic_calming_features, inputs=['traffic_calming_matched'], files=[cf.__file__]),
+        pf.Stage('cycle_lane_features', cycle_lane_features, inputs=['cycle_lanes'], files=[cf.__file__]),
+        pf.Stage('highway_features', highway_features, inputs=['highway_index'], files=[gf.__file__, cf.__file__]),
+        pf.Stage('centrality', network_centrality, inputs=['highway_index'], files=[nf.__file__, gf.__file__], params={'samples': centrality_samples, 'seed': 0}, settings={'workers': workers}),
+    ]
+
+    environment_inputs = ['highway_features', 'bus_stops_matched', 'crossing_features', 'traffic_calming_features', 'cycle_lane_features', 'centrality']
+
+    if os.path.exists(bus_lane_file):
+        stages += [
+            pf.Stage('bus_lanes', load_reference_layer, files=[bus_lane_file] + load_files, params={'path': bus_lane_file, 'source': bus_lane_file}, settings={'storage': 'geojson'}),
+            pf.Stage('bus_lanes_matched', match_bus_lanes, inputs=['highway_index', 'bus_lanes'], files=[gf.__file__], params={'buffer': bus_lane_buffer}, settings={'workers': workers}, outputs=['../data/interim/bus_lane_matched.csv']),
+        ]
+        environment_inputs.append('bus_lanes_matched')
+
+    stages += [
+        pf.Stage('road_environment', road_environment, inputs=environment_inputs, files=[fe.__file__, cf.__file__]),
+        pf.Stage('export', export_road_environment, inputs=['road_environment', 'highway_hashes', 'highway_index'], files=[iof.__file__, gf.__file__, fe.__file__], params={'path': export_path}, settings=settings, outputs=[iof.layer_path(export_path, storage), hashes_file]),
+    ]
+
+    return stages
+
+def update_road_environment(highways=highway_file, storage=storage, workers=workers, buffer=buffer, path='../data/interim/road_environment'):
+    """
+    Update the last build for a new release of the highways network, without rebuilding it.
+
+    The new network is compared with the last build by TOID and geometry / attribute hashes. Only
+    the reference points within buffer of added or moved links and the bus lanes within their buffer
+    of changed links (or either matched to changed or removed links) are matched again, against the
+    whole network, and only the rows of the links affected by a change are rebuilt
+    and patched into the last road environment output. Network centrality depends on the whole
+    network, so it is recalculated for every link. If the last build has different columns (other
+    than feature flags) every link is rebuilt. Assumes the reference data has not changed since
+    the last build
+    """
+    assert os.path.exists(hashes_file), 'No previous build to update, run a full build first'
+
+    stages = build_stages(storage=storage, workers=workers, highways=highways)
+    targets = ['highway_index', 'highway_hashes', 'cycle_lane_features', 'centrality'] + list(reference_points)
+    if os.path.exists(bus_lane_file):
+        targets.append('bus_lanes')
+
+    results, report = pf.Pipeline(stages, storage=storage).run(targets=targets)
+    highway_index = results['highway_index']
+    network = highway_index.attributes
+
+    diff = gf.diff_lines(pd.read_csv(hashes_file, dtype={'geometry_hash': 'uint64', 'attribute_hash': 'uint64'}), results['highway_hashes'])
+    moved = np.concatenate([diff['added'], diff['geometry']])
+    changed = np.concatenate([moved, diff['attributes']])
+    dropped = np.concatenate([diff['geometry'], diff['attributes'], diff['removed']])
+
+    # links to rebuild, added to as points are matched again
+    affected = set(changed)
+
+    moved_links = highway_index.geodataframe(rows=np.flatnonzero(network.TOID.isin(moved)))
+    matched = {}
+    rematched_points = {}
+    for name, (matched_name, key) in reference_points.items():
+        points = results[name]
+        previous = iof.read_layer(f'../data/interim/{matched_name}', storage)
+
+        # points matched to links that changed, and points close enough to be matched to moved links
+        rematch = set(previous.loc[previous.TOID.isin(dropped), key])
+        if len(moved_links) > 0:
+            pt_i, _, _ = gf.point_line_candidates(moved_links, points, buffer=buffer)
+            rematch.update(points[key].values[pt_i])
+
+        with prf.span(f'rematch {name}', rows_in=len(rematch)):
+            rematched = gf.match_point_to_line(highway_index, ['TOID','identifier'], points[points[key].isin(rematch)], buffer=buffer, workers=workers)
+
+        affected.update(previous.loc[previous[key].isin(rematch), 'TOID'])
+        affected.update(rematched.TOID)
+        rematched_points[name] = len(rematch)
+
+        matched[name] = pd.concat([previous[~previous[key].isin(rematch)], rematched])
+        iof.write_layer(matched[name], f'../data/interim/{matched_name}', storage)
+
+    bus_lane_matched = None
+    if os.path.exists(bus_lane_file):
+        bus_lanes = results['bus_lanes']
+        previous = pd.read_csv('../data/interim/bus_lane_matched.csv')
+
+        if 'bus_lane' in previous.columns:
+            # bus lanes matched to links that changed, and bus lanes close enough to be matched to changed
+            # links (links can change road type, which decides whether bus lanes are matched to them)
+            rematch = set(previous.loc[previous.TOID.isin(dropped), 'bus_lane'])
+            changed_links = highway_index.geodataframe(rows=np.flatnonzero(network.TOID.isin(changed)))
+            if len(changed_links) > 0:
+                lane_i, _ = gf.BoundsGrid(changed_links.geometry.values.bounds).query(bus_lanes.geometry.values.bounds + [-bus_lane_buffer, -bus_lane_buffer, bus_lane_buffer, bus_lane_buffer])
+                rematch.update(bus_lanes.index[lane_i])
+        else:
+            # matched before the bus lanes were kept, so match all of them again
+            rematch = set(bus_lanes.index)
+            previous = previous.assign(bus_lane=-1)
+
+        replaced = previous.bus_lane.isin(rematch) | (previous.bus_lane < 0)
+        with prf.span('rematch bus_lanes', rows_in=len(rematch)):
+            rematched = match_bus_lanes(highway_index, bus_lanes.loc[sorted(rematch)], workers=workers, path=None)
+
+        affected.update(previous.loc[replaced, 'TOID'])
+        affected.update(rematched.TOID)
+        rematched_points['bus_lanes'] = len(rematch)
+
+        bus_lane_matched = pd.concat([previous[~replaced], rematched])
+        bus_lane_matched.to_csv('../data/interim/bus_lane_matched.csv', index=False)
+
+    ## Rebuild the affected links
+    # the features are aggregated per TOID, which is cheap, so aggregate all of the matched points
+    def rebuild(links):
+        return road_environment(
+            highway_features(links),
+            matched['bus_stops'],
+            crossing_features(matched['crossings']),
+            traffic_calming_features(matched['traffic_calming']),
+            results['cycle_lane_features'],
+            results['centrality'],
+            bus_lane_matched
+        )
+
+    with prf.span('rebuild links', rows_in=len(affected)):
+        updated = rebuild(highway_index.geodataframe(rows=np.flatnonzero(network.TOID.isin(affected))))
+
+    previous = iof.read_layer(path, storage)
+
+    # columns only found on one side of the patch are 0 where missing if they are feature flags (e.g. a
+    # layer that was not available last time). Any other column (e.g. a metric added since the last
+    # build) cannot be filled in, so every link is rebuilt
+    new_cols = previous.columns.symmetric_difference(updated.columns)
+    if new_cols.isin(feature_flags).all():
+        highway = pd.concat([previous[~previous.TOID.isin(affected.union(diff['removed']))], updated])
+        highway[new_cols] = highway[new_cols].fillna(0).astype('uint8')
+    else:
+        with prf.span('rebuild all links', rows_in=len(network)):
+            updated = highway = rebuild(highway_index)
+
+    # categories can differ between the previous and updated rows
+    highway = cf.clean_frame(highway, cf.highway_schema)
+
+    # centrality depends on the whole network, so it is updated for every link
+    centrality = results['centrality'].set_index('TOID')
+    for col in centrality.columns:
+        highway[col] = highway.TOID.map(centrality[col])
+
+    # put the links back in network order
+    highway = highway.iloc[pd.Index(highway.TOID).get_indexer(network.TOID)]
+    highway.index = network.index
+
+    export_road_environment(highway, results['highway_hashes'], highway_index, path=path, storage=storage)
+
+    summary = pd.DataFrame([{
+        'added': len(diff['added']),
+        'removed': len(diff['removed']),
+        'geometry changed': len(diff['geometry']),
+        'attributes changed': len(diff['attributes']),
+        'links rebuilt': len(updated),
+        **{f'{name} matched again': count for name, count in rematched_points.items()}
+    }])
+
+    return highway, summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the road environment reference data, only rerunning the stages whose inputs have changed')
+    parser.add_argument('--refresh', action='store_true', default=refresh_ref_data, help='download the latest reference data first')
+    parser.add_argument('--storage', choices=list(iof.storage_extensions), default=storage, help='storage backend for the outputs')
+    parser.add_argument('--workers', type=int, default=workers, help='number of processes used for matching')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to rerun even if they are cached')
+    parser.add_argument('--target', nargs='*', default=None, help='stages to build (default: export)')
+    parser.add_argument('--highways', default=highway_file, help='highways network file')
+    parser.add_argument('--delta', action='store_true', help='patch the last build for a new highways release, only rebuilding the links that changed')
+    parser.add_argument('--trace', default=trace_file, help='file to write the stage timings, memory and row counts to')
+    parser.add_argument('--profile', nargs='*', default=[], help='stages to run under cProfile, dumped to ../data/interim/profile/')
+    args = parser.parse_args(argv)
+
+    prf.tracer.reset()
+
+    # create interim folder
+    os.makedirs('../data/interim/', exist_ok=True)
+
+    ## Retreive Data
+    # downloads replace the source files, so the stored (reprojected) copies and any stages using them are rebuilt
+    if args.refresh:
+        print(gre.download_reference_data().to_string(index=False))
+
+        gre.get_bus_stop_data('bus_stops', storage='geojson', download=False)
+        gre.get_crossing_data('crossings', storage='geojson', download=False)
+
+    if args.delta:
+        with prf.span('update_road_environment'):
+            highway, summary = update_road_environment(highways=args.highways, storage=args.storage, workers=args.workers)
+
+        print(summary.to_string(index=False))
+        print(f'Trace written to {prf.tracer.write(args.trace)}')
+
+        return highway
+
+    pipeline = pf.Pipeline(build_stages(storage=args.storage, workers=args.workers, highways=args.highways), storage=args.storage)
+    results, report = pipeline.run(targets=args.target, force=args.force, profile=args.profile)
+
+    print(report.to_string(index=False))
+    print(f'Trace written to {prf.tracer.write(args.trace)}')
+
+    return results
+
+# the process pool used for matching re-imports this script, so only build when run directly
+if __name__ == '__main__':
+    main()
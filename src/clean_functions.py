@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+import profile_functions as prf
+
+## Schemas
+# the type of each source column:
+#   flag     - 'TRUE' / 'FALSE' strings, stored as 0 / 1 (uint8)
+#   length   - strings with a unit suffix (e.g. '5.5m'), stored as float32 with NaN for blanks
+#   category - repeated labels, stored as a categorical
+#   anything else is a numpy dtype to convert to, e.g. 'float32' or 'uint16'
+cycle_lane_schema = {col: 'flag' for col in ['CLT_CARR','CLT_SEGREG','CLT_STEPP','CLT_PARSEG','CLT_SHARED','CLT_MANDAT',
+    'CLT_ADVIS','CLT_PRIORI','CLT_CONTRA','CLT_BIDIRE','CLT_CBYPAS','CLT_BBYPAS','CLT_PARKR','CLT_WATERR','CLT_PTIME']}
+
+traffic_calming_schema = {col: 'flag' for col in ['TRF_RAISED','TRF_ENTRY','TRF_CUSHI','TRF_HUMP','TRF_SINUSO','TRF_BARIER','TRF_NAROW','TRF_CALM']}
+
+crossing_schema = {'crossing': 'category', 'crossing_ref': 'category'}
+
+bus_stop_schema = {'naptan:Bearing': 'category'}
+
+highway_schema = {
+    'roadWidthMinimum': 'length',
+    'roadWidthAverage': 'length',
+    'routeHierarchy': 'category',
+    'length': 'float32',
+    'gradient': 'float32',
+    'sinuosity': 'float32',
+    'max_gradient': 'float32',
+    'mean_gradient': 'float32',
+    'turning_angle': 'float32',
+    'max_curvature': 'float32',
+    'bearing': 'uint16',
+    'relative_location': 'uint32',
+    'start_x': 'float32',
+    'end_x': 'float32',
+    'start_y': 'float32',
+    'end_y': 'float32'
+}
+
+schemas = {
+    'cycle_lane': cycle_lane_schema,
+    'traffic_calming': traffic_calming_schema,
+    'crossing': crossing_schema,
+    'bus_stop': bus_stop_schema,
+    'highway': highway_schema
+}
+
+def clean_column(series, kind):
+    """
+    Convert a column to the type given in a schema
+    """
+    if kind == 'flag':
+        if series.dtype == 'bool':
+            return series.astype('uint8')
+
+        return series.astype(str).str.upper().eq('TRUE').astype('uint8')
+
+    elif kind == 'length':
+        if series.dtype == 'object':
+            series = series.str.strip().str.rstrip('m')
+
+        return pd.to_numeric(series, errors='coerce').astype('float32')
+
+    elif kind == 'category':
+        return series.astype('category')
+
+    return series.astype(kind)
+
+def memory_usage(df):
+    """
+    Memory used by a DataFrame in MB, including the content of object columns
+    """
+    return df.memory_usage(deep=True).sum() / 2**20
+
+def clean_frame(df, schema, name=None):
+    """
+    Convert the columns of a DataFrame to the types in a schema (a dictionary of column name to
+    type, see clean_column). Columns not in the DataFrame are skipped. If a name is given, the
+    memory used before and after (MB) is recorded on the clean_frame span of the trace
+    """
+    with prf.span('clean_frame', layer=name, rows_in=len(df)):
+        if name is not None:
+            prf.record(memory_before_mb=round(memory_usage(df), 1))
+
+        df = df.copy()
+        for col, kind in schema.items():
+            if col in df.columns:
+                df[col] = clean_column(df[col], kind)
+
+        if name is not None:
+            prf.record(memory_after_mb=round(memory_usage(df), 1))
+
+    return df
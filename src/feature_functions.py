@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+# reducers for the columns of a feature layer:
+#   max   - largest value on the link (0 if there are none)
+#   count - number of rows on the link (with a non-zero value, if a column is given)
+#   any   - 1 if any row on the link (with a non-zero value, if a column is given), else 0
+reducers = ['max', 'count', 'any']
+
+def feature_layer(data, key='TOID', columns=None):
+    """
+    Describe a layer of features to aggregate per link: the rows, the column holding the link key
+    and a dictionary of output column to (source column, reducer). The source column can be None
+    for count and any, to use the rows themselves
+    """
+    columns = columns or {}
+
+    unknown = {reducer for _, reducer in columns.values()}.difference(reducers)
+    assert len(unknown) == 0, f'Unknown reducers: {sorted(unknown)}'
+
+    return {'data': data, 'key': key, 'columns': columns}
+
+def key_codes(keys, values):
+    """
+    Integer code (position in keys) of each value, or -1 for values not in keys
+    """
+    keys = pd.Index(keys)
+    assert keys.is_unique, 'The link keys are not unique'
+
+    return keys.get_indexer(values)
+
+def aggregate_features(network, layers, key='TOID'):
+    """
+    Aggregate any number of feature layers (see feature_layer) onto the links of a network.
+
+    The rows of each layer are given the integer code of their link once, then every output column
+    is reduced straight into a preallocated array (with all the max columns of a layer reduced in one
+    call over its rows sorted by link), so no per-layer tables are built and the network is copied
+    once. Returns the network with a column added for each output column
+    """
+    size = len(network)
+    features = {}
+
+    for layer in layers:
+        data = layer['data']
+        codes = key_codes(network[key], data[layer['key']])
+
+        # rows that are not on a link of the network are left out
+        on_network = codes >= 0
+        codes = codes[on_network]
+
+        max_cols = [col for col, (_, reducer) in layer['columns'].items() if reducer == 'max']
+        if len(max_cols) > 0:
+            values = data[[layer['columns'][col][0] for col in max_cols]].to_numpy()[on_network]
+            result = np.zeros((size, len(max_cols)), dtype=values.dtype)
+
+            # sort the rows by link, then reduce each run of rows on the same link
+            order = np.argsort(codes, kind='stable')
+            sorted_codes = codes[order]
+            starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1) != 0)
+            result[sorted_codes[starts]] = np.maximum.reduceat(values[order], starts, axis=0)
+
+            for i, col in enumerate(max_cols):
+                features[col] = result[:, i]
+
+        for col, (source, reducer) in layer['columns'].items():
+            if reducer == 'max':
+                continue
+
+            rows = codes
+            if source is not None:
+                rows = codes[data[source].fillna(0).to_numpy()[on_network] != 0]
+
+            if reducer == 'count':
+                features[col] = np.bincount(rows, minlength=size).astype('uint32')
+            else:
+                result = np.zeros(size, dtype='uint8')
+                result[rows] = 1
+                features[col] = result
+
+    network = network.copy()
+    for col, values in features.items():
+        network[col] = values
+
+    return network
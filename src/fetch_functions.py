@@ -0,0 +1,271 @@
+import os
+import json
+import math
+import time
+import hashlib
+import asyncio
+from urllib.parse import urlsplit
+import aiohttp
+import pandas as pd
+
+# responses worth trying again after a wait, e.g. a busy server (429) or a gateway timeout (504)
+retry_statuses = (429, 502, 503, 504)
+
+class RetryError(Exception):
+    """
+    A download that failed in a way that may succeed later, optionally with the wait (seconds) asked for by the server
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def meta_path(path):
+    """
+    Path of the file holding the HTTP validators (ETag / Last-Modified) of a download
+    """
+    return f'{path}.http.json'
+
+def read_meta(path):
+    if os.path.exists(meta_path(path)):
+        with open(meta_path(path)) as file:
+            return json.load(file)
+
+    return {}
+
+def write_meta(path, meta):
+    with open(meta_path(path), 'w') as file:
+        json.dump(meta, file, indent=2)
+
+def response_validators(response):
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+def request_headers(path, meta):
+    """
+    Build the conditional request headers for a download. A complete file is only downloaded
+    again if it has changed (If-None-Match / If-Modified-Since), and a partial download is resumed
+    from where it stopped if the file has not changed since (Range / If-Range)
+    """
+    headers = {}
+
+    if os.path.exists(path):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    part = meta.get('part', {})
+    if os.path.exists(f'{path}.part') and (part.get('etag') or part.get('last_modified')):
+        headers['Range'] = f'bytes={os.path.getsize(path + ".part")}-'
+        headers['If-Range'] = part.get('etag') or part.get('last_modified')
+
+    return headers
+
+async def fetch_file(session, url, path, params=None, chunk_size=2**16, check=None):
+    """
+    Download a url to a file, streaming the body to disk in chunks.
+
+    The body is written to a .part file, which replaces the file once complete, so an interrupted
+    download never leaves a broken file behind and is resumed on the next call. If given, check is
+    called with the path of the complete .part file and returns an error message for a response
+    that should not be kept (e.g. an error reported in the body of a 200 response).
+
+    Returns a dictionary with the status of the download: downloaded, resumed, not modified or
+    failed. Raises RetryError for responses that may succeed later (see retry_statuses, and failed checks)
+    """
+    meta = read_meta(path)
+    part = f'{path}.part'
+    result = {'url': url, 'path': path, 'status': 'failed', 'bytes': 0}
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    async with session.get(url, params=params, headers=request_headers(path, meta)) as response:
+        if response.status == 304:
+            # the file is up to date, so restart its ttl (see cached_downloads)
+            os.utime(path)
+            result['status'] = 'not modified'
+            return result
+
+        if response.status in retry_statuses:
+            retry_after = response.headers.get('Retry-After', '')
+            raise RetryError(f'Status code {response.status}', float(retry_after) if retry_after.isdigit() else None)
+
+        if response.status == 416:
+            # the partial download does not fit the file on the server, so start again
+            stale = True
+        elif response.status not in (200, 206):
+            print(f'Status code {response.status}. {url} not downloaded.')
+            return result
+        else:
+            stale = False
+
+            # keep the validators of the partial download, so it can be resumed if interrupted
+            meta['part'] = response_validators(response)
+            write_meta(path, meta)
+
+            with open(part, 'ab' if response.status == 206 else 'wb') as file:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    file.write(chunk)
+                    result['bytes'] += len(chunk)
+
+            result['status'] = 'resumed' if response.status == 206 else 'downloaded'
+
+    if stale:
+        os.remove(part)
+        meta.pop('part', None)
+        write_meta(path, meta)
+
+        return await fetch_file(session, url, path, params=params, chunk_size=chunk_size, check=check)
+
+    error = check(part) if check is not None else None
+    if error is not None:
+        # the response is complete, so it cannot be resumed
+        os.remove(part)
+        meta.pop('part')
+        write_meta(path, meta)
+
+        raise RetryError(error)
+
+    os.replace(part, path)
+    write_meta(path, {'url': url, **meta.pop('part')})
+
+    return result
+
+async def fetch_all(downloads, limit=4, timeout=3600, retries=3, backoff=2, host_limits=None):
+    """
+    Download a list of files concurrently, with at most limit downloads at once, and at most
+    host_limits[host] at once from a host (e.g. a shared API). Each download is a dictionary of
+    fetch_file arguments (url, path and optionally params and check).
+
+    Downloads that fail with a RetryError or a connection error are tried up to retries more
+    times, waiting backoff * 2^attempt seconds (or as long as the server asks) in between
+    """
+    semaphore = asyncio.Semaphore(limit)
+    host_semaphores = {}
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def fetch(download):
+            host = urlsplit(download['url']).netloc
+            host_semaphore = host_semaphores.setdefault(host, asyncio.Semaphore((host_limits or {}).get(host, limit)))
+
+            for attempt in range(retries + 1):
+                try:
+                    async with host_semaphore, semaphore:
+                        return await fetch_file(session, **download)
+                except (RetryError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    if attempt == retries:
+                        raise
+
+                    # wait without holding a slot, so other downloads can go ahead
+                    await asyncio.sleep(getattr(error, 'retry_after', None) or backoff * 2**attempt)
+
+        return await asyncio.gather(*[fetch(download) for download in downloads], return_exceptions=True)
+
+def fetch_files(downloads, limit=4, timeout=3600, retries=3, backoff=2, host_limits=None):
+    """
+    Download a list of files concurrently (see fetch_all). A download that fails part way keeps
+    its partial file, which is resumed next time. Returns a DataFrame with the status of each download
+    """
+    results = asyncio.run(fetch_all(downloads, limit=limit, timeout=timeout, retries=retries, backoff=backoff, host_limits=host_limits))
+
+    report = []
+    for download, result in zip(downloads, results):
+        if isinstance(result, Exception):
+            print(f'{download["url"]} not downloaded: {result!r}')
+            result = {'url': download['url'], 'path': download['path'], 'status': 'failed', 'bytes': 0}
+
+        report.append(result)
+
+    return pd.DataFrame(report)
+
+def grid_tiles(bounds, tile_size=0.1):
+    """
+    Split a bounding box (south, west, north, east) into the tiles of a fixed global grid, so
+    overlapping areas share the same tiles. Returns a list of tile bounding boxes in the same order
+    """
+    south, west, north, east = bounds
+
+    tiles = []
+    for iy in range(math.floor(south / tile_size), math.ceil(north / tile_size)):
+        for ix in range(math.floor(west / tile_size), math.ceil(east / tile_size)):
+            tiles.append(tuple(round(value * tile_size, 6) for value in (iy, ix, iy + 1, ix + 1)))
+
+    return tiles
+
+def cache_path(cache_dir, url, params=None):
+    """
+    Path of the cached response for a request, keyed on a hash of the url and parameters
+    """
+    key = hashlib.sha256(json.dumps([url, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, f'{key}.json')
+
+def cached_downloads(requests, cache_dir, ttl=7*24*3600, refresh=False):
+    """
+    Split a list of requests (url and optionally params) into the downloads needed to update the
+    cache and the requests that can be served from it. Responses older than ttl seconds (or all
+    of them, with refresh set) are downloaded again.
+
+    Returns the list of downloads and the list of cache hits
+    """
+    now = time.time()
+    downloads = []
+    hits = []
+
+    for request in requests:
+        path = cache_path(cache_dir, request['url'], request.get('params'))
+
+        if not refresh and os.path.exists(path) and now - os.path.getmtime(path) < ttl:
+            hits.append({'url': request['url'], 'path': path, 'status': 'cached', 'bytes': 0})
+        else:
+            downloads.append({**request, 'path': path})
+
+    return downloads, hits
+
+def evict_cache(cache_dir, max_bytes=2**30, keep=()):
+    """
+    Remove the least recently used responses from the cache until it is no larger than max_bytes.
+    Responses in keep (e.g. those just used) are never removed
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    responses = [os.path.join(cache_dir, file) for file in os.listdir(cache_dir) if file.endswith('.json') and not file.endswith('.http.json')]
+    responses.sort(key=os.path.getatime)
+
+    def response_size(path):
+        return sum(os.path.getsize(file) for file in [path, meta_path(path), f'{path}.part'] if os.path.exists(file))
+
+    total = sum(response_size(path) for path in responses)
+
+    for path in responses:
+        if total <= max_bytes:
+            break
+        elif os.path.abspath(path) in keep:
+            continue
+
+        total -= response_size(path)
+        for file in [path, meta_path(path), f'{path}.part']:
+            if os.path.exists(file):
+                os.remove(file)
+
+def fetch_cached(requests, cache_dir, ttl=7*24*3600, max_bytes=2**30, refresh=False, limit=4, timeout=3600, retries=3, backoff=2):
+    """
+    Fetch a list of requests through an on-disk response cache. Only the responses that are missing
+    or older than ttl are downloaded (concurrently, see fetch_files), then the cache is trimmed to
+    max_bytes. Returns a DataFrame with the cached file and status of each request, in order
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    downloads, hits = cached_downloads(requests, cache_dir, ttl=ttl, refresh=refresh)
+    report = pd.DataFrame(hits, columns=['url','path','status','bytes'])
+    if len(downloads) > 0:
+        report = pd.concat([report, fetch_files(downloads, limit=limit, timeout=timeout, retries=retries, backoff=backoff)])
+
+    # mark the cache hits as used (access time), so they are the last to be evicted. The
+    # modification time is kept as the download time for the ttl
+    for path in report.path[report.status == 'cached']:
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+
+    evict_cache(cache_dir, max_bytes=max_bytes, keep=report.path)
+
+    order = [cache_path(cache_dir, request['url'], request.get('params')) for request in requests]
+
+    return report.set_index('path').loc[order].reset_index()
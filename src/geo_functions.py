@@ -1,16 +1,31 @@
 import geopandas as gpd
+import fiona
+from fiona.schema import FIELD_TYPES_MAP_REV
+from fiona.rfc3339 import FionaDateTimeType
 import pandas as pd
 from numpy import sqrt, arctan2
 import numpy as np
-#import networkx as nx
 import math
+from itertools import chain, islice, repeat
+from concurrent.futures import ProcessPoolExecutor
 from shapely import geometry
-from shapely.geometry import Point
+from shapely import wkb as shapely_wkb
+from shapely.geometry import Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon, GeometryCollection
+from pyproj import CRS, Transformer
+from functools import lru_cache
 import os
+import json
+import struct
+import hashlib
+import shutil
+import tempfile
+from rtree import index as rtree_index
 import matplotlib.pyplot as plt
 
-latlong = {'init':'epsg:4326'}
-ukgrid = {'init':'epsg:27700'}
+import profile_functions as prf
+
+latlong = 'epsg:4326'
+ukgrid = 'epsg:27700'
 
 def stretch_gradient(shape, shape_length):
     """
@@ -112,40 +127,242 @@ def stretch_location(shape, cent_y = 181223, cent_x = 529028):
 
     return crow_flies
 
-# create a graph network representation to calculate centrality etc
-# def gdf_to_nx(gdf_network):
-#     net = nx.Graph()
-#     net.graph['crs'] = gdf_network.crs
-#     fields = list(gdf_network.columns)
-
-#     for index, row in gdf_network.iterrows():
-#         first = row.geometry[0].coords[0][0:2]
-#         last = row.geometry[0].coords[-1][0:2]
-
-#         data = [row[f] for f in fields]
-#         attributes = dict(zip(fields, data))
-#         net.add_edge(first, last, **attributes)
-
-#     return net
-
-# def nx_to_gdf(net, nodes=True, edges=True):
-#     # generate nodes and edges geodataframes from graph
-#     if nodes is True:
-#         node_xy, node_data = zip(*net.nodes(data=True))
-#         gdf_nodes = gpd.GeoDataFrame(list(node_data), geometry=[Point(i, j) for i, j in node_xy])
-#         gdf_nodes.crs = net.graph['crs']
-
-#     if edges is True:
-#         starts, ends, edge_data = zip(*net.edges(data=True))
-#         gdf_edges = gpd.GeoDataFrame(list(edge_data))
-#         gdf_edges.crs = net.graph['crs']
-
-#     if nodes is True and edges is True:
-#         return gdf_nodes, gdf_edges
-#     elif nodes is True and edges is False:
-#         return gdf_nodes
-#     else:
-#         return gdf_edges
+def flatten_line_coords(geoms, all_parts=False):
+    """
+    Flatten the first part (or every part, if all_parts) of each (Multi)LineString geometry into a
+    single array of x, y, z coordinates, so the geometries can be worked on with array arithmetic
+    rather than per row
+
+    Returns the coordinates (n, 3), the offsets into the coordinates for each part (part i spans
+    coords[offsets[i]:offsets[i + 1]]) and the ordinal position of the geometry each part came from.
+    Geometries that are not lines are skipped, and missing z values are returned as NaN
+    """
+    parts = []
+    geom_idx = []
+
+    for i, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        elif geom.geom_type == 'MultiLineString':
+            geom_parts = list(geom.geoms) if all_parts else [geom.geoms[0]]
+        elif geom.geom_type == 'LineString':
+            geom_parts = [geom]
+        else:
+            continue
+
+        for part in geom_parts:
+            part_coords = np.asarray(part.coords, dtype='float64')
+            if part_coords.shape[1] == 2:
+                part_coords = np.column_stack([part_coords, np.full(len(part_coords), np.nan)])
+
+            parts.append(part_coords)
+            geom_idx.append(i)
+
+    lengths = [len(part) for part in parts]
+    offsets = np.zeros(len(parts) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(lengths)
+
+    if len(parts) > 0:
+        coords = np.concatenate(parts)
+    else:
+        coords = np.empty((0, 3), dtype='float64')
+
+    return coords, offsets, np.asarray(geom_idx, dtype='int64')
+
+def stretch_end_coords(geoms):
+    """
+    Uses network geometry to return the first and last vertex (x, y, z) of every road stretch as
+    two (n, 3) arrays. Geometries that are not lines are given (0, 0, 0), as in stretch_bearing
+    """
+    coords, offsets, geom_idx = flatten_line_coords(geoms)
+
+    first = np.zeros((len(geoms), 3), dtype='float64')
+    last = np.zeros((len(geoms), 3), dtype='float64')
+
+    first[geom_idx] = coords[offsets[:-1]]
+    last[geom_idx] = coords[offsets[1:] - 1]
+
+    return first, last
+
+def two_product_error(a, b, product):
+    """
+    The rounding error of the floating point product of a and b (Dekker's two-product), so that
+    product + error is exactly a * b
+    """
+    def split(x):
+        c = 134217729.0 * x
+        high = c - (c - x)
+        return high, x - high
+
+    a_high, a_low = split(a)
+    b_high, b_low = split(b)
+
+    return ((a_high * b_high - product) + a_high * b_low + a_low * b_high) + a_low * b_low
+
+def python_round(values, decimals=0):
+    """
+    Round an array as the Python round function does on floats: to the nearest multiple of
+    10**-decimals of the exact value, with ties to even.
+
+    np.round multiplies by 10**decimals before rounding, and the rounding of that product can turn a
+    value just below a tie into a tie, which is then rounded up (0.15 is stored as 0.1499..., so
+    round(0.15, 1) is 0.1 but np.round(0.15, 1) is 0.2). Here ties in the product are broken on
+    the sign of its rounding error, so only exact ties are rounded to even
+    """
+    values = np.asarray(values, dtype='float64')
+    scale = 10.0 ** decimals
+    product = values * scale
+    rounded = np.round(product)
+
+    with np.errstate(invalid='ignore'):
+        error = two_product_error(values, scale, product)
+        tie = np.abs(product - rounded) == 0.5
+
+    rounded = np.where(tie & (error > 0), np.floor(product) + 1, rounded)
+    rounded = np.where(tie & (error < 0), np.floor(product), rounded)
+
+    return rounded / scale
+
+stretch_metrics = ['gradient', 'sinuosity', 'bearing', 'relative_location', 'key_coords']
+
+def compute_stretch_metrics(shape, metrics=None, shape_length='length', cent_y=181223, cent_x=529028):
+    """
+    Calculate the stretch metrics for every road stretch in one pass over the network geometry.
+
+    This gives the same values as stretch_gradient, stretch_sinuosity, stretch_bearing,
+    stretch_location and stretch_key_coords (including their rounding), but pulls the first and
+    last vertex of each stretch into arrays once and calculates each metric as array arithmetic.
+
+    The shape can be a GeoDataFrame or a RoadNetworkIndex, whose vertices are read from its
+    geometry store. Returns a DataFrame on the index of shape with a column for each metric. The
+    key_coords metric gives the start_x, end_x, start_y and end_y columns.
+    """
+    if metrics is None:
+        metrics = stretch_metrics
+
+    unknown = set(metrics).difference(stretch_metrics)
+    assert len(unknown) == 0, f'Unknown stretch metrics: {sorted(unknown)}'
+
+    with prf.span('stretch_end_coords', rows_in=len(shape)):
+        if isinstance(shape, RoadNetworkIndex):
+            first, last = shape.store.end_coords()
+        else:
+            first, last = stretch_end_coords(shape.geometry.values)
+
+    shape = line_attributes(shape)
+    x1, y1, z1 = first.T
+    x2, y2, z2 = last.T
+
+    if shape_length in shape.columns:
+        length = shape[shape_length].to_numpy(dtype='float64')
+    else:
+        length = np.full(len(shape), np.nan)
+
+    result = pd.DataFrame(index=shape.index)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'gradient' in metrics:
+            result['gradient'] = python_round(100 * (z1 - z2) / length, 1)
+
+        if 'sinuosity' in metrics:
+            crow_flies = sqrt((x1 - x2)**2 + (y1 - y2)**2)
+            # stretch_sinuosity rounds a numpy float (crow_flies comes from numpy sqrt), which rounds as np.round
+            result['sinuosity'] = np.round(length / crow_flies, 2)
+
+        if 'bearing' in metrics:
+            x_delta = np.radians(x2 - x1)
+            x = np.cos(np.radians(y2)) * np.sin(x_delta)
+            y = np.cos(np.radians(y1)) * np.sin(np.radians(y2)) - np.sin(np.radians(y1)) * np.cos(np.radians(y2)) * np.cos(x_delta)
+            bearing = arctan2(x, y)
+            result['bearing'] = np.trunc((np.degrees(bearing) + 360) % 360).astype('int64')
+
+        if 'relative_location' in metrics:
+            ave_x = (x1 + x2) / 2
+            ave_y = (y1 + y2) / 2
+            result['relative_location'] = np.trunc(sqrt((ave_x - cent_x)**2 + (ave_y - cent_y)**2)).astype('int64')
+
+        if 'key_coords' in metrics:
+            result['start_x'] = python_round(x1, 0)
+            result['end_x'] = python_round(x2, 0)
+            result['start_y'] = python_round(y1, 0)
+            result['end_y'] = python_round(y2, 0)
+
+    return result
+
+def group_reduce(ufunc, values, groups, size, empty=np.nan):
+    """
+    Reduce values by group with a ufunc (e.g. np.fmax or np.add), where the values of each group
+    are contiguous and groups are in ascending order. Groups without values are given empty
+    """
+    result = np.full(size, empty, dtype='float64')
+
+    if len(values) > 0:
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        result[groups[starts]] = ufunc.reduceat(values, starts)
+
+    return result
+
+def compute_profile_metrics(shape):
+    """
+    Calculate the gradient and curvature profile of every road stretch from all of its vertices,
+    rather than only the first and last vertex as in stretch_gradient and stretch_sinuosity.
+
+    The vertices of every part of every stretch are flattened into one array (see flatten_line_coords)
+    and the metrics are calculated segment by segment, then reduced per stretch:
+      max_gradient   - steepest absolute gradient of any segment (%)
+      mean_gradient  - absolute rise and fall over the horizontal length (%)
+      turning_angle  - sum of the absolute turns at each vertex (degrees)
+      max_curvature  - sharpest turn at a vertex over the mean length of its two segments (1 / metres)
+
+    Gradients are NaN for stretches without z values, and every metric is NaN for geometries that
+    are not lines. The shape can be a GeoDataFrame or a RoadNetworkIndex (see GeometryStore).
+    Returns a DataFrame on the index of shape
+    """
+    store = line_store(shape)
+    coords, offsets, geom_idx = np.asarray(store.coords), store.offsets, store.geom_idx
+    shape = line_attributes(shape)
+    size = len(shape)
+
+    # segments between consecutive vertices of the same part, leaving out repeated vertices
+    part = np.repeat(np.arange(len(geom_idx)), np.diff(offsets))
+    delta = np.diff(coords, axis=0)
+    seg_part = part[:-1]
+    run = np.hypot(delta[:, 0], delta[:, 1])
+
+    keep = (part[1:] == seg_part) & (run > 0)
+    delta, seg_part, run = delta[keep], seg_part[keep], run[keep]
+    seg_geom = geom_idx[seg_part]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rise = np.abs(delta[:, 2])
+        max_gradient = group_reduce(np.fmax, 100 * rise / run, seg_geom, size)
+        mean_gradient = 100 * group_reduce(np.add, rise, seg_geom, size) / group_reduce(np.add, run, seg_geom, size)
+
+        # turns between consecutive segments of the same part
+        turn = seg_part[1:] == seg_part[:-1]
+        before, after = delta[:-1][turn], delta[1:][turn]
+        cross = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0]
+        dot = before[:, 0] * after[:, 0] + before[:, 1] * after[:, 1]
+        angle = np.abs(arctan2(cross, dot))
+        curvature = angle / ((run[:-1][turn] + run[1:][turn]) / 2)
+        turn_geom = seg_geom[:-1][turn]
+
+    # stretches with segments but no turns are straight
+    lines = np.zeros(size, dtype='bool')
+    lines[seg_geom] = True
+
+    turning_angle = np.where(lines, 0.0, np.nan)
+    turning_angle[lines] = np.degrees(group_reduce(np.add, angle, turn_geom, size, empty=0.0))[lines]
+
+    max_curvature = np.where(lines, 0.0, np.nan)
+    max_curvature[lines] = group_reduce(np.fmax, curvature, turn_geom, size, empty=0.0)[lines]
+
+    return pd.DataFrame({
+        'max_gradient': max_gradient,
+        'mean_gradient': mean_gradient,
+        'turning_angle': turning_angle,
+        'max_curvature': max_curvature
+    }, index=shape.index)
 
 # def match_point_to_line(line_shape, point_shape, buffer=None):
 #     """
@@ -170,110 +387,1267 @@ def stretch_location(shape, cent_y = 181223, cent_x = 529028):
 
 #     return point_shape_tmp
 
-def match_point_to_line(line_shape, line_columns, point_shape, buffer=15, on_first=True):
+@lru_cache(maxsize=None)
+def cached_transformer(source_wkt, target_wkt):
+    return Transformer.from_crs(CRS.from_wkt(source_wkt), CRS.from_wkt(target_wkt), always_xy=True)
+
+def crs_transformer(source, target):
     """
-    Match a point geometry to the nearest line geometry within a radius (buffer)
-    Expects both geometries to share the same CRS
+    Return the transformer between two CRS (anything pyproj accepts, e.g. 'epsg:27700'). Transformers
+    are built once for each pair and reused
     """
-    assert line_shape.crs == point_shape.crs, 'The shape CRS do not match'
-    line_shape.sindex
+    return cached_transformer(CRS.from_user_input(source).to_wkt(), CRS.from_user_input(target).to_wkt())
+
+def geometry_coords(geom):
+    """
+    List the coordinate arrays (points, lines and rings) that make up a geometry
+    """
+    if geom.geom_type in ('Point', 'LineString', 'LinearRing'):
+        return [np.asarray(geom.coords, dtype='float64')]
+    elif geom.geom_type == 'Polygon':
+        return [np.asarray(geom.exterior.coords, dtype='float64')] + [np.asarray(ring.coords, dtype='float64') for ring in geom.interiors]
 
-    bbox = point_shape.bounds + [-buffer, -buffer, buffer, buffer]
-    hits = bbox.apply(lambda row: list(line_shape.sindex.intersection(row)), axis=1)
+    return [coords for part in geom.geoms for coords in geometry_coords(part)]
 
-    tmp = pd.DataFrame({
-        # index of points table
-        "pt_idx": np.repeat(hits.index, hits.apply(len)),
-        # ordinal position of line - access via iloc later
-        "line_i": np.concatenate(hits.values)
+def rebuild_geometry(geom, coords):
+    """
+    Build a geometry of the same type and shape as geom from an iterator of coordinate arrays, in
+    the order given by geometry_coords
+    """
+    if geom.geom_type == 'Point':
+        return Point(next(coords)[0])
+    elif geom.geom_type == 'LineString':
+        return LineString(next(coords))
+    elif geom.geom_type == 'Polygon':
+        exterior = next(coords)
+        return Polygon(exterior, [next(coords) for ring in geom.interiors])
+
+    parts = [rebuild_geometry(part, coords) for part in geom.geoms]
+    multi_types = {'MultiPoint': MultiPoint, 'MultiLineString': MultiLineString, 'MultiPolygon': MultiPolygon}
+
+    return multi_types.get(geom.geom_type, GeometryCollection)(parts)
+
+def transform_coords(coords, transformer):
+    """
+    Transform an (n, 2) or (n, 3) array of coordinates in bulk. Rows with a NaN z (2D coordinates
+    mixed with 3D ones) are transformed in 2D, the rest with their z
+    """
+    result = np.array(coords, dtype='float64')
+    flat = np.isnan(result[:, 2]) if result.shape[1] == 3 else np.ones(len(result), dtype='bool')
+
+    if flat.any():
+        result[flat, 0], result[flat, 1] = transformer.transform(result[flat, 0], result[flat, 1])
+    if not flat.all():
+        result[~flat, 0], result[~flat, 1], result[~flat, 2] = transformer.transform(result[~flat, 0], result[~flat, 1], result[~flat, 2])
+
+    return result
+
+def transform_geometries(geoms, transformer):
+    """
+    Transform an array of geometries with one batch of transformer calls for all of their
+    coordinates (including z), then rebuild each geometry from the transformed coordinates
+    """
+    result = geoms.copy()
+    present = [i for i, geom in enumerate(geoms) if geom is not None and not geom.is_empty]
+
+    # point layers need no splitting, so skip straight to building the points
+    if all(geoms[i].geom_type == 'Point' for i in present) and len({geoms[i].has_z for i in present}) == 1:
+        if len(present) > 0:
+            points = transform_coords(np.array([geoms[i].coords[0] for i in present]), transformer)
+            for i, point in zip(present, points.tolist()):
+                result[i] = Point(point)
+
+        return result
+
+    arrays = [coords for i in present for coords in geometry_coords(geoms[i])]
+
+    if len(arrays) == 0:
+        return result
+
+    # stack every coordinate as x, y, z, with NaN z for 2D coordinates
+    lengths = np.array([len(coords) for coords in arrays])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    stacked = np.full((offsets[-1], 3), np.nan)
+    for coords, start in zip(arrays, offsets[:-1]):
+        stacked[start:start + len(coords), :coords.shape[1]] = coords
+
+    stacked = transform_coords(stacked, transformer)
+
+    # split back into arrays with the dimensions of the originals
+    transformed = iter([stacked[start:start + len(coords), :coords.shape[1]] for coords, start in zip(arrays, offsets[:-1])])
+    for i in present:
+        result[i] = rebuild_geometry(geoms[i], transformed)
+
+    return result
+
+def reproject(gdf, crs):
+    """
+    Reproject a GeoDataFrame (or GeoSeries) to crs, transforming all of its coordinates in one batch
+    with a cached transformer. Layers already in crs are returned as they are
+    """
+    target = CRS.from_user_input(crs)
+    if gdf.crs is not None and CRS.from_user_input(gdf.crs) == target:
+        return gdf
+
+    assert gdf.crs is not None, 'The layer has no CRS to reproject from'
+    transformer = crs_transformer(gdf.crs, target)
+
+    with prf.span('reproject', rows_in=len(gdf), crs=target.to_string()):
+        if gpd.options.use_pygeos:
+            import pygeos
+            data = gdf.geometry.values.data
+            has_z = bool(pygeos.has_z(data).any())
+            coords = transform_coords(pygeos.get_coordinates(data, include_z=has_z), transformer)
+            geoms = gpd.array.GeometryArray(pygeos.set_coordinates(data.copy(), coords), crs=target)
+        else:
+            geoms = gpd.array.GeometryArray(transform_geometries(gdf.geometry.values.data, transformer), crs=target)
+
+    if isinstance(gdf, gpd.GeoSeries):
+        return gpd.GeoSeries(geoms, index=gdf.index, name=gdf.name, crs=target)
+
+    result = gdf.copy()
+    result[gdf.geometry.name] = gpd.GeoSeries(geoms, index=gdf.index, crs=target)
+    result.crs = target
+
+    return result
+
+def file_hash(path, extra=None, chunk_size=2**20):
+    """
+    Calculate a sha256 hash of the content of a file (plus any extra text, e.g. parameters), reading
+    the file in chunks
+    """
+    sha = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+
+    if extra is not None:
+        sha.update(str(extra).encode('utf-8'))
+
+    return sha.hexdigest()
+
+def line_hashes(line_shape, key='TOID'):
+    """
+    Hash the geometry (as WKB) and the attributes of each line, so two versions of a network can
+    be compared without keeping the old network (see diff_lines). For a RoadNetworkIndex the WKB is
+    written from its geometry store
+    """
+    if isinstance(line_shape, RoadNetworkIndex):
+        wkb = pd.Series(line_shape.store.to_wkb())
+        attributes = line_shape.attributes
+    else:
+        wkb = pd.Series([geom.wkb for geom in line_shape.geometry.values])
+        attributes = pd.DataFrame(line_shape.drop(columns=line_shape.geometry.name))
+
+    return pd.DataFrame({
+        key: attributes[key].values,
+        'geometry_hash': pd.util.hash_pandas_object(wkb, index=False).values,
+        'attribute_hash': pd.util.hash_pandas_object(attributes, index=False).values
     })
 
-    # Join back to lines on line_i to give ordinal position of each line
-    tmp = tmp.join(line_shape.reset_index(drop=True), on='line_i')
+def diff_lines(old_hashes, new_hashes, key='TOID'):
+    """
+    Compare the line hashes of two versions of a network by key. Returns a dictionary with the keys
+    of the lines that were added, removed, had their geometry changed (geometry) or only had
+    their attributes changed (attributes)
+    """
+    old = old_hashes.set_index(key)
+    new = new_hashes.set_index(key)
+    assert old.index.is_unique and new.index.is_unique, f'The {key} values are not unique'
+
+    common = new.index.intersection(old.index)
+    old = old.loc[common]
+    new = new.loc[common]
+
+    same_geometry = old.geometry_hash.values == new.geometry_hash.values
+    same_attributes = old.attribute_hash.values == new.attribute_hash.values
+
+    return {
+        'added': new_hashes.loc[~new_hashes[key].isin(old_hashes[key]), key].values,
+        'removed': old_hashes.loc[~old_hashes[key].isin(new_hashes[key]), key].values,
+        'geometry': common[~same_geometry].values,
+        'attributes': common[same_geometry & ~same_attributes].values
+    }
+
+class BoundsGrid:
+    """
+    A uniform grid over the bounds (minx, miny, maxx, maxy) of a set of geometries, to find every
+    geometry whose bounds intersect each of many boxes with array operations, rather than one
+    R-tree query per box.
+
+    Each geometry is listed under every cell its bounds cover, sorted by cell. A box is paired with
+    the geometries listed under the cells it covers, and each intersecting pair is only kept in the
+    cell holding the lower left corner of the intersection of the two boxes, so no pair is found
+    twice. Geometries with missing bounds are left out
+    """
+    def __init__(self, bounds, cell_size=None):
+        self.bounds = np.asarray(bounds, dtype='float64').reshape(-1, 4)
+        valid = np.flatnonzero(np.isfinite(self.bounds).all(axis=1))
+        valid_bounds = self.bounds[valid]
+
+        if len(valid) > 0:
+            self.origin = valid_bounds[:, :2].min(axis=0)
+            extent = valid_bounds[:, 2:].max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.zeros(2)
+
+        # cells about the size of a typical geometry, and no more cells than geometries
+        if cell_size is None:
+            size = np.maximum(valid_bounds[:, 2] - valid_bounds[:, 0], valid_bounds[:, 3] - valid_bounds[:, 1])
+            cell_size = max(np.median(size) if len(size) > 0 else 0, sqrt(extent[0] * extent[1] / max(len(valid), 1)), 1e-9)
+
+        self.cell_size = float(cell_size)
+        self.shape = np.floor(extent / self.cell_size).astype('int64') + 1
+
+        ix0, iy0, ix1, iy1 = self.cell_ranges(valid_bounds)
+        self.items, self.keys = self.expand(valid, ix0, iy0, ix1, iy1)
+
+        order = np.argsort(self.keys, kind='stable')
+        self.items = self.items[order]
+        self.keys = self.keys[order]
+
+    def cell_index(self, values, axis):
+        """
+        Cell of each coordinate along an axis (0 for x, 1 for y), clipped to just outside the grid
+        """
+        with np.errstate(invalid='ignore'):
+            cells = np.floor((values - self.origin[axis]) / self.cell_size)
+
+        return np.clip(np.nan_to_num(cells, nan=-1), -1, self.shape[axis]).astype('int64')
+
+    def cell_ranges(self, boxes):
+        """
+        The first and last cell covered by each box along x and y, clipped to the grid
+        """
+        ix0 = np.maximum(self.cell_index(boxes[:, 0], 0), 0)
+        iy0 = np.maximum(self.cell_index(boxes[:, 1], 1), 0)
+        ix1 = np.minimum(self.cell_index(boxes[:, 2], 0), self.shape[0] - 1)
+        iy1 = np.minimum(self.cell_index(boxes[:, 3], 1), self.shape[1] - 1)
+
+        return ix0, iy0, ix1, iy1
+
+    def expand(self, items, ix0, iy0, ix1, iy1):
+        """
+        One row for every cell covered by each item, as the item and the cell key
+        """
+        width = np.maximum(ix1 - ix0 + 1, 0)
+        counts = width * np.maximum(iy1 - iy0 + 1, 0)
+
+        item = np.repeat(np.arange(len(items)), counts)
+        within = np.arange(len(item)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = (ix0[item] + within % width[item]) * self.shape[1] + iy0[item] + within // width[item]
+
+        return np.asarray(items)[item], keys
+
+    def query(self, boxes, chunk_size=100000):
+        """
+        Find every box and geometry pair whose bounds intersect, for an array of boxes (minx, miny,
+        maxx, maxy), a chunk of boxes at a time. Returns the ordinal position of the box and the
+        geometry of each pair, sorted by box then geometry
+        """
+        boxes = np.asarray(boxes, dtype='float64').reshape(-1, 4)
+        box_i = []
+        item_i = []
+
+        for start in range(0, len(boxes), chunk_size):
+            chunk = boxes[start:start + chunk_size]
+            valid = np.flatnonzero(np.isfinite(chunk).all(axis=1))
+            box, key = self.expand(valid, *self.cell_ranges(chunk[valid]))
+
+            # every geometry listed under the cells of each box
+            first = np.searchsorted(self.keys, key, side='left')
+            counts = np.searchsorted(self.keys, key, side='right') - first
+            pair_box = np.repeat(box, counts)
+            pair_key = np.repeat(key, counts)
+            listed = np.repeat(first, counts) + np.arange(len(pair_box)) - np.repeat(np.cumsum(counts) - counts, counts)
+            pair_item = self.items[listed]
+
+            a = chunk[pair_box]
+            b = self.bounds[pair_item]
+            hit = (a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0]) & (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1])
+
+            # keep each pair only in the cell of the lower left corner of the intersection
+            corner_x = self.cell_index(np.maximum(a[:, 0], b[:, 0]), 0)
+            corner_y = self.cell_index(np.maximum(a[:, 1], b[:, 1]), 1)
+            hit &= corner_x * self.shape[1] + corner_y == pair_key
+
+            box_i.append(pair_box[hit] + start)
+            item_i.append(pair_item[hit])
+
+        if len(box_i) == 0:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='int64')
+
+        box_i = np.concatenate(box_i)
+        item_i = np.concatenate(item_i)
+        order = np.lexsort((item_i, box_i))
+
+        return box_i[order], item_i[order]
+
+class GeometryStore:
+    """
+    A compact store of line geometries as flat arrays, so a network can be worked on (and memory-mapped
+    from disk) without holding a shapely object for every line.
+
+    Holds the x, y, z coordinates of every vertex of every part (missing z values are NaN), the offsets
+    into the coordinates for each part and the ordinal position of the geometry each part came from
+    (see flatten_line_coords), plus the type of each geometry (see geom_types). Geometries that are
+    not lines have no coordinates and are kept as WKB. Shapely objects are only created on demand,
+    e.g. for export (see to_geoms)
+    """
+    geom_types = [None, 'LineString', 'MultiLineString']
+    arrays = ['coords', 'offsets', 'geom_idx', 'geom_type']
+
+    def __init__(self, coords, offsets, geom_idx, geom_type, crs=None, others=None):
+        self.coords = coords
+        self.offsets = offsets
+        self.geom_idx = geom_idx
+        self.geom_type = geom_type
+        self.crs = crs
+        self.others = others or {}
+        self._layout = None
+
+    def __len__(self):
+        return len(self.geom_type)
+
+    @classmethod
+    def from_geoms(cls, geoms, crs=None):
+        """
+        Build the store from an array of geometries
+        """
+        coords, offsets, geom_idx = flatten_line_coords(geoms, all_parts=True)
+        geom_type = np.zeros(len(geoms), dtype='uint8')
+        others = {}
+
+        for i, geom in enumerate(geoms):
+            if geom is None:
+                continue
+            elif geom.geom_type in cls.geom_types and not geom.is_empty:
+                geom_type[i] = cls.geom_types.index(geom.geom_type)
+            else:
+                others[i] = geom.wkb
+
+        return cls(coords, offsets, geom_idx, geom_type, crs=crs, others=others)
+
+    def save(self, path):
+        """
+        Save the store to a folder, with an .npy file for each array
+        """
+        os.makedirs(path, exist_ok=True)
+
+        for name in self.arrays:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+        crs = None if self.crs is None else CRS.from_user_input(self.crs).to_wkt()
+        pd.to_pickle({'crs': crs, 'others': self.others}, os.path.join(path, 'store.pkl'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a store saved with save, memory-mapping the arrays
+        """
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in cls.arrays}
+        meta = pd.read_pickle(os.path.join(path, 'store.pkl'))
+        crs = None if meta['crs'] is None else CRS.from_wkt(meta['crs'])
+
+        return cls(crs=crs, others=meta['others'], **arrays)
+
+    def first_parts(self):
+        """
+        Ordinal position of the first part of every geometry with any parts
+        """
+        if len(self.geom_idx) == 0:
+            return np.empty(0, dtype='int64')
+
+        return np.flatnonzero(np.r_[True, self.geom_idx[1:] != self.geom_idx[:-1]])
+
+    def layout(self):
+        """
+        The first and last (exclusive) vertex of each geometry, whether a segment starts at each
+        vertex (it is not the last vertex of its part) and the 2D distance of each vertex along its
+        geometry, counting the parts one after another as shapely project does. Calculated once
+        """
+        if self._layout is None:
+            parts = self.first_parts()
+            last_parts = np.r_[parts[1:] - 1, len(self.geom_idx) - 1] if len(parts) > 0 else parts
+
+            start = np.zeros(len(self), dtype='int64')
+            end = np.zeros(len(self), dtype='int64')
+            start[self.geom_idx[parts]] = self.offsets[parts]
+            end[self.geom_idx[parts]] = self.offsets[last_parts + 1]
+
+            segment = np.ones(len(self.coords), dtype='bool')
+            segment[self.offsets[1:][np.diff(self.offsets) > 0] - 1] = False
+
+            delta = np.diff(self.coords[:, :2], axis=0)
+            run = np.where(segment[:-1], sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1]), 0)
+            along = np.zeros(len(self.coords), dtype='float64')
+            along[1:] = np.cumsum(run)
+
+            # distance from the first vertex of each geometry
+            vertex_geom = np.repeat(self.geom_idx, np.diff(self.offsets))
+            along -= along[start[vertex_geom]]
+
+            self._layout = start, end, segment, along
+
+        return self._layout
+
+    def bounds(self):
+        """
+        The bounds (minx, miny, maxx, maxy) of each geometry, NaN for missing geometries
+        """
+        vertex_geom = np.repeat(self.geom_idx, np.diff(self.offsets))
+        bounds = np.column_stack([
+            group_reduce(np.fmin, self.coords[:, 0], vertex_geom, len(self)),
+            group_reduce(np.fmin, self.coords[:, 1], vertex_geom, len(self)),
+            group_reduce(np.fmax, self.coords[:, 0], vertex_geom, len(self)),
+            group_reduce(np.fmax, self.coords[:, 1], vertex_geom, len(self))
+        ])
+
+        # empty geometries have no bounds, so are left as NaN
+        for i, wkb in self.others.items():
+            geom = shapely_wkb.loads(wkb)
+            if not geom.is_empty:
+                bounds[i] = geom.bounds
+
+        return bounds
+
+    def lengths(self):
+        """
+        The 2D length of each geometry (over all of its parts), NaN for missing geometries
+        """
+        start, end, segment, along = self.layout()
+        length = np.where(self.geom_type == 0, np.nan, 0.0)
+
+        lines = end > start
+        length[lines] = along[end[lines] - 1]
+
+        for i, wkb in self.others.items():
+            length[i] = shapely_wkb.loads(wkb).length
+
+        return length
+
+    def end_coords(self):
+        """
+        The first and last vertex (x, y, z) of the first part of each geometry as two (n, 3) arrays,
+        as in stretch_end_coords. Geometries that are not lines are given (0, 0, 0)
+        """
+        parts = self.first_parts()
+        first = np.zeros((len(self), 3), dtype='float64')
+        last = np.zeros((len(self), 3), dtype='float64')
+
+        first[self.geom_idx[parts]] = self.coords[self.offsets[parts]]
+        last[self.geom_idx[parts]] = self.coords[self.offsets[parts + 1] - 1]
+
+        return first, last
+
+    def locate(self, point_xy, line_i, max_segments=2**21):
+        """
+        Find the closest point on each line (by ordinal position) to each point (x, y) on the
+        coordinate arrays, segment by segment as GEOS does, in batches of up to max_segments segments.
+
+        Returns the distance (as shapely distance), the position along the line (as shapely project)
+        and the x, y, z of the closest point, which is shapely interpolate at that position except
+        at the gap between two parts, where interpolate gives the end of the earlier part, and at a
+        vertex repeated with a different z, where interpolate gives the z of the last repeat rather
+        than the first. Lines that are not LineStrings or MultiLineStrings are given an infinite distance
+        """
+        start, end, segment, along = self.layout()
+        point_xy = np.asarray(point_xy, dtype='float64')
+        line_i = np.asarray(line_i, dtype='int64')
+
+        dist = np.full(len(line_i), np.inf)
+        position = np.full(len(line_i), np.nan)
+        located = np.full((len(line_i), 3), np.nan)
+
+        # every segment of a line, including the gaps between its parts (which are left out below)
+        n_segments = np.maximum(end[line_i] - start[line_i] - 1, 0)
+        total = np.cumsum(n_segments)
+        i = 0
+
+        while i < len(line_i):
+            done = total[i - 1] if i > 0 else 0
+            j = max(int(np.searchsorted(total, done + max_segments, side='right')), i + 1)
+
+            counts = n_segments[i:j]
+            first = np.cumsum(counts) - counts
+            pair = np.repeat(np.arange(j - i), counts)
+            v = start[line_i[i:j]][pair] + np.arange(len(pair)) - first[pair]
+
+            a = self.coords[v]
+            b = self.coords[v + 1]
+            p = point_xy[i:j][pair]
+
+            # distance to each segment (Distance::pointToSegment)
+            dx, dy = b[:, 0] - a[:, 0], b[:, 1] - a[:, 1]
+            len2 = dx * dx + dy * dy
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = ((p[:, 0] - a[:, 0]) * dx + (p[:, 1] - a[:, 1]) * dy) / len2
+                s = ((a[:, 1] - p[:, 1]) * dx - (a[:, 0] - p[:, 0]) * dy) / len2
+
+            to_a = sqrt((p[:, 0] - a[:, 0])**2 + (p[:, 1] - a[:, 1])**2)
+            to_b = sqrt((p[:, 0] - b[:, 0])**2 + (p[:, 1] - b[:, 1])**2)
+            d = np.where((len2 == 0) | (r <= 0), to_a, np.where(r >= 1, to_b, np.abs(s) * sqrt(len2)))
+            d[~segment[v]] = np.inf
+
+            # the first closest segment of each pair
+            has = counts > 0
+            closest = np.full(j - i, np.inf)
+            closest[has] = np.minimum.reduceat(d, first[has])
+
+            seg = np.where(d == closest[pair], np.arange(len(pair)), len(pair))
+            best = np.full(j - i, len(pair))
+            best[has] = np.minimum.reduceat(seg, first[has])
+
+            found = np.flatnonzero(best < len(pair))
+            k = best[found]
+            t = np.where(len2[k] > 0, np.clip(r[k], 0, 1), 0)
+
+            dist[i + found] = closest[found]
+            position[i + found] = along[v[k]] + t * sqrt(len2[k])
+            located[i + found] = a[k] + t[:, None] * (b[k] - a[k])
+
+            i = j
+
+        return dist, position, located
+
+    def part_coords(self, part, has_z=True):
+        coords = np.asarray(self.coords[self.offsets[part]:self.offsets[part + 1]])
+
+        return coords if has_z else coords[:, :2]
+
+    def part_wkb(self, part, has_z, type_code):
+        coords = self.part_coords(part, has_z)
+
+        return struct.pack('<BII', 1, type_code, len(coords)) + coords.astype('<f8').tobytes()
+
+    def geom_parts(self, rows):
+        """
+        The parts of each geometry in rows and whether it has z values
+        """
+        start, end, segment, along = self.layout()
+        part_start = np.searchsorted(self.geom_idx, rows, side='left')
+        part_end = np.searchsorted(self.geom_idx, rows, side='right')
+
+        for i, p1, p2 in zip(rows, part_start, part_end):
+            has_z = not np.isnan(self.coords[start[i]:end[i], 2]).all()
+            yield i, range(p1, p2), has_z
+
+    def to_geoms(self, rows=None):
+        """
+        Create the shapely geometries of the given rows (ordinal positions, by default every row)
+        as a GeometryArray
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype='int64')
+        geoms = np.empty(len(rows), dtype='object')
+
+        for j, (i, parts, has_z) in enumerate(self.geom_parts(rows)):
+            if self.geom_type[i] == 1:
+                geoms[j] = LineString(self.part_coords(parts[0], has_z))
+            elif self.geom_type[i] == 2:
+                geoms[j] = MultiLineString([LineString(self.part_coords(part, has_z)) for part in parts])
+            elif i in self.others:
+                geoms[j] = shapely_wkb.loads(self.others[i])
+
+        return gpd.array.GeometryArray(geoms, crs=self.crs)
+
+    def to_wkb(self, rows=None):
+        """
+        The WKB of the given rows (ordinal positions, by default every row), written straight from
+        the coordinate arrays in the same (little endian, extended) form as shapely geom.wkb
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype='int64')
+        wkb = []
+
+        for i, parts, has_z in self.geom_parts(rows):
+            # type codes, with the z flag of extended WKB
+            z_flag = 0x80000000 if has_z else 0
+
+            if self.geom_type[i] == 1:
+                wkb.append(self.part_wkb(parts[0], has_z, 2 | z_flag))
+            elif self.geom_type[i] == 2:
+                wkb.append(struct.pack('<BII', 1, 5 | z_flag, len(parts)) + b''.join(self.part_wkb(part, has_z, 2 | z_flag) for part in parts))
+            else:
+                wkb.append(self.others.get(i))
+
+        return wkb
+
+class RoadNetworkIndex:
+    """
+    A spatial index over a road network that is built once and reused for every match against it.
+    It can be used in place of the network GeoDataFrame in the matching functions.
+
+    Holds the attributes of the network (without geometry), the network geometry as a GeometryStore,
+    the bounds of each line and an R-tree over them. Candidate lines for many boxes at once are
+    found on a grid over the bounds (see BoundsGrid), built on the first query. The index can be saved next to the network file,
+    keyed by a hash of the file content, and reloaded on later runs with the geometry memory-mapped
+    from disk, so no shapely objects are created for the network unless they are asked for
+    (see geodataframe)
+    """
+    # saved indexes from an earlier layout are rebuilt
+    version = 2
+
+    def __init__(self, attributes, store, tree=None, bounds=None, geometry='geometry', geometry_loc=None):
+        self.attributes = attributes
+        self.store = store
+        self.geometry = geometry
+        self.geometry_loc = len(attributes.columns) if geometry_loc is None else geometry_loc
+
+        if bounds is None:
+            bounds = store.bounds()
+
+        if tree is None:
+            tree = rtree_index.Index(self.tree_stream(bounds))
+
+        self.tree = tree
+        self.bounds = bounds
+        self.grid = None
+
+    @classmethod
+    def from_network(cls, network):
+        """
+        Build the index for a network GeoDataFrame
+        """
+        geometry = network.geometry.name
+        store = GeometryStore.from_geoms(network.geometry.values, crs=network.crs)
+        attributes = pd.DataFrame(network.drop(columns=geometry))
+
+        return cls(attributes, store, geometry=geometry, geometry_loc=network.columns.get_loc(geometry))
+
+    def __len__(self):
+        return len(self.attributes)
+
+    @property
+    def crs(self):
+        return self.store.crs
+
+    @property
+    def network(self):
+        """
+        The network as a GeoDataFrame. The shapely geometries are created on every call, so keep
+        the result rather than calling this repeatedly
+        """
+        return self.geodataframe()
+
+    def geodataframe(self, frame=None, rows=None):
+        """
+        Attach the network geometry to a table of links, e.g. for export. The table defaults to the
+        network attributes (of the given rows), and rows gives the ordinal position in the network
+        of each row of the table
+        """
+        if frame is None:
+            frame = self.attributes if rows is None else self.attributes.iloc[rows]
+
+        frame = pd.DataFrame(frame).copy()
+        geoms = self.store.to_geoms(rows)
+        frame.insert(min(self.geometry_loc, len(frame.columns)), self.geometry, gpd.GeoSeries(geoms, index=frame.index))
+
+        return gpd.GeoDataFrame(frame, geometry=self.geometry, crs=self.crs)
+
+    @staticmethod
+    def tree_stream(bounds):
+        """
+        Stream the line bounds into the R-tree for bulk loading, skipping empty geometries
+        """
+        return ((i, tuple(row), None) for i, row in enumerate(bounds) if np.isfinite(row).all())
+
+    def query_bulk(self, bbox):
+        """
+        Query the index with an array of boxes (minx, miny, maxx, maxy) in one vectorised join on
+        the line bounds. Returns the ordinal position of the box and line for every pair where they
+        intersect, sorted by box then line. Boxes with missing bounds have no pairs
+        """
+        if self.grid is None:
+            self.grid = BoundsGrid(self.bounds)
+
+        return self.grid.query(bbox)
+
+    def save(self, path):
+        """
+        Save the index to a folder. The folder is written in full before it is put in place, so an
+        interrupted save never leaves a partial index behind
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent)
+
+        try:
+            tree = rtree_index.Index(os.path.join(tmp_path, 'tree'), self.tree_stream(self.bounds))
+            tree.close()
+
+            np.save(os.path.join(tmp_path, 'bounds.npy'), self.bounds)
+            self.store.save(os.path.join(tmp_path, 'store'))
+            self.attributes.to_pickle(os.path.join(tmp_path, 'attributes.pkl'))
+
+            with open(os.path.join(tmp_path, 'index.json'), 'w') as file:
+                json.dump({'version': self.version, 'geometry': self.geometry, 'geometry_loc': self.geometry_loc}, file)
+
+            os.replace(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save, memory-mapping the bounds and geometry arrays
+        """
+        with open(os.path.join(path, 'index.json')) as file:
+            meta = json.load(file)
+
+        tree = rtree_index.Index(os.path.join(path, 'tree'))
+        bounds = np.load(os.path.join(path, 'bounds.npy'), mmap_mode='r')
+        store = GeometryStore.load(os.path.join(path, 'store'))
+        attributes = pd.read_pickle(os.path.join(path, 'attributes.pkl'))
+
+        return cls(attributes, store, tree=tree, bounds=bounds, geometry=meta['geometry'], geometry_loc=meta['geometry_loc'])
+
+    @classmethod
+    def from_file(cls, network_file, crs=None, cache_dir=None):
+        """
+        Load the index for a network file (reprojected to crs, if given), building it and saving it
+        next to the file the first time. The saved index is keyed by a hash of the file content and
+        crs, so it is rebuilt whenever the network file changes
+        """
+        if cache_dir is None:
+            cache_dir = f'{network_file}.index'
+
+        path = os.path.join(cache_dir, file_hash(network_file, extra=f'{crs}-v{cls.version}'))
+
+        if os.path.exists(path):
+            with prf.span('load_index', path=path):
+                return cls.load(path)
+
+        with prf.span('read_file', path=network_file):
+            network = gpd.read_file(network_file)
+            prf.record(rows_out=len(network))
+
+        if crs is not None:
+            network = reproject(network, crs)
+
+        with prf.span('build_index', rows_in=len(network)):
+            network_index = cls.from_network(network)
+            del network
+            network_index.save(path)
+
+        return network_index
+
+def line_network(line_shape):
+    """
+    Return the network for a RoadNetworkIndex (creating its geometries), or the line shape itself
+    if it is not an index
+    """
+    if isinstance(line_shape, RoadNetworkIndex):
+        return line_shape.network
+
+    return line_shape
+
+def line_attributes(line_shape):
+    """
+    Return the attributes of a RoadNetworkIndex (without geometry), or the line shape itself if it
+    is not an index
+    """
+    if isinstance(line_shape, RoadNetworkIndex):
+        return line_shape.attributes
+
+    return line_shape
+
+def line_store(line_shape):
+    """
+    Return the geometry store of a RoadNetworkIndex, or a GeometryStore of the line shape geometry
+    """
+    if isinstance(line_shape, RoadNetworkIndex):
+        return line_shape.store
+
+    return GeometryStore.from_geoms(line_shape.geometry.values, crs=line_shape.crs)
+
+def point_xy(geoms):
+    """
+    The x, y coordinates of an array of points as an (n, 2) array, taken from their bounds as
+    that is much quicker than reading the coordinates of each point
+    """
+    return np.asarray(geoms.bounds, dtype='float64').reshape(-1, 4)[:, :2]
+
+def points_from_coords(coords):
+    """
+    Create points from an (n, 3) array of x, y, z coordinates, leaving out z where it is NaN
+    """
+    geoms = np.empty(len(coords), dtype='object')
+
+    for i, (x, y, z) in enumerate(coords.tolist()):
+        geoms[i] = Point(x, y) if math.isnan(z) else Point(x, y, z)
+
+    return gpd.array.GeometryArray(geoms)
 
-    # Join back to the original points to get their geometry
-    tmp = tmp.join(point_shape.geometry.rename('point'), on='pt_idx')
-    tmp = gpd.GeoDataFrame(tmp, geometry='geometry', crs=point_shape.crs)
+def point_line_candidates(line_shape, point_shape, buffer=15):
+    """
+    Find every point and line pair where the line is within a radius (buffer) of the point
 
-    # calculate distance between each point and associate lines
-    tmp['snap_dist'] = tmp.geometry.distance(gpd.GeoSeries(tmp.point))
+    The line spatial index is queried for all of the points in one call, and the snap distances are
+    calculated on the geometry arrays only (for a RoadNetworkIndex, on the coordinates in its
+    geometry store). Returns the ordinal position of the point and line in each pair along with
+    the distance between them
+    """
+    point_geoms = point_shape.geometry.values
+
+    with prf.span('sindex_query', rows_in=len(point_geoms)):
+        if isinstance(line_shape, RoadNetworkIndex):
+            bbox = point_geoms.bounds + [-buffer, -buffer, buffer, buffer]
+            pt_i, line_i = line_shape.query_bulk(bbox)
+        elif gpd.options.use_pygeos:
+            # square buffers share their bounds with the buffer box around each point
+            bbox = point_shape.geometry.buffer(buffer, cap_style=3)
+            pt_i, line_i = line_shape.sindex.query_bulk(bbox)
+        else:
+            # the rtree index can only be queried one box at a time, so join the bounds on a grid instead
+            bbox = point_shape.geometry.values.bounds + [-buffer, -buffer, buffer, buffer]
+            pt_i, line_i = BoundsGrid(line_shape.geometry.values.bounds).query(bbox)
+
+        pt_i = np.asarray(pt_i, dtype='int64')
+        line_i = np.asarray(line_i, dtype='int64')
+        prf.record(box_pairs=len(pt_i))
+
+    # calculate distance between each point and associated lines
+    with prf.span('distance', rows_in=len(pt_i)):
+        if isinstance(line_shape, RoadNetworkIndex):
+            snap_dist, _, _ = line_shape.store.locate(point_xy(point_geoms)[pt_i], line_i)
+        else:
+            snap_dist = np.asarray(line_shape.geometry.values[line_i].distance(point_geoms[pt_i]), dtype='float64')
 
     # discard lines greater than buffer
-    tmp = tmp.loc[tmp.snap_dist <= buffer]
+    within = snap_dist <= buffer
 
-    # sort on ascending snap distance (closest at top)
-    tmp = tmp.sort_values(by=['snap_dist'])
+    return pt_i[within], line_i[within], snap_dist[within]
+
+def closest_candidates(pt_i, line_i, snap_dist, on_first=True):
+    """
+    Sort point and line pairs on ascending snap distance for each point, and keep only the closest
+    line to each point (if on_first). Ties are broken on the ordinal position of the line
+    """
+    order = np.lexsort((line_i, snap_dist, pt_i))
+    pt_i, line_i, snap_dist = pt_i[order], line_i[order], snap_dist[order]
 
-    #  group by index and take the closest point (if true)
     if on_first:
-        closest = tmp.groupby('pt_idx').first()
+        first = np.ones(len(pt_i), dtype='bool')
+        first[1:] = pt_i[1:] != pt_i[:-1]
+        pt_i, line_i, snap_dist = pt_i[first], line_i[first], snap_dist[first]
+
+    return pt_i, line_i, snap_dist
+
+def tile_point_line_candidates(line_geoms, point_geoms, buffer=15):
+    """
+    Find the point and line pairs for one spatial tile. Used as the worker for
+    parallel_point_line_candidates, so it only takes plain GeoSeries
+    """
+    return point_line_candidates(line_geoms, point_geoms, buffer=buffer)
+
+def parallel_point_line_candidates(line_shape, point_shape, buffer=15, workers=2, tiles_per_worker=4):
+    """
+    Find every point and line pair where the line is within a radius (buffer) of the point, using a
+    process pool over spatial tiles.
+
+    Each point belongs to exactly one tile, and each tile takes every line within a halo of buffer
+    around it, so every point sees the same candidate lines as in point_line_candidates. Returns the
+    ordinal position of the point and line in each pair along with the distance between them
+    """
+    point_geoms = point_shape.geometry.values
+
+    pt_bounds = point_geoms.bounds
+    if isinstance(line_shape, RoadNetworkIndex):
+        line_bounds = line_shape.bounds
     else:
-        closest = tmp
-    
-    closest = gpd.GeoDataFrame(closest, geometry='geometry')
+        line_bounds = line_shape.geometry.values.bounds
+
+    # points without a location (missing or empty geometry) have no candidates, as in the serial path
+    located = np.flatnonzero(np.isfinite(pt_bounds).all(axis=1))
+    if len(located) == 0:
+        return np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0, dtype='float64')
+
+    # split the extent of the points into a grid of roughly square tiles
+    minx, miny = pt_bounds[located, :2].min(axis=0)
+    maxx, maxy = pt_bounds[located, 2:].max(axis=0)
+    width = max(maxx - minx, 1e-9)
+    height = max(maxy - miny, 1e-9)
+
+    n_tiles = workers * tiles_per_worker
+    nx = max(int(round(sqrt(n_tiles * width / height))), 1)
+    ny = max(int(np.ceil(n_tiles / nx)), 1)
+
+    tx = np.clip(((pt_bounds[located, 0] - minx) / width * nx).astype('int64'), 0, nx - 1)
+    ty = np.clip(((pt_bounds[located, 1] - miny) / height * ny).astype('int64'), 0, ny - 1)
+    tile = ty * nx + tx
+
+    tile_points = []
+    tile_lines = []
+
+    for t in np.unique(tile):
+        pts = located[tile == t]
+
+        # tile extent taken from its points, plus a halo of buffer
+        bx1, by1 = pt_bounds[pts, :2].min(axis=0) - buffer
+        bx2, by2 = pt_bounds[pts, 2:].max(axis=0) + buffer
+
+        lines = np.flatnonzero(
+            (line_bounds[:, 0] <= bx2) & (line_bounds[:, 2] >= bx1) &
+            (line_bounds[:, 1] <= by2) & (line_bounds[:, 3] >= by1)
+        )
+
+        if len(lines) > 0:
+            tile_points.append(pts)
+            tile_lines.append(lines)
+
+    prf.record(tiles=len(tile_points))
+
+    # only the lines of each tile are created as shapely objects for the workers
+    if isinstance(line_shape, RoadNetworkIndex):
+        tile_geoms = (line_shape.store.to_geoms(lines) for lines in tile_lines)
+    else:
+        tile_geoms = (line_shape.geometry.values[lines] for lines in tile_lines)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            tile_point_line_candidates,
+            [gpd.GeoSeries(geoms, crs=line_shape.crs) for geoms in tile_geoms],
+            [gpd.GeoSeries(point_geoms[pts], crs=point_shape.crs) for pts in tile_points],
+            repeat(buffer)
+        )
+
+        pt_i = []
+        line_i = []
+        snap_dist = []
+
+        # map the tile positions back to positions in the full tables
+        for pts, lines, (tile_pt_i, tile_line_i, tile_snap_dist) in zip(tile_points, tile_lines, results):
+            pt_i.append(pts[tile_pt_i])
+            line_i.append(lines[tile_line_i])
+            snap_dist.append(tile_snap_dist)
+
+    if len(pt_i) == 0:
+        return np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0, dtype='float64')
+
+    return np.concatenate(pt_i), np.concatenate(line_i), np.concatenate(snap_dist)
+
+def match_point_to_line(line_shape, line_columns, point_shape, buffer=15, on_first=True, workers=1):
+    """
+    Match a point geometry to the nearest line geometry within a radius (buffer)
+    Expects both geometries to share the same CRS. The line shape can be a GeoDataFrame or a RoadNetworkIndex
+
+    Line attributes are only joined for the matched lines. If on_first is False, every line within
+    the buffer is returned for each point, closest first. With workers greater than 1 the matching
+    is split into spatial tiles across a process pool, giving the same result as the serial path
+    """
+    assert line_shape.crs == point_shape.crs, 'The shape CRS do not match'
+
+    with prf.span('match_point_to_line', rows_in=len(point_shape), lines=len(line_shape), workers=workers):
+        if workers > 1 and len(point_shape) > 0:
+            pt_i, line_i, snap_dist = parallel_point_line_candidates(line_shape, point_shape, buffer=buffer, workers=workers)
+        else:
+            pt_i, line_i, snap_dist = point_line_candidates(line_shape, point_shape, buffer=buffer)
+
+        prf.record(candidate_pairs=len(pt_i))
+        pt_i, line_i, snap_dist = closest_candidates(pt_i, line_i, snap_dist, on_first=on_first)
+
+        matched = snap_points_to_lines(line_shape, line_columns, point_shape, pt_i, line_i, snap_dist)
+        prf.record(rows_out=len(matched))
+
+        return matched
+
+def nearest_k_candidates(pt_i, line_i, snap_dist, n_points, k=3):
+    """
+    Keep the k closest lines to each point from a set of point and line pairs, without sorting the
+    pairs by distance. The pairs are grouped by point (they already are from the spatial index)
+    and each point has k slots, filled one slot per round by taking the closest remaining pair of
+    every point with np.minimum.reduceat (ties broken on the ordinal position of the line), so the
+    work is k passes over the pairs and the memory is k slots per point.
+
+    Returns the (n_points, k) arrays of line positions (-1 for empty slots) and snap distances (inf)
+    """
+    assert k >= 1, 'k must be at least 1'
+
+    best_line = np.full((n_points, k), -1, dtype='int64')
+    best_dist = np.full((n_points, k), np.inf)
+
+    pt_i = np.asarray(pt_i)
+    line_i = np.asarray(line_i, dtype='int64')
+    snap_dist = np.asarray(snap_dist, dtype='float64')
+
+    pairs = np.flatnonzero(np.isfinite(snap_dist))
+    if len(pairs) == 0:
+        return best_line, best_dist
+    if (np.diff(pt_i[pairs]) < 0).any():
+        pairs = pairs[np.argsort(pt_i[pairs], kind='stable')]
+
+    pt_sorted, line_sorted, remaining = pt_i[pairs], line_i[pairs], snap_dist[pairs]
+
+    # the run of pairs of each point
+    starts = np.flatnonzero(np.diff(pt_sorted, prepend=-1) != 0)
+    points = pt_sorted[starts]
+    run = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(pairs)]))
+    no_line = np.iinfo('int64').max
+
+    for rank in range(k):
+        closest = np.minimum.reduceat(remaining, starts)
+        found = np.isfinite(closest)
+        if not found.any():
+            break
+
+        # of the pairs at the closest distance, take the first line
+        tied = np.isfinite(remaining) & (remaining == closest[run])
+        first_line = np.minimum.reduceat(np.where(tied, line_sorted, no_line), starts)
+
+        best_line[points[found], rank] = first_line[found]
+        best_dist[points[found], rank] = closest[found]
+
+        remaining[tied & (line_sorted == first_line[run])] = np.inf
+
+    return best_line, best_dist
+
+def match_point_to_nearest_lines(line_shape, point_shape, k=3, buffer=15, key='TOID', chunk_size=100000, workers=1):
+    """
+    Match each point to its k nearest lines within a radius (buffer), e.g. to pick between the
+    links meeting at a junction. The line shape can be a GeoDataFrame or a RoadNetworkIndex.
+
+    The points are matched a chunk at a time and only the k closest lines of each point are kept
+    (see nearest_k_candidates), so memory is bounded by the chunk size rather than the number of
+    points. Returns a long table with a row for each point and matched line: the point
+    index, the line key, the rank (1 for the closest), the snap distance and the position of the
+    snapped point along the line
+    """
+    assert line_shape.crs == point_shape.crs, 'The shape CRS do not match'
+
+    lines = line_attributes(line_shape)
+    tables = []
+
+    with prf.span('match_point_to_nearest_lines', rows_in=len(point_shape), lines=len(line_shape), k=k):
+        for start in range(0, len(point_shape), chunk_size):
+            chunk = point_shape.iloc[start:start + chunk_size]
+
+            if workers > 1:
+                pt_i, line_i, snap_dist = parallel_point_line_candidates(line_shape, chunk, buffer=buffer, workers=workers)
+            else:
+                pt_i, line_i, snap_dist = point_line_candidates(line_shape, chunk, buffer=buffer)
+
+            prf.count(candidate_pairs=len(pt_i))
+            best_line, best_dist = nearest_k_candidates(pt_i, line_i, snap_dist, len(chunk), k=k)
+
+            # one row per filled slot, in point then rank order
+            pt_k, rank = np.nonzero(best_line >= 0)
+            line_k = best_line[pt_k, rank]
+
+            if isinstance(line_shape, RoadNetworkIndex):
+                _, position, _ = line_shape.store.locate(point_xy(chunk.geometry.values)[pt_k], line_k)
+            else:
+                position = line_shape.geometry.values[line_k].project(chunk.geometry.values[pt_k])
+
+            tables.append(pd.DataFrame({
+                'point': chunk.index[pt_k],
+                key: lines[key].values[line_k],
+                'rank': (rank + 1).astype(np.min_scalar_type(k)),
+                'snap_dist': best_dist[pt_k, rank].astype('float32'),
+                'position': np.asarray(position, dtype='float32')
+            }))
+
+        nearest = pd.concat(tables, ignore_index=True) if len(tables) > 0 else pd.DataFrame(columns=['point', key, 'rank', 'snap_dist', 'position'])
+        prf.record(rows_out=len(nearest))
+
+    return nearest
+
+def snap_points_to_lines(line_shape, line_columns, point_shape, pt_i, line_i, snap_dist):
+    """
+    Snap each point onto its matched line and join on the line attributes, given the ordinal
+    positions of the matched points and lines. For a RoadNetworkIndex the points are snapped on
+    the coordinates in its geometry store
+    """
+    lines = line_attributes(line_shape)
+    point_geoms = point_shape.geometry.values[pt_i]
 
     # position of nearest point from the start of the line
-    pos = closest.geometry.project(gpd.GeoSeries(closest.point))
-    new_pts = closest.geometry.interpolate(pos)
+    with prf.span('project_interpolate', rows_in=len(pt_i)):
+        if isinstance(line_shape, RoadNetworkIndex):
+            _, _, located = line_shape.store.locate(point_xy(point_geoms), line_i)
+            new_pts = points_from_coords(located)
+        else:
+            line_geoms = lines.geometry.values[line_i]
+            pos = line_geoms.project(point_geoms)
+            new_pts = line_geoms.interpolate(pos)
+
+    # index of points table
+    pt_idx = point_shape.index[pt_i]
 
     # create a new geodataframe from the required columns
     if line_columns is not None:
-        snapped = gpd.GeoDataFrame(closest[line_columns], geometry=new_pts)
+        closest = pd.DataFrame(lines[line_columns].take(line_i))
+        closest.index = pt_idx
     else:
-        snapped = gpd.GeoDataFrame(closest, geometry=new_pts)
+        if isinstance(lines, gpd.GeoDataFrame):
+            lines = pd.DataFrame(lines.drop(columns=lines.geometry.name))
+        closest = lines.take(line_i)
+        closest.index = pt_idx
+        closest.insert(0, 'line_i', line_i)
+        closest['point'] = point_geoms
+        closest['snap_dist'] = snap_dist
+
+    snapped = gpd.GeoDataFrame(closest, geometry=gpd.GeoSeries(new_pts, index=pt_idx), crs=point_shape.crs)
 
     # join back to original points
     updated_points = point_shape.drop(columns=['geometry']).join(snapped)
     updated_points = updated_points.dropna(subset=['geometry'])
 
-    return updated_points
+    return gpd.GeoDataFrame(updated_points, geometry='geometry', crs=point_shape.crs)
 
-def check_point_to_line_match(line_shape, point_shape):
+def read_point_chunks(point_file, chunk_size=100000, layer=None):
     """
-    Check the results of the match_point_to_line function by comparing the new point shape geometry to the line shape
+    Read a point layer (e.g. GeoJSON or GeoPackage) in fixed size batches, so only one batch of
+    points is held in memory at a time. Each batch is indexed on the position of its points in the file
     """
-    fig, ax = plt.subplots()
-    line_shape.plot(ax=ax, color='black', edgecolor='black', linewidth=1)
-    point_shape.plot(ax=ax, color='red', markersize=2)
-    plt.show()
+    with fiona.open(point_file, layer=layer) as src:
+        crs = src.crs_wkt
+        columns = list(src.schema['properties'])
+        records = iter(src)
+        start = 0
 
-def match_line_to_line(line1, line2, buffer=10):
-    assert line1.crs == line2.crs
+        while True:
+            features = list(islice(records, chunk_size))
+            if len(features) == 0:
+                break
 
-    line_as_points = pd.DataFrame()
+            chunk = gpd.GeoDataFrame.from_features(features, crs=crs, columns=columns + ['geometry'])
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
 
-    for index, row in line2.iterrows():
+            yield chunk
 
-        if row.geometry.geom_type == 'MultiLineString':
-            coords = row.geometry[0].coords
-        else:
-            coords = row.geometry.coords
+def iter_match_point_to_line(line_shape, line_columns, point_file, buffer=15, on_first=True, chunk_size=100000, layer=None):
+    """
+    Match the points in a file to the nearest line geometry within a radius (buffer), one batch
+    of points at a time. The line spatial index is built once and reused for every batch.
+
+    Yields the matched points for each batch. Batches in a different CRS to the lines are reprojected
+    """
+    if not isinstance(line_shape, RoadNetworkIndex):
+        line_shape = RoadNetworkIndex.from_network(line_shape)
 
-        tmp = pd.DataFrame({
-            # index of the line
-            'line2_idx': np.repeat(index, len(coords)),
-            # coordinate values
-            'pt_vals': pd.Series(coords)
-        })
+    for chunk in read_point_chunks(point_file, chunk_size=chunk_size, layer=layer):
+        if chunk.crs != line_shape.crs:
+            chunk = reproject(chunk, line_shape.crs)
 
-        line_as_points = pd.concat([line_as_points, tmp], ignore_index=True)
+        yield match_point_to_line(line_shape, line_columns, chunk, buffer=buffer, on_first=on_first)
 
-    # join id on by index
-    line_as_points = line_as_points.join(line2.drop(columns='geometry').reset_index(drop=True), on='line2_idx')
-    
-    # convert to geodataframe of points
-    line_as_points = gpd.GeoDataFrame(line_as_points, geometry=[Point(i, j) for i, j in line_as_points.pt_vals])
-    line_as_points.crs = line2.crs
+def fiona_field_type(dtype):
+    """
+    The fiona field type for a column dtype, through fiona's mapping of Python types to field
+    types. Flags are written as integers and categories with the type of their values
+    """
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        python_type = int
+    elif pd.api.types.is_float_dtype(dtype):
+        python_type = float
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        python_type = FionaDateTimeType
+    else:
+        python_type = str
+
+    return FIELD_TYPES_MAP_REV[python_type]
+
+def match_file_schema(line_shape, line_columns, point_file, layer=None):
+    """
+    The schema of the matched points of a point file: the properties of the point file as given
+    in its schema (rather than as inferred from a batch, where e.g. a column can be all missing),
+    then the line columns and a point geometry, with z values if the lines have them
+    """
+    assert line_columns is not None, 'The line columns to write must be given'
+
+    with fiona.open(point_file, layer=layer) as src:
+        properties = dict(src.schema['properties'])
+
+    lines = line_attributes(line_shape)
+    properties.update({col: fiona_field_type(lines[col].dtype) for col in line_columns})
+
+    if isinstance(line_shape, RoadNetworkIndex):
+        has_z = not np.isnan(line_shape.store.coords[:, 2]).all()
+    else:
+        has_z = bool(line_shape.geometry.has_z.any())
+
+    return {'geometry': '3D Point' if has_z else 'Point', 'properties': properties}
+
+def match_point_file_to_line(line_shape, line_columns, point_file, out_file, buffer=15, on_first=True, chunk_size=100000, layer=None, driver='GPKG'):
+    """
+    Match the points in a file to the nearest line geometry within a radius (buffer) and stream the
+    matched points to out_file, so peak memory is bounded by chunk_size rather than the size of the file.
+
+    The output schema is the schema of the point file plus the line columns (see match_file_schema),
+    so every batch is written with the same types. Returns the number of matched points
+    """
+    matched_count = 0
+    dst = None
 
-    # run through points to line match
-    line_as_points = match_point_to_line(line1, None, line_as_points, buffer=buffer, on_first=True)
+    try:
+        for matched in iter_match_point_to_line(line_shape, line_columns, point_file, buffer=buffer, on_first=on_first, chunk_size=chunk_size, layer=layer):
+            if len(matched) == 0:
+                continue
 
-    # limit returned columns and rows
-    line_as_points.drop(columns=['line_i','pt_vals','geometry','point','snap_dist'], inplace=True)
-    line_as_points.drop_duplicates(inplace=True, ignore_index=True)
+            if dst is None:
+                schema = match_file_schema(line_shape, line_columns, point_file, layer=layer)
+                dst = fiona.open(out_file, mode='w', driver=driver, crs_wkt=line_shape.crs.to_wkt(), schema=schema)
+
+            dst.writerecords(matched.iterfeatures())
+            matched_count += len(matched)
+    finally:
+        if dst is not None:
+            dst.close()
+
+    return matched_count
+
+def check_point_to_line_match(line_shape, point_shape):
+    """
+    Check the results of the match_point_to_line function by comparing the new point shape geometry to the line shape
+    """
+    fig, ax = plt.subplots()
+    line_shape.plot(ax=ax, color='black', edgecolor='black', linewidth=1)
+    point_shape.plot(ax=ax, color='red', markersize=2)
+    plt.show()
+
+def match_line_to_line(line1, line2, buffer=10, workers=1):
+    """
+    Match a line geometry (line2) to every line geometry in line1 that its vertices are matched to
+    within a radius (buffer), using every vertex of every part of line2
+    Expects both geometries to share the same CRS
+    """
+    assert line1.crs == line2.crs
 
-    # convert to dataframe
-    line_as_points = pd.DataFrame(line_as_points)
+    with prf.span('match_line_to_line', rows_in=len(line2), lines=len(line1)):
+        # explode all vertices of all parts into coordinate arrays in one step
+        coords, offsets, geom_idx = flatten_line_coords(line2.geometry.values, all_parts=True)
+        prf.record(vertices=len(coords))
+        line2_i = np.repeat(geom_idx, np.diff(offsets))
+
+        # convert to geodataframe of points, with the index of the line
+        line_as_points = gpd.GeoDataFrame(
+            {'line2_idx': line2.index[line2_i]},
+            geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]),
+            crs=line2.crs
+        )
+
+        # run through points to line match
+        line1_attributes = line_attributes(line1)
+        if isinstance(line1_attributes, gpd.GeoDataFrame):
+            line1_attributes = line1_attributes.drop(columns=line1_attributes.geometry.name)
+        line1_columns = list(line1_attributes.columns)
+        line_as_points = match_point_to_line(line1, line1_columns, line_as_points, buffer=buffer, on_first=True, workers=workers)
+
+        # limit returned columns and rows
+        line_as_points = pd.DataFrame(line_as_points.drop(columns=['geometry']))
+        line_as_points = line_as_points.drop_duplicates(ignore_index=True)
+
+        # join line2 attributes on by index, only for the matched lines
+        line2_attributes = line2.drop(columns=line2.geometry.name)
+        line_as_points = line_as_points.join(line2_attributes, on='line2_idx')
+        line_as_points = line_as_points[['line2_idx'] + list(line2_attributes.columns) + line1_columns]
+        prf.record(rows_out=len(line_as_points))
 
     # # calculate expected bearings
     # line1['l1_bearing'] = line1.apply(lambda x: stretch_bearing(x), axis=1)
@@ -1,134 +1,310 @@
-import requests
 import os
 import re
+import json
+from array import array
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from shapely.geometry import Point
+from urllib.parse import urlsplit
+
+import io_functions as iof
+import fetch_functions as ff
+import profile_functions as prf
+
+# base urls of the reference data sources - can be pointed at another server, e.g. a local copy for testing
+cid_url = 'https://cycling.data.tfl.gov.uk/CyclingInfrastructure/data/'
+overpass_url = 'http://overpass-api.de/api/interpreter'
+
+# Overpass queries are run per tile - {bbox} is replaced with the bounding box of each tile
+crossing_query = """
+    [out:json][timeout:180];
+    rel[boundary][name="Greater London"];
+    map_to_area;
+    (node["highway"="crossing"](area)({bbox});
+    );
+    out geom;
+    """
 
-def get_cycle_lane_layer(url='https://cycling.data.tfl.gov.uk/CyclingInfrastructure/data/lines/cycle_lane_track.json', download = True):
+bus_stop_query = """
+    [out:json][timeout:180];
+    rel[boundary][name="Greater London"];
+    map_to_area;
+    (node["highway"="bus_stop"](area)({bbox});
+    );
+    out geom;
     """
-    Download the latest version of the Cycle Lane / Track layer from the Transport for London Cycling Infrastructure Database
-    
-    The file is approximately 30MB in size (as of May 2021)
+
+# bounding box (south, west, north, east) of Greater London and the size (degrees) of the query tiles
+london_bounds = (51.28, -0.52, 51.70, 0.34)
+tile_size = 0.1
+
+# cached Overpass tiles are downloaded again after a week, and the cache is kept under 1GB
+overpass_cache = '../data/osm/cache/'
+overpass_ttl = 7*24*3600
+overpass_cache_bytes = 2**30
+
+# the public Overpass API limits the queries run at once from one address
+overpass_limit = 2
+
+def overpass_tile_requests(query, bounds=london_bounds, tile_size=tile_size, url=overpass_url):
     """
-    if download:
-        r = requests.get(url=url, allow_redirects=True)
+    Split an Overpass query into one request per tile of the area. Responses with a runtime error
+    are not kept (see overpass_runtime_error)
+    """
+    requests = []
+    for tile in ff.grid_tiles(bounds, tile_size):
+        bbox = ','.join(str(value) for value in tile)
+        requests.append({'url': url, 'params': {'data': query.replace('{bbox}', bbox)}, 'check': overpass_runtime_error})
+
+    return requests
+
+def reference_downloads(cid_url=cid_url):
+    """
+    The url and file of each reference data source downloaded in one piece
+    """
+    return [
+        {'url': f'{cid_url}lines/cycle_lane_track.json', 'path': '../data/cid/cycle_lane_track.json'},
+        {'url': f'{cid_url}points/traffic_calming.json', 'path': '../data/cid/traffic_calming.json'}
+    ]
+
+def download_reference_data(cid_url=cid_url, overpass_url=overpass_url, bounds=london_bounds, limit=4):
+    """
+    Download all of the reference data sources concurrently, with at most overpass_limit Overpass
+    queries at once. Files that have not changed since the last download are skipped and
+    interrupted downloads are resumed. Only the Overpass tiles that are missing from the cache (or
+    older than overpass_ttl) are downloaded. Failed downloads are tried again after a wait.
+
+    Returns a DataFrame with the status of each download
+    """
+    requests = overpass_tile_requests(crossing_query, bounds, url=overpass_url) + overpass_tile_requests(bus_stop_query, bounds, url=overpass_url)
+
+    os.makedirs(overpass_cache, exist_ok=True)
+    downloads, hits = ff.cached_downloads(requests, overpass_cache, ttl=overpass_ttl)
+
+    with prf.span('download_reference_data', downloads=len(downloads), cached=len(hits)):
+        report = ff.fetch_files(reference_downloads(cid_url) + downloads, limit=limit, host_limits={urlsplit(overpass_url).netloc: overpass_limit})
+        prf.record(bytes=int(report['bytes'].sum()))
+
+    ff.evict_cache(overpass_cache, max_bytes=overpass_cache_bytes, keep=[request['path'] for request in downloads + hits])
+
+    return pd.concat([report, pd.DataFrame(hits)], ignore_index=True)
 
-        os.makedirs('../data/cid/', exist_ok=True)
+def get_cycle_lane_layer(url=f'{cid_url}lines/cycle_lane_track.json', download = True, storage='geojson'):
+    """
+    Download the latest version of the Cycle Lane / Track layer from the Transport for London Cycling Infrastructure Database
 
-        if r.status_code == 200:
-            file = open('../data/cid/cycle_lane_track.json','wb')
-            file.write(r.content)
-            file.close()
+    The file is approximately 30MB in size (as of May 2021)
 
-        else:
-            print(f"Status code {r.status_code}. File not downloaded.")
+    With a storage backend other than geojson, the downloaded file is converted once and read from
+    the converted copy on later runs
+    """
+    if download:
+        ff.fetch_files([{'url': url, 'path': '../data/cid/cycle_lane_track.json'}])
 
-    cid = gpd.read_file('../data/cid/cycle_lane_track.json')
+    cid = iof.load_layer('../data/cid/cycle_lane_track', storage, source='../data/cid/cycle_lane_track.json')
 
     return cid
 
 
-def get_traffic_calming_layer(url='https://cycling.data.tfl.gov.uk/CyclingInfrastructure/data/points/traffic_calming.json', download = True):
+def get_traffic_calming_layer(url=f'{cid_url}points/traffic_calming.json', download = True, storage='geojson'):
     """
     Download the latest version of the Traffic Calming from the Transport for London Cycling Infrastructure Database
-    
+
     The file is approximately 38MB in size (as of May 2021)
+
+    With a storage backend other than geojson, the downloaded file is converted once and read from
+    the converted copy on later runs
     """
     if download:
-        r = requests.get(url=url, allow_redirects=True)
+        ff.fetch_files([{'url': url, 'path': '../data/cid/traffic_calming.json'}])
 
-        os.makedirs('../data/cid/', exist_ok=True)
+    traffic_calming = iof.load_layer('../data/cid/traffic_calming', storage, source='../data/cid/traffic_calming.json')
 
-        if r.status_code == 200:
-            file = open('../data/cid/traffic_calming.json','wb')
-            file.write(r.content)
-            file.close()
+    return traffic_calming
 
-        else:
-            print(f"Status code {r.status_code}. File not downloaded.")
+def overpass_runtime_error(path, tail_bytes=2**16):
+    """
+    Return the remark of an Overpass response if the query failed part way (e.g. timed out or ran
+    out of memory), otherwise None. The remark is sent at the end of a 200 response, after any
+    elements found before the error, so only the end of the file is read
+    """
+    with open(path, 'rb') as file:
+        file.seek(max(os.path.getsize(path) - tail_bytes, 0))
+        tail = file.read().decode('utf-8', errors='ignore')
 
-    traffic_calming = gpd.read_file('../data/cid/traffic_calming.json')
+    match = re.search(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")', tail)
+    if match is not None:
+        remark = json.loads(match.group(1))
+        if 'runtime error' in remark:
+            return f'Overpass {remark}'
 
-    return traffic_calming
+    return None
 
-def get_overpass_turbo_data(url='http://overpass-api.de/api/interpreter', query=None):
+class OverpassParser:
     """
-    Download data from the Overpass Turbo API
+    Incremental parser for the nodes in an Overpass JSON response.
+
+    Chunks of the response are fed in as they are read and each element is decoded on its own,
+    keeping only the id, coordinates and the requested tag keys in column arrays, so the whole
+    response is never held in memory. Repeated tag values share one string
     """
+    elements_start = re.compile(r'"elements"\s*:\s*\[')
+    separator = re.compile(r'[\s,]*')
+
+    def __init__(self, tags=()):
+        self.tags = list(tags)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.started = False
+        self.finished = False
+
+        self.types = []
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.columns = {tag: [] for tag in self.tags}
+        self.values = {}
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of the response, keeping any incomplete element until the next chunk
+        """
+        self.buffer += chunk
+        pos = 0
+
+        if not self.started:
+            match = self.elements_start.search(self.buffer)
+            if match is None:
+                # keep the end of the buffer in case the key is split across chunks
+                self.buffer = self.buffer[-32:]
+                return
+
+            pos = match.end()
+            self.started = True
+
+        while not self.finished:
+            pos = self.separator.match(self.buffer, pos).end()
+
+            if pos == len(self.buffer):
+                break
+            elif self.buffer[pos] == ']':
+                self.finished = True
+                break
+
+            try:
+                element, end = self.decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                # the element is incomplete
+                break
+
+            self.add(element)
+            pos = end
+
+        self.buffer = self.buffer[pos:]
+
+    def add(self, element):
+        if element.get('type') != 'node':
+            return
+
+        self.types.append('node')
+        self.ids.append(element['id'])
+        self.lats.append(element['lat'])
+        self.lons.append(element['lon'])
+
+        tags = element.get('tags', {})
+        for tag in self.tags:
+            value = tags.get(tag)
+            self.columns[tag].append(self.values.setdefault(value, value))
+
+    def to_frame(self, crs='epsg:4326'):
+        """
+        Build a GeoDataFrame of the nodes parsed so far, with the point geometry created in bulk
+        """
+        assert self.finished or not self.started, 'The Overpass response is incomplete'
 
-    if query is not None:
-        r = requests.get(url, params={'data': query})
+        df = pd.DataFrame({'type': self.types, 'id': np.frombuffer(self.ids, dtype='int64'), **self.columns})
+        geometry = gpd.points_from_xy(np.frombuffer(self.lons, dtype='float64'), np.frombuffer(self.lats, dtype='float64'))
 
-        os.makedirs('../data/osm/', exist_ok=True)
+        return gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
 
-        if r.status_code == 200:
-            data = r.json()['elements']
+def read_overpass_nodes(path, tags=(), chunk_size=2**20):
+    """
+    Read the nodes of an Overpass JSON response file in chunks, keeping only the requested tags
+    """
+    parser = OverpassParser(tags)
 
-        else:
-            print(f'Status code {r.status_code}. File not downloaded')
+    with prf.span('read_overpass_nodes', path=path, bytes=os.path.getsize(path)):
+        with open(path, encoding='utf-8') as file:
+            for chunk in iter(lambda: file.read(chunk_size), ''):
+                parser.feed(chunk)
 
-            data = list()
+        nodes = parser.to_frame()
+        prf.record(rows_out=len(nodes))
 
-    return data
+    return nodes
 
-def get_crossing_data(filename='tmp'):
-    crossing_query = """
-        [out:json];
-        rel[boundary][name="Greater London"];
-        map_to_area;
-        (node["highway"="crossing"](area);
-        );
-        out geom;
-        """
-    data = get_overpass_turbo_data(query=crossing_query)
+def get_overpass_turbo_data(url=overpass_url, query=None, path='../data/osm/overpass.json', download=True, tags=()):
+    """
+    Download data from the Overpass Turbo API, keeping the response in path. Returns the nodes
+    in the response with the requested tags
+    """
+    if download and query is not None:
+        ff.fetch_files([{'url': url, 'path': path, 'params': {'data': query}}])
 
-    if len(data) > 0:
+    if os.path.exists(path):
+        data = read_overpass_nodes(path, tags=tags)
 
-        for feature in data:
-            for key, value in feature['tags'].items():
-                if key in ['crossing','crossing_ref']:
-                    feature[key] = value
+    else:
+        data = gpd.GeoDataFrame()
 
-        df = pd.DataFrame(data)
-        df['geometry'] = [Point(x, y) for x, y in zip(df.lon, df.lat)]
-        df = gpd.GeoDataFrame(df.drop(['lat','lon','tags'], axis=1), geometry='geometry')
+    return data
 
-        df.to_file(f'../data/osm/{filename}.geojson', driver='GeoJSON')
+def get_overpass_tiles(query, bounds=london_bounds, tile_size=tile_size, url=overpass_url, tags=(), download=True, limit=overpass_limit):
+    """
+    Run an Overpass query (with a {bbox} placeholder) tile by tile through the response cache,
+    downloading the missing tiles with at most limit queries at once. Without download, only the
+    cached tiles are used, whatever their age.
 
+    The nodes of all the tiles are merged, dropping nodes repeated on the tile edges. Raises a
+    RuntimeError if any tile is not available (or its query failed), rather than return part of the area
+    """
+    requests = overpass_tile_requests(query, bounds, tile_size, url)
+
+    if download:
+        with prf.span('fetch_overpass_tiles', tiles=len(requests)):
+            paths = ff.fetch_cached(requests, overpass_cache, ttl=overpass_ttl, max_bytes=overpass_cache_bytes, limit=limit).path
     else:
+        paths = [ff.cache_path(overpass_cache, request['url'], request['params']) for request in requests]
 
-        df = gpd.GeoDataFrame()
-    
-    return df
+    # tiles cached before their query failed are removed, so they are downloaded again
+    for path in paths:
+        if os.path.exists(path) and overpass_runtime_error(path) is not None:
+            os.remove(path)
 
-def get_bus_stop_data(filename='tmp'):
-    bus_stop_query = """
-        [out:json];
-        rel[boundary][name="Greater London"];
-        map_to_area;
-        (node["highway"="bus_stop"](area);
-        );
-        out geom;
-        """
-    data = get_overpass_turbo_data(query=bus_stop_query)
+    missing = [path for path in paths if not os.path.exists(path)]
+    if len(missing) > 0:
+        raise RuntimeError(f'{len(missing)} of {len(paths)} Overpass tiles are not available, download them again')
 
-    if len(data) > 0:
+    tiles = [read_overpass_nodes(path, tags=tags) for path in paths]
+    if len(tiles) == 0:
+        return gpd.GeoDataFrame()
 
-        for feature in data:
-            for key, value in feature['tags'].items():
-                if key in ['naptan:AtcoCode','naptan:Bearing']:
-                    feature[key] = value
+    nodes = pd.concat(tiles, ignore_index=True).drop_duplicates(subset='id')
 
-        df = pd.DataFrame(data)
-        df['geometry'] = [Point(x, y) for x, y in zip(df.lon, df.lat)]
-        df = gpd.GeoDataFrame(df.drop(['lat','lon','tags'], axis=1), geometry='geometry')
+    return gpd.GeoDataFrame(nodes.sort_values('id').reset_index(drop=True), geometry='geometry', crs='epsg:4326')
 
-        df.to_file(f'../data/osm/{filename}.geojson', driver='GeoJSON')
+def get_crossing_data(filename='tmp', storage='geojson', download=True, url=overpass_url, bounds=london_bounds):
+    df = get_overpass_tiles(crossing_query, bounds=bounds, url=url, tags=['crossing','crossing_ref'], download=download)
 
-    else:
+    if len(df) > 0:
+        iof.write_layer(df, f'../data/osm/{filename}', storage)
+
+    return df
+
+def get_bus_stop_data(filename='tmp', storage='geojson', download=True, url=overpass_url, bounds=london_bounds):
+    df = get_overpass_tiles(bus_stop_query, bounds=bounds, url=url, tags=['naptan:AtcoCode','naptan:Bearing'], download=download)
+
+    if len(df) > 0:
+        iof.write_layer(df, f'../data/osm/{filename}', storage)
 
-        df = gpd.GeoDataFrame()
-    
     return df
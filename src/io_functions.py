@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import tempfile
+import shutil
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+import pyarrow.ipc as ipc
+
+import geo_functions as gf
+import profile_functions as prf
+
+# file extension for each storage backend
+storage_extensions = {
+    'geojson': '.geojson',
+    'parquet': '.parquet',
+    'feather': '.feather'
+}
+
+def layer_path(path, storage='parquet'):
+    """
+    Swap the file extension of a layer path for the extension of the storage backend
+    """
+    root, ext = os.path.splitext(path)
+
+    if ext in storage_extensions.values():
+        path = root
+
+    return path + storage_extensions[storage]
+
+def layer_metadata(path, storage='parquet'):
+    """
+    Read the schema metadata of a GeoParquet or Feather file, without reading any data
+    """
+    if storage == 'parquet':
+        schema = pq.read_schema(path)
+    else:
+        with ipc.open_file(path) as reader:
+            schema = reader.schema
+
+    return schema.metadata or {}
+
+def write_layer(df, path, storage='parquet'):
+    """
+    Write a layer using the storage backend, with geometry stored as WKB for GeoParquet / Feather
+
+    GeoDataFrames can use any backend, while plain DataFrames (no geometry) can only be written
+    to parquet or feather. Returns the path written to
+    """
+    path = layer_path(path, storage)
+
+    with prf.span('write_layer', path=path, rows_in=len(df)):
+        if storage == 'geojson':
+            assert isinstance(df, gpd.GeoDataFrame), 'Only GeoDataFrames can be written to GeoJSON'
+            df.to_file(path, driver='GeoJSON')
+
+        elif storage == 'parquet':
+            df.to_parquet(path)
+
+        elif storage == 'feather':
+            # feather does not store the index
+            df.reset_index(drop=True).to_feather(path)
+
+        else:
+            raise ValueError(f'Unknown storage backend {storage}. Use one of {list(storage_extensions)}')
+
+    return path
+
+def read_geojson(path, columns=None):
+    """
+    Read a GeoJSON file, keeping only the given columns (and the geometry). GeoJSON has no column
+    projection (the OGR driver cannot skip fields), so the whole file is read and the other columns
+    dropped after, unlike parquet and feather where only the given columns are read
+    """
+    with prf.span('read_file', path=path):
+        df = gpd.read_file(path)
+        prf.record(rows_out=len(df))
+
+    if columns is not None:
+        df = df[[col for col in df.columns if col in columns or col == df.geometry.name]]
+
+    return df
+
+def read_layer(path, storage='parquet', columns=None):
+    """
+    Read a layer written with write_layer, reading only the given columns (and the geometry, if any).
+    For GeoJSON the columns are dropped after the file is read (see read_geojson)
+    """
+    path = layer_path(path, storage)
+
+    if storage == 'geojson':
+        return read_geojson(path, columns=columns)
+
+    elif storage not in storage_extensions:
+        raise ValueError(f'Unknown storage backend {storage}. Use one of {list(storage_extensions)}')
+
+    with prf.span('read_layer', path=path):
+        df = read_stored_layer(path, storage, columns=columns)
+        prf.record(rows_out=len(df))
+
+    return df
+
+def read_stored_layer(path, storage='parquet', columns=None):
+    """
+    Read a GeoParquet / Feather file (or a plain parquet / feather table, if it has no geometry)
+    """
+    metadata = layer_metadata(path, storage)
+
+    if b'geo' in metadata:
+        geometry = json.loads(metadata[b'geo'])['primary_column']
+
+        if columns is not None and geometry not in columns:
+            columns = list(columns) + [geometry]
+
+        if storage == 'parquet':
+            return gpd.read_parquet(path, columns=columns)
+        else:
+            return gpd.read_feather(path, columns=columns)
+
+    if storage == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    else:
+        return pd.read_feather(path, columns=columns)
+
+def crs_path(path, crs=None):
+    """
+    Add the CRS to a layer path (e.g. crossings -> crossings.epsg27700), so copies of a layer in
+    different CRS are kept apart
+    """
+    if crs is None:
+        return path
+
+    root, ext = os.path.splitext(path)
+    if ext in storage_extensions.values():
+        path = root
+
+    return f"{path}.{re.sub('[^a-z0-9]', '', str(crs).lower())}"
+
+def convert_layer(path, storage='parquet', source=None, refresh=False, crs=None):
+    """
+    Write a copy of a source GeoJSON file (by default the layer path with a .geojson extension)
+    with the storage backend, if it has not been written yet, the source is newer than the copy or
+    refresh is set. If a crs is given, the copy is reprojected before it is written (see crs_path),
+    so later runs read it without reprojecting. The copy is used as it is if the source has been
+    removed. Returns the path of the layer for the storage backend
+    """
+    if source is None:
+        source = layer_path(path, 'geojson')
+
+    if storage == 'geojson':
+        return source
+
+    converted = layer_path(crs_path(path, crs), storage)
+    if not os.path.exists(source) and os.path.exists(converted):
+        return converted
+
+    if refresh or not os.path.exists(converted) or os.path.getmtime(source) > os.path.getmtime(converted):
+        layer = gpd.read_file(source)
+        if crs is not None:
+            layer = gf.reproject(layer, crs)
+
+        write_layer(layer, converted, storage)
+
+    return converted
+
+def load_layer(path, storage='parquet', columns=None, source=None, refresh=False, crs=None):
+    """
+    Read a layer with the storage backend. If the layer has not been written with the backend yet
+    (or the source is newer, or refresh is set), it is read from the source GeoJSON file (by default the layer path with a
+    .geojson extension) and written with the backend for next time. If a crs is given the layer
+    is returned in that CRS, reprojected once when the copy is written
+    """
+    path = convert_layer(path, storage, source=source, refresh=refresh, crs=crs)
+
+    if storage == 'geojson':
+        layer = read_geojson(path, columns=columns)
+        return layer if crs is None else gf.reproject(layer, crs)
+
+    return read_layer(path, storage, columns=columns)
+
+def benchmark_storage(gdf, storages=None, repeat=3, out_dir=None):
+    """
+    Compare the write time, read time and file size of each storage backend for a layer.
+    Returns a DataFrame with the best time of repeat runs for each backend
+    """
+    if storages is None:
+        storages = list(storage_extensions)
+
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    results = []
+
+    try:
+        for storage in storages:
+            path = os.path.join(tmp_dir, 'layer')
+            write_times = []
+            read_times = []
+
+            for i in range(repeat):
+                if os.path.exists(layer_path(path, storage)):
+                    os.remove(layer_path(path, storage))
+
+                start = time.perf_counter()
+                written = write_layer(gdf, path, storage)
+                write_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                read_layer(path, storage)
+                read_times.append(time.perf_counter() - start)
+
+            results.append({
+                'storage': storage,
+                'rows': len(gdf),
+                'write_seconds': min(write_times),
+                'read_seconds': min(read_times),
+                'size_mb': os.path.getsize(written) / 2**20
+            })
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return pd.DataFrame(results)
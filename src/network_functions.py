@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+import geo_functions as gf
+
+class RoadGraph:
+    """
+    A graph of a road network, with each link as an edge between the nodes at its start and end.
+
+    The adjacency is held in CSR arrays: the edges from node i are indices[indptr[i]:indptr[i + 1]],
+    with their weights (e.g. length) in weights and the position of the link they came from in
+    edge_link. Links are treated as two way, and only the shortest link between two nodes is kept
+    """
+    def __init__(self, node_xy, link_nodes, keys, indptr, indices, weights, edge_link):
+        self.node_xy = node_xy
+        self.link_nodes = link_nodes
+        self.keys = keys
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.edge_link = edge_link
+        self.pairs = None
+
+    @property
+    def n_nodes(self):
+        return len(self.node_xy)
+
+    @property
+    def n_links(self):
+        return len(self.link_nodes)
+
+    @classmethod
+    def from_lines(cls, line_shape, weight='length', key='TOID', precision=0.1):
+        """
+        Build the graph from a network (a GeoDataFrame or RoadNetworkIndex). Link ends within
+        precision of each other are joined into one node. Links that are not lines are left out of
+        the graph (their nodes are -1)
+        """
+        store = gf.line_store(line_shape)
+        lines = gf.line_attributes(line_shape)
+
+        # the ends of the first part of each link
+        parts = store.first_parts()
+        geom_idx = store.geom_idx[parts]
+
+        # snap the start and end of each link to the precision, so links meeting at a junction share a node
+        ends = np.concatenate([store.coords[store.offsets[parts], :2], store.coords[store.offsets[parts + 1] - 1, :2]])
+        node_grid, node = np.unique(np.round(ends / precision).astype('int64'), axis=0, return_inverse=True)
+        node = node.reshape(-1)
+
+        link_nodes = np.full((len(lines), 2), -1, dtype='int64')
+        link_nodes[geom_idx, 0] = node[:len(geom_idx)]
+        link_nodes[geom_idx, 1] = node[len(geom_idx):]
+
+        if weight in lines.columns:
+            link_weights = lines[weight].to_numpy(dtype='float64')
+        else:
+            link_weights = np.full(len(lines), np.nan)
+
+        # fall back to the geometry length, and keep weights above zero so every link is an edge
+        if np.isnan(link_weights).any():
+            link_weights = np.where(np.isnan(link_weights), store.lengths(), link_weights)
+        link_weights = np.maximum(link_weights[geom_idx], 1e-6)
+
+        # both directions of each link, without loops
+        u = np.concatenate([link_nodes[geom_idx, 0], link_nodes[geom_idx, 1]])
+        v = np.concatenate([link_nodes[geom_idx, 1], link_nodes[geom_idx, 0]])
+        w = np.concatenate([link_weights, link_weights])
+        link = np.concatenate([geom_idx, geom_idx])
+
+        keep = u != v
+        u, v, w, link = u[keep], v[keep], w[keep], link[keep]
+
+        # sort by node pair then weight, keeping the shortest link between each pair
+        order = np.lexsort((w, v, u))
+        u, v, w, link = u[order], v[order], w[order], link[order]
+
+        first = np.ones(len(u), dtype='bool')
+        first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, w, link = u[first], v[first], w[first], link[first]
+
+        indptr = np.zeros(len(node_grid) + 1, dtype='int64')
+        indptr[1:] = np.cumsum(np.bincount(u, minlength=len(node_grid)))
+
+        return cls(node_grid * precision, link_nodes, lines[key].values, indptr, v, w, link)
+
+    def matrix(self):
+        return csr_matrix((self.weights, self.indices, self.indptr), shape=(self.n_nodes, self.n_nodes))
+
+    def edge_position(self, u, v):
+        """
+        Position of the edges from nodes u to nodes v in the CSR arrays. The edges are sorted by
+        node pair, so they can be found with a binary search
+        """
+        if self.pairs is None:
+            rows = np.repeat(np.arange(self.n_nodes, dtype='int64'), np.diff(self.indptr))
+            self.pairs = rows * self.n_nodes + self.indices
+
+        return np.searchsorted(self.pairs, u * self.n_nodes + v)
+
+    def centrality(self, samples=None, seed=0, workers=1, batch_size=16):
+        """
+        Calculate the betweenness and closeness centrality of each link, from the shortest paths
+        (by weight) starting at a random sample of nodes (or every node, if samples is None).
+
+        Betweenness is the share of the sampled shortest paths that use the link and closeness
+        is the mean closeness of the nodes at either end of the link (scaled by the share of
+        nodes they can reach). With workers greater than 1 the sources are split across a process pool
+        """
+        n = self.n_nodes
+        sources = np.arange(n)
+        if samples is not None and samples < n:
+            sources = np.sort(np.random.default_rng(seed).choice(n, samples, replace=False))
+
+        if workers > 1:
+            batches = np.array_split(sources, min(workers * 4, len(sources)))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(source_centrality, repeat(self), batches, repeat(batch_size)))
+        else:
+            results = [source_centrality(self, sources, batch_size)]
+
+        link_paths = sum(result[0] for result in results)
+        dist_sum = sum(result[1] for result in results)
+        reached = sum(result[2] for result in results)
+
+        # closeness of each node from the sources that reach it (excluding itself)
+        sampled = np.zeros(n, dtype='int64')
+        sampled[sources] = 1
+        others = np.maximum(len(sources) - sampled, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            closeness = np.where(dist_sum > 0, (reached / dist_sum) * (reached / others), 0.0)
+
+        link_closeness = np.full(self.n_links, np.nan)
+        valid = self.link_nodes[:, 0] >= 0
+        link_closeness[valid] = closeness[self.link_nodes[valid]].mean(axis=1)
+
+        return pd.DataFrame({
+            'TOID': self.keys,
+            'betweenness': (link_paths / (len(sources) * max(n - 1, 1))).astype('float32'),
+            'closeness': link_closeness.astype('float32')
+        })
+
+def tree_depth(pred):
+    """
+    Number of steps from each node to the root of its shortest path tree, given the predecessor
+    of each node (negative for roots and unreached nodes), by pointer jumping
+    """
+    nodes = np.arange(len(pred))
+    ancestor = np.where(pred >= 0, pred, nodes)
+    depth = (pred >= 0).astype('int64')
+
+    while True:
+        done = ancestor[ancestor] == ancestor
+        if done.all():
+            return depth
+
+        depth = depth + depth[ancestor]
+        ancestor = ancestor[ancestor]
+
+def source_centrality(graph, sources, batch_size=16):
+    """
+    Walk the shortest path trees from a set of sources, returning the number of shortest paths
+    through each link, and the sum of the distances to each node and the number of sources
+    reaching it (excluding the node itself). Used as the worker for RoadGraph.centrality
+    """
+    matrix = graph.matrix()
+    n = graph.n_nodes
+
+    link_paths = np.zeros(graph.n_links)
+    dist_sum = np.zeros(n)
+    reached = np.zeros(n, dtype='int64')
+
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        dist, preds = dijkstra(matrix, directed=True, indices=batch, return_predecessors=True)
+
+        for source, d, pred in zip(batch, dist, preds):
+            reachable = np.isfinite(d)
+            reachable[source] = False
+            dist_sum[reachable] += d[reachable]
+            reached[reachable] += 1
+
+            # count the targets below each node in the tree, working up one level at a time
+            tree = np.flatnonzero(pred >= 0)
+            depth = tree_depth(pred)[tree]
+            order = np.argsort(-depth, kind='stable')
+            tree, depth = tree[order], depth[order]
+
+            subtree = reachable.astype('float64')
+            levels = np.flatnonzero(np.diff(depth)) + 1
+            for nodes in np.split(tree, levels):
+                np.add.at(subtree, pred[nodes], subtree[nodes])
+
+            # every target below a node is reached through the edge from its predecessor
+            links = graph.edge_link[graph.edge_position(pred[tree], tree)]
+            np.add.at(link_paths, links, subtree[tree])
+
+    return link_paths, dist_sum, reached
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import pandas as pd
+
+import geo_functions as gf
+import io_functions as iof
+import profile_functions as prf
+
+class Stage:
+    """
+    A stage of a pipeline. The function is called with the outputs of the input stages (in order)
+    followed by the params and settings as keyword arguments.
+
+    The cache key of a stage is built from its function source, params, the content of its input
+    files and the keys of its input stages. Settings (e.g. the number of workers) are passed to the
+    function but do not change the key. Stages with cache set to False are never saved, e.g. for
+    outputs that keep their own cache. Outputs are the files a stage writes (e.g. an export), so
+    the cached stage is only used while they are all there
+    """
+    def __init__(self, name, function, inputs=(), files=(), params=None, settings=None, cache=True, outputs=()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.files = list(files)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.settings = settings or {}
+        self.cache = cache
+
+class Pipeline:
+    """
+    Run a DAG of stages, caching the output of each stage keyed on its inputs, so a rerun only
+    recomputes the stages whose inputs have changed.
+
+    Stages are only loaded from the cache or run when a later stage needs them
+    """
+    def __init__(self, stages, cache_dir='../data/interim/cache/', storage='parquet'):
+        self.stages = {}
+        for stage in stages:
+            assert stage.name not in self.stages, f'Duplicate stage name {stage.name}'
+            missing = [name for name in stage.inputs if name not in self.stages]
+            assert len(missing) == 0, f'Stage {stage.name} has inputs {missing} that are not defined before it'
+            self.stages[stage.name] = stage
+
+        self.cache_dir = cache_dir
+        self.storage = 'feather' if storage == 'feather' else 'parquet'
+        self.file_hashes = {}
+        self.keys = {}
+
+    def file_key(self, path):
+        """
+        Hash the content of an input file. Hashes are remembered on disk against the file size and
+        modification time, so unchanged files are not read again on every run
+        """
+        if not os.path.exists(path):
+            return 'missing'
+
+        memo_file = os.path.join(self.cache_dir, 'file_hashes.json')
+        if len(self.file_hashes) == 0 and os.path.exists(memo_file):
+            with open(memo_file) as file:
+                self.file_hashes = json.load(file)
+
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        memo = self.file_hashes.get(path)
+
+        if memo is None or memo['size'] != stat.st_size or memo['mtime'] != stat.st_mtime_ns:
+            memo = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': gf.file_hash(path)}
+            self.file_hashes[path] = memo
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(memo_file, 'w') as file:
+                json.dump(self.file_hashes, file, indent=2)
+
+        return memo['hash']
+
+    def stage_key(self, name):
+        """
+        Build the cache key for a stage from its function, params, input files and input stages
+        """
+        if name not in self.keys:
+            stage = self.stages[name]
+            sha = hashlib.sha256()
+
+            sha.update(name.encode('utf-8'))
+            sha.update(inspect.getsource(stage.function).encode('utf-8'))
+            sha.update(json.dumps(stage.params, sort_keys=True, default=str).encode('utf-8'))
+
+            for path in stage.files:
+                sha.update(self.file_key(path).encode('utf-8'))
+
+            for input_name in stage.inputs:
+                sha.update(self.stage_key(input_name).encode('utf-8'))
+
+            self.keys[name] = sha.hexdigest()[:16]
+
+        return self.keys[name]
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}-{self.stage_key(name)}')
+
+    def load(self, name):
+        """
+        Load the cached output of a stage, returning a (found, value) pair. A stage with any of its
+        output files missing is not found, so it is run again to write them
+        """
+        if not all(os.path.exists(path) for path in self.stages[name].outputs):
+            return False, None
+
+        path = self.cache_path(name)
+
+        if os.path.exists(iof.layer_path(path, self.storage)):
+            return True, iof.read_layer(path, self.storage)
+        elif os.path.exists(f'{path}.pkl'):
+            return True, pd.read_pickle(f'{path}.pkl')
+
+        return False, None
+
+    def save(self, name, value):
+        """
+        Save the output of a stage. Tables are written with the storage backend, anything else
+        (including stages that only have side effects and return None) is pickled
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(name)
+
+        # remove outputs of the stage from earlier keys
+        for file in os.listdir(self.cache_dir):
+            if file.startswith(f'{name}-') and not file.startswith(os.path.basename(path)):
+                os.remove(os.path.join(self.cache_dir, file))
+
+        if isinstance(value, pd.DataFrame):
+            iof.write_layer(value, path, self.storage)
+        else:
+            pd.to_pickle(value, f'{path}.pkl')
+
+    def run(self, targets=None, force=(), profile=(), profile_dir='../data/interim/profile/'):
+        """
+        Run the stages needed for the targets (by default the last stage), rerunning any stages in
+        force. Stages in profile are run under cProfile, with the stats dumped to profile_dir.
+
+        Returns the outputs of the targets and a report of what happened to every stage, with the
+        rows in and out and peak memory (MB) of the stages that were run. Each stage is recorded
+        as a span of the tracer (see profile_functions)
+        """
+        if targets is None:
+            targets = [list(self.stages)[-1]]
+
+        outputs = {}
+        report = {name: {'stage': name, 'status': 'not needed', 'seconds': 0.0, 'rows_in': None, 'rows_out': None, 'peak_rss_mb': None, 'key': self.stage_key(name)} for name in self.stages}
+
+        def evaluate(name):
+            if name in outputs:
+                return outputs[name]
+
+            stage = self.stages[name]
+            start = time.perf_counter()
+
+            found = False
+            if stage.cache and name not in force:
+                with prf.span(f'load {name}'):
+                    found, value = self.load(name)
+
+            if found:
+                report[name]['status'] = 'cache hit'
+            else:
+                inputs = [evaluate(input_name) for input_name in stage.inputs]
+                input_rows = [prf.rows(input_value) for input_value in inputs]
+                rows_in = sum(rows for rows in input_rows if rows is not None) if len(inputs) > 0 else None
+
+                # time the stage itself, not its inputs
+                start = time.perf_counter()
+                with prf.span(name, stage=name, key=self.stage_key(name), rows_in=rows_in) as event:
+                    if name in profile:
+                        value = prf.profile_call(os.path.join(profile_dir, f'{name}.prof'), stage.function, *inputs, **stage.params, **stage.settings)
+                    else:
+                        value = stage.function(*inputs, **stage.params, **stage.settings)
+
+                    event['rows_out'] = prf.rows(value)
+
+                    if stage.cache:
+                        with prf.span(f'save {name}'):
+                            self.save(name, value)
+
+                report[name].update({'status': 'run', 'rows_in': rows_in, 'rows_out': event['rows_out'], 'peak_rss_mb': round(event['peak_rss_mb'], 1)})
+
+            report[name]['seconds'] = round(time.perf_counter() - start, 3)
+            outputs[name] = value
+
+            return value
+
+        results = {name: evaluate(name) for name in targets}
+
+        return results, pd.DataFrame(list(report.values())).astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+def peak_rss():
+    """
+    Peak resident memory (MB) of the process. On Linux the peak can be reset (see reset_peak_rss),
+    elsewhere it is the peak since the process started
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb)
+
+        return counters.PeakWorkingSetSize / 2**20
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on macOS, KB elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of the process to the current memory, where the OS allows it
+    (Linux). Returns True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return False
+
+    return True
+
+def linux_peak_rss():
+    """
+    Peak resident memory (MB) from /proc, which follows reset_peak_rss, or None if not available
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+
+    return None
+
+class Tracer:
+    """
+    Record the wall time, peak memory and counts (e.g. rows in / out or candidate pairs) of nested
+    spans of work, e.g. the stages of the build and the steps of each match.
+
+    Where the peak memory can be reset (Linux), the peak of each span is its own; elsewhere it is
+    the peak of the process up to the end of the span. Spans in worker processes are not recorded
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stack = []
+        self.resettable = None
+
+    def peak(self):
+        # ru_maxrss is not reset with the peak, so read it from /proc where it can be reset
+        if self.resettable is None:
+            self.resettable = reset_peak_rss() and linux_peak_rss() is not None
+
+        return linux_peak_rss() if self.resettable else peak_rss()
+
+    def reset(self):
+        self.events = []
+        self.stack = []
+
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Record a span of work. Fields (e.g. rows_in) are kept with the span, and more can be added
+        from inside it with record and count
+        """
+        # the peak so far belongs to the enclosing span, before it is reset for this one
+        peak = self.peak()
+        if len(self.stack) > 0:
+            self.stack[-1]['peak_rss_mb'] = max(self.stack[-1]['peak_rss_mb'], peak)
+        if self.resettable:
+            reset_peak_rss()
+            peak = self.peak()
+
+        event = {'name': name, 'depth': len(self.stack), 'start': time.perf_counter() - self.origin, 'peak_rss_mb': peak, **fields}
+        self.stack.append(event)
+
+        try:
+            yield event
+        finally:
+            event['seconds'] = time.perf_counter() - self.origin - event['start']
+            event['peak_rss_mb'] = max(event['peak_rss_mb'], self.peak())
+            self.stack.pop()
+
+            if len(self.stack) > 0:
+                self.stack[-1]['peak_rss_mb'] = max(self.stack[-1]['peak_rss_mb'], event['peak_rss_mb'])
+
+            self.events.append(event)
+
+    def record(self, **fields):
+        """
+        Set fields on the current span (if any)
+        """
+        if len(self.stack) > 0:
+            self.stack[-1].update(fields)
+
+    def count(self, **counts):
+        """
+        Add to counts on the current span (if any), e.g. the candidate pairs of each batch
+        """
+        if len(self.stack) > 0:
+            for key, value in counts.items():
+                self.stack[-1][key] = self.stack[-1].get(key, 0) + int(value)
+
+    def summary(self):
+        """
+        The recorded spans as a list of dictionaries, in the order they started
+        """
+        return sorted(self.events, key=lambda event: event['start'])
+
+    def write(self, path):
+        """
+        Write the spans as a trace file (Chrome trace event format, which can be opened in
+        chrome://tracing or Perfetto), with the fields of each span as its args
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        events = [{
+            'name': event['name'],
+            'ph': 'X',
+            'ts': round(event['start'] * 1e6),
+            'dur': round(event['seconds'] * 1e6),
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {key: value for key, value in event.items() if key not in ('name', 'start', 'seconds')}
+        } for event in self.summary()]
+
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, indent=1, default=str)
+
+        return path
+
+# the tracer used by the build and matching functions
+tracer = Tracer()
+
+def span(name, **fields):
+    return tracer.span(name, **fields)
+
+def record(**fields):
+    tracer.record(**fields)
+
+def count(**counts):
+    tracer.count(**counts)
+
+def rows(value):
+    """
+    Number of rows in a stage input or output, or None if it is not a table
+    """
+    if value is None or isinstance(value, (str, bytes, dict)) or not hasattr(value, '__len__'):
+        return None
+
+    return len(value)
+
+def profile_call(path, function, *args, top=20, **kwargs):
+    """
+    Run a function under cProfile, dumping the stats to path (e.g. for snakeviz or pstats) and
+    printing the top functions by cumulative time. Returns the result of the function
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    profiler = cProfile.Profile()
+
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
+        print(f'Profile written to {path}')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
@@ -0,0 +1,166 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString, MultiLineString
+
+import geo_functions as gf
+import clean_functions as cf
+
+# reference layers written by write_synthetic_data, as a share of the number of links
+reference_shares = {
+    'crossings': 0.5,
+    'bus_stops': 0.2,
+    'traffic_calming': 0.2,
+    'cycle_lanes': 0.1,
+    'bus_lanes': 0.05
+}
+
+route_hierarchy = ['A Road', 'B Road', 'Minor Road', 'Local Road', 'Local Access Road', 'Restricted Local Access Road']
+
+def synthetic_network(n_links, seed=0, spacing=100, centre=(529028, 181223), crs=gf.ukgrid):
+    """
+    Generate a road network of n_links 3D lines on a jittered grid around centre, with the fields
+    of the OS Highways network used in the build (TOID, identifier, length, roadWidthMinimum,
+    roadWidthAverage and routeHierarchy). Each link runs between two neighbouring junctions
+    with up to three bends, and takes its heights from a smooth surface
+    """
+    rng = np.random.default_rng(seed)
+
+    # junctions on a square grid, large enough for n_links links between neighbours
+    side = int(np.ceil(np.sqrt(n_links / 2))) + 1
+    iy, ix = np.divmod(np.arange(side * side), side)
+    nodes = np.column_stack([ix, iy]) * spacing + rng.uniform(-0.2, 0.2, (side * side, 2)) * spacing
+    nodes = nodes - nodes.mean(axis=0) + np.asarray(centre)
+
+    node_id = np.arange(side * side).reshape(side, side)
+    start = np.concatenate([node_id[:, :-1].ravel(), node_id[:-1, :].ravel()])
+    end = np.concatenate([node_id[:, 1:].ravel(), node_id[1:, :].ravel()])
+
+    # keep the links closest to the centre, so the network stays connected
+    mid = (nodes[start] + nodes[end]) / 2
+    keep = np.argsort(np.hypot(*(mid - np.asarray(centre)).T), kind='stable')[:n_links]
+    start, end = start[keep], end[keep]
+
+    # bends part way along each link, pushed to one side
+    bends = rng.integers(0, 4, n_links)
+    link = np.repeat(np.arange(n_links), bends + 2)
+    position = np.concatenate([np.concatenate([[0], np.sort(rng.uniform(0.1, 0.9, k)), [1]]) for k in bends])
+
+    a, b = nodes[start][link], nodes[end][link]
+    normal = np.column_stack([a[:, 1] - b[:, 1], b[:, 0] - a[:, 0]]) / spacing
+    inner = (position > 0) & (position < 1)
+    xy = a + position[:, None] * (b - a) + normal * np.where(inner, rng.normal(0, 0.05 * spacing, len(link)), 0)[:, None]
+    z = 30 + 20 * np.sin(xy[:, 0] / 1500) * np.cos(xy[:, 1] / 1700) + rng.normal(0, 0.2, len(link))
+
+    coords = np.column_stack([xy, np.round(z, 2)])
+    offsets = np.concatenate([[0], np.cumsum(bends + 2)])
+    geoms = [MultiLineString([LineString(coords[offsets[i]:offsets[i + 1]])]) for i in range(n_links)]
+
+    network = gpd.GeoDataFrame({
+        'TOID': [f'osgb{5000000000000000 + i}' for i in range(n_links)],
+        'identifier': [f'synthetic-{seed}-{i}' for i in range(n_links)]
+    }, geometry=geoms, crs=crs)
+
+    width = rng.uniform(3, 14, n_links)
+    network['length'] = network.geometry.length.round(2)
+    network['roadWidthMinimum'] = [f'{w:.1f}m' if w > 4 else '' for w in width]
+    network['roadWidthAverage'] = [f'{w + 1:.1f}m' for w in width]
+    network['routeHierarchy'] = rng.choice(route_hierarchy, n_links, p=[0.1, 0.05, 0.15, 0.4, 0.25, 0.05])
+
+    return network
+
+def synthetic_points(network, n_points, seed=0, max_offset=10, off_network=0.1):
+    """
+    Generate n_points points along the links of a network (a GeoDataFrame or RoadNetworkIndex),
+    each within max_offset of a random point on a link. A share (off_network) are placed three to
+    five times further away, so not every point can be matched
+    """
+    rng = np.random.default_rng(seed)
+    network = gf.line_network(network)
+    coords, offsets, geom_idx = gf.flatten_line_coords(network.geometry.values, all_parts=True)
+
+    # every segment between two vertices of the same part
+    segment = np.ones(len(coords), dtype='bool')
+    segment[offsets[1:] - 1] = False
+    first = rng.choice(np.flatnonzero(segment), n_points)
+
+    along = rng.uniform(0, 1, n_points)[:, None]
+    xy = coords[first, :2] + along * (coords[first + 1, :2] - coords[first, :2])
+
+    radius = rng.uniform(0, max_offset, n_points)
+    far = rng.uniform(0, 1, n_points) < off_network
+    radius[far] = rng.uniform(3 * max_offset, 5 * max_offset, far.sum())
+    angle = rng.uniform(0, 2 * np.pi, n_points)
+    xy = xy + np.column_stack([np.cos(angle), np.sin(angle)]) * radius[:, None]
+
+    return gpd.GeoDataFrame({'id': np.arange(n_points)}, geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=network.crs)
+
+def synthetic_lines(network, n_lines, seed=0, max_offset=2):
+    """
+    Generate n_lines 2D lines following random links of a network (e.g. bus lanes), each shifted
+    by up to max_offset. Returns the lines and the position of the link each one follows
+    """
+    rng = np.random.default_rng(seed)
+    network = gf.line_network(network)
+    coords, offsets, geom_idx = gf.flatten_line_coords(network.geometry.values)
+
+    chosen = rng.choice(len(geom_idx), min(n_lines, len(geom_idx)), replace=False)
+    shift = rng.uniform(-max_offset, max_offset, (len(chosen), 2))
+    geoms = [LineString(coords[offsets[i]:offsets[i + 1], :2] + shift[j]) for j, i in enumerate(chosen)]
+
+    lines = gpd.GeoDataFrame({'id': np.arange(len(chosen))}, geometry=geoms, crs=network.crs)
+
+    return lines, geom_idx[chosen]
+
+def write_synthetic_data(root, n_links, seed=0, shares=None):
+    """
+    Write a synthetic highways network of n_links links and reference layers scaled to it (see
+    reference_shares) to a data folder laid out like ../data, with the columns the build reads,
+    so the build can be run against it. Returns the network in UKGRID
+    """
+    shares = {**reference_shares, **(shares or {})}
+    rng = np.random.default_rng(seed)
+
+    for folder in ['os-highways', 'osm', 'cid', 'tfl', 'interim']:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def write(gdf, path):
+        gf.reproject(gdf, gf.latlong).to_file(os.path.join(root, path), driver='GeoJSON')
+
+    network = synthetic_network(n_links, seed=seed)
+    write(network, 'os-highways/os_highways_data.geojson')
+
+    crossings = synthetic_points(network, int(n_links * shares['crossings']), seed=seed + 1)
+    crossings['type'] = 'node'
+    crossings['crossing'] = rng.choice(['zebra', 'traffic_signals', 'uncontrolled', 'marked', 'no'], len(crossings))
+    crossings['crossing_ref'] = rng.choice(['zebra', 'pelican', 'toucan', ''], len(crossings))
+    write(crossings, 'osm/crossings.geojson')
+
+    bus_stops = synthetic_points(network, int(n_links * shares['bus_stops']), seed=seed + 2)
+    bus_stops['type'] = 'node'
+    bus_stops['naptan:AtcoCode'] = [f'490{i:08d}' for i in bus_stops['id']]
+    bus_stops['naptan:Bearing'] = rng.choice(['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'], len(bus_stops))
+    write(bus_stops, 'osm/bus_stops.geojson')
+
+    traffic_calming = synthetic_points(network, int(n_links * shares['traffic_calming']), seed=seed + 3)
+    traffic_calming['FEATURE_ID'] = [f'RWG{i:06d}' for i in traffic_calming.pop('id')]
+    for col in cf.traffic_calming_schema:
+        traffic_calming[col] = rng.choice(['TRUE', 'FALSE'], len(traffic_calming), p=[0.2, 0.8])
+    write(traffic_calming, 'cid/traffic_calming.json')
+
+    # cycle lanes are joined to the network by TOID
+    cycle_lanes, link = synthetic_lines(network, int(n_links * shares['cycle_lanes']), seed=seed + 4)
+    cycle_lanes['FEATURE_ID'] = [f'RWG{i:06d}' for i in cycle_lanes.pop('id')]
+    cycle_lanes['OS_Highway'] = network['TOID'].values[link]
+    for col in cf.cycle_lane_schema:
+        cycle_lanes[col] = rng.choice(['TRUE', 'FALSE'], len(cycle_lanes), p=[0.2, 0.8])
+    write(cycle_lanes, 'cid/cycle_lane_track.json')
+
+    bus_lanes, link = synthetic_lines(network, int(n_links * shares['bus_lanes']), seed=seed + 5)
+    bus_lanes['DIRECTION'] = rng.choice(['N', 'S', 'E', 'W'], len(bus_lanes))
+    bus_lanes['ROAD_NAME'] = [f'Road {i}' for i in link]
+    bus_lanes['LANE_TYPE'] = rng.choice(['With-flow', 'Contra-flow'], len(bus_lanes))
+    write(bus_lanes.drop(columns='id'), 'tfl/bus_lanes.geojson')
+
+    return network
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+import clean_functions as cf
+import profile_functions as prf
+
+def test_flag():
+    flags = cf.clean_column(pd.Series(['TRUE', 'FALSE', 'true', 'False', None, '']), 'flag')
+
+    assert flags.dtype == 'uint8'
+    assert flags.tolist() == [1, 0, 1, 0, 0, 0]
+
+    assert cf.clean_column(pd.Series([True, False]), 'flag').tolist() == [1, 0]
+
+def test_length():
+    lengths = cf.clean_column(pd.Series(['5.5m', ' 3m ', '7', '', None, 'unknown']), 'length')
+
+    assert lengths.dtype == 'float32'
+    np.testing.assert_array_equal(lengths, np.array([5.5, 3, 7, np.nan, np.nan, np.nan], dtype='float32'))
+
+    # lengths that are already numbers are only converted
+    assert cf.clean_column(pd.Series([5.5, np.nan]), 'length').dtype == 'float32'
+
+def test_category():
+    categories = cf.clean_column(pd.Series(['A Road', 'B Road', 'A Road', None]), 'category')
+
+    assert categories.dtype == 'category'
+    assert list(categories.cat.categories) == ['A Road', 'B Road']
+    assert categories.isna().tolist() == [False, False, False, True]
+
+def test_dtype():
+    bearings = cf.clean_column(pd.Series([0.0, 90.0, 359.0]), 'uint16')
+
+    assert bearings.dtype == 'uint16'
+    assert bearings.tolist() == [0, 90, 359]
+
+def test_clean_frame(capsys):
+    df = pd.DataFrame({'CLT_CARR': ['TRUE', 'FALSE'], 'roadWidthMinimum': ['4.5m', ''], 'routeHierarchy': ['A Road', 'A Road'], 'bearing': [10.0, 20.0], 'other': ['a', 'b']})
+    schema = {**cf.cycle_lane_schema, **cf.highway_schema}
+
+    prf.tracer.reset()
+    with prf.span('load'):
+        cleaned = cf.clean_frame(df, schema, name='layer')
+
+    # columns missing from the frame are skipped, and the input is left as it was
+    assert list(cleaned.columns) == list(df.columns)
+    assert cleaned.dtypes.astype(str).tolist() == ['uint8', 'float32', 'category', 'uint16', 'object']
+    assert df['CLT_CARR'].tolist() == ['TRUE', 'FALSE']
+
+    # the memory used is recorded on the trace rather than printed
+    span = [event for event in prf.tracer.summary() if event['name'] == 'clean_frame'][0]
+    assert span['layer'] == 'layer' and span['rows_in'] == 2
+    assert span['memory_after_mb'] <= span['memory_before_mb']
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.affinity import translate
+
+import build_road_reference_data as bb
+import geo_functions as gf
+import io_functions as iof
+import synthetic_functions as sf
+
+def edit_network(data, seed=0):
+    """
+    Write a new release of the synthetic network, with links moved, renamed, removed and added
+    (a few metres) around the bus lanes (which are matched to the nearest link, so are the easiest to get wrong)
+    """
+    rng = np.random.default_rng(seed)
+    # edited in lat/long, so the links left alone keep exactly the same coordinates
+    network = gpd.read_file(os.path.join(data, 'os-highways/os_highways_data.geojson'))
+    near_lanes = rng.permutation(pd.read_csv(os.path.join(data, 'interim/bus_lane_matched.csv')).TOID.unique())
+
+    moved, renamed, removed = near_lanes[:4], near_lanes[4:7], near_lanes[7:9]
+    added = network[network.TOID.isin(near_lanes[9:11])].copy()
+
+    network.loc[network.TOID.isin(moved), 'geometry'] = network.loc[network.TOID.isin(moved), 'geometry'].apply(lambda geom: translate(geom, 4e-5, -2e-5))
+    network.loc[network.TOID.isin(renamed), 'routeHierarchy'] = 'Local Access Road'
+    network = network[~network.TOID.isin(removed)]
+
+    added['TOID'] = [f'osgbnew{i}' for i in range(len(added))]
+    added['geometry'] = added.geometry.apply(lambda geom: translate(geom, -1.5e-5, 1e-5))
+    network = pd.concat([network, added], ignore_index=True)
+
+    network.to_file(os.path.join(data, 'os-highways/release.geojson'), driver='GeoJSON')
+
+def build(root, *args):
+    """
+    Run the build in a src folder next to the data folder, as the build uses paths relative to src
+    """
+    cwd = os.getcwd()
+    os.makedirs(os.path.join(root, 'src'), exist_ok=True)
+    os.chdir(os.path.join(root, 'src'))
+    try:
+        bb.main(['--workers', '1', '--trace', '../data/interim/trace.json', *args])
+
+        outputs = {
+            'road_environment': iof.read_layer('../data/interim/road_environment', 'parquet'),
+            'bus_lanes': pd.read_csv('../data/interim/bus_lane_matched.csv'),
+        }
+        for name, (matched_name, key) in bb.reference_points.items():
+            outputs[name] = iof.read_layer(f'../data/interim/{matched_name}', 'parquet')
+    finally:
+        os.chdir(cwd)
+
+    return outputs
+
+def sort_rows(frame, key):
+    frame = pd.DataFrame(frame.drop(columns='geometry', errors='ignore'))
+    return frame.sort_values(key, kind='stable').reset_index(drop=True)
+
+def test_delta_equals_full_rebuild(tmp_path):
+    delta_root, full_root = tmp_path / 'delta', tmp_path / 'full'
+    sf.write_synthetic_data(str(delta_root / 'data'), 300, seed=2)
+
+    build(delta_root)
+    edit_network(str(delta_root / 'data'))
+    shutil.copytree(delta_root / 'data', full_root / 'data')
+    shutil.rmtree(full_root / 'data' / 'interim')
+
+    release = '../data/os-highways/release.geojson'
+    delta = build(delta_root, '--highways', release, '--delta')
+    full = build(full_root, '--highways', release)
+
+    # the bus lanes matched to each link, and the points matched to each link
+    assert sort_rows(delta['bus_lanes'], ['bus_lane', 'TOID']).equals(sort_rows(full['bus_lanes'], ['bus_lane', 'TOID']))
+    for name, (matched_name, key) in bb.reference_points.items():
+        pd.testing.assert_frame_equal(sort_rows(delta[name], [key]), sort_rows(full[name], [key]))
+
+    # and the patched output is the same as rebuilding every link
+    expected = full['road_environment']
+    got = delta['road_environment']
+    assert got.TOID.tolist() == expected.TOID.tolist()
+    assert got.geometry.geom_equals_exact(expected.geometry, 0).all()
+    pd.testing.assert_frame_equal(pd.DataFrame(got.drop(columns='geometry')), pd.DataFrame(expected.drop(columns='geometry')))
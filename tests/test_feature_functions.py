@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_functions as fe
+
+crossing_types = ['marked_crossing', 'signalled_crossing', 'unmarked_crossing']
+flags = ['TRF_RAISED', 'TRF_HUMP']
+
+@pytest.fixture
+def layers():
+    rng = np.random.default_rng(0)
+    network = pd.DataFrame({'TOID': [f'link{i}' for i in range(12)], 'length': np.arange(12, dtype='float32')})
+
+    # matched rows in random order, some on links that are not in the network
+    toids = rng.choice([f'link{i}' for i in range(8)] + ['other'], 60)
+    crossings = pd.DataFrame({'TOID': toids, 'type': rng.choice(crossing_types, 60)})
+    for col in crossing_types:
+        crossings[col] = (crossings['type'] == col).astype('uint8')
+
+    calming = pd.DataFrame({'TOID': rng.choice(toids, 30)})
+    for col in flags:
+        calming[col] = rng.choice([0, 1], 30, p=[0.7, 0.3]).astype('uint8')
+
+    bus_stops = pd.DataFrame({'TOID': rng.choice(toids, 20)})
+
+    return network, crossings, calming, bus_stops
+
+def joined_features(network, crossings, calming, bus_stops):
+    """
+    The features from one table per layer, joined to the network and filled with 0
+    """
+    crossing_table = pd.crosstab(index=crossings.TOID, columns=crossings['type'], values=np.uint8(1), aggfunc='max').reset_index().fillna(0)
+    calming_table = calming.groupby(['TOID'], as_index=False).max()
+
+    highway = network.copy()
+    highway['bus_stop'] = highway['TOID'].isin(bus_stops.TOID.unique()).astype('uint8')
+    highway['bus_stops'] = highway['TOID'].map(bus_stops.groupby('TOID').size()).fillna(0).astype('uint32')
+    highway = highway.join(crossing_table.set_index('TOID'), how='left', on='TOID')
+    highway = highway.join(calming_table.set_index('TOID'), how='left', on='TOID')
+    highway[crossing_types + flags] = highway[crossing_types + flags].fillna(0).astype('uint8')
+
+    return highway
+
+def test_aggregate_equals_joined_tables(layers):
+    network, crossings, calming, bus_stops = layers
+
+    highway = fe.aggregate_features(network, [
+        fe.feature_layer(bus_stops, 'TOID', {'bus_stop': (None, 'any'), 'bus_stops': (None, 'count')}),
+        fe.feature_layer(crossings, 'TOID', {col: (col, 'max') for col in crossing_types}),
+        fe.feature_layer(calming, 'TOID', {col: (col, 'max') for col in flags}),
+    ])
+
+    pd.testing.assert_frame_equal(highway, joined_features(*layers))
+
+def test_empty_layer(layers):
+    network, crossings, calming, bus_stops = layers
+
+    highway = fe.aggregate_features(network, [fe.feature_layer(calming.iloc[:0], 'TOID', {col: (col, 'max') for col in flags})])
+
+    assert (highway[flags] == 0).all().all()
+    assert highway[flags].dtypes.tolist() == ['uint8', 'uint8']
@@ -0,0 +1,186 @@
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch_functions as ff
+
+body = bytes(range(256)) * 400
+etag = '"v1"'
+last_modified = 'Wed, 01 Sep 2021 10:00:00 GMT'
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serve one file with an ETag and Last-Modified date, answering conditional and range requests
+    """
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.most_active = max(self.server.most_active, self.server.active)
+
+        try:
+            time.sleep(self.server.delay)
+            self.respond()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def respond(self):
+        # a busy server, for the first requests
+        if len(self.server.requests) <= self.server.busy:
+            return self.reply(429)
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match == etag or (if_none_match is None and self.headers.get('If-Modified-Since') == last_modified):
+            return self.reply(304)
+
+        if self.headers.get('Range') and self.headers.get('If-Range') in (etag, last_modified):
+            start = int(self.headers['Range'][len('bytes='):-1])
+            if start >= len(body):
+                return self.reply(416, headers={'Content-Range': f'bytes */{len(body)}'})
+
+            return self.reply(206, body[start:], {'Content-Range': f'bytes {start}-{len(body) - 1}/{len(body)}'})
+
+        return self.reply(200, body)
+
+    def reply(self, status, content=b'', headers=None):
+        self.send_response(status)
+        for name, value in {'ETag': etag, 'Last-Modified': last_modified, 'Content-Length': str(len(content)), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.busy = 0
+    server.delay = 0
+    server.lock = threading.Lock()
+    server.active = server.most_active = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+def server_url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}/file'
+
+def fetch(server, path, busy=0, check=None):
+    server.requests.clear()
+    server.busy = busy
+
+    return ff.fetch_files([{'url': server_url(server), 'path': str(path), 'check': check}], retries=2, backoff=0).iloc[0]
+
+def test_download(server, tmp_path):
+    path = tmp_path / 'file'
+    result = fetch(server, path)
+
+    assert result.status == 'downloaded'
+    assert result.bytes == len(body)
+    assert path.read_bytes() == body
+    assert not os.path.exists(f'{path}.part')
+    assert ff.read_meta(str(path))['etag'] == etag
+
+@pytest.mark.parametrize('validator', ['etag', 'last_modified'])
+def test_not_modified_restarts_ttl(server, tmp_path, validator):
+    requests = [{'url': server_url(server)}]
+    path = ff.cache_path(str(tmp_path), server_url(server))
+    fetch(server, path)
+
+    # only keep one of the validators, and age the download past the ttl
+    meta = ff.read_meta(path)
+    meta.pop('last_modified' if validator == 'etag' else 'etag')
+    ff.write_meta(path, meta)
+    os.utime(path, (0, 0))
+
+    downloads, hits = ff.cached_downloads(requests, str(tmp_path), ttl=3600)
+    assert [download['path'] for download in downloads] == [path]
+
+    result = fetch(server, path)
+
+    assert result.status == 'not modified'
+    assert server.requests[0].get('If-None-Match' if validator == 'etag' else 'If-Modified-Since') == meta[validator]
+    with open(path, 'rb') as file:
+        assert file.read() == body
+
+    # the unchanged response is served from the cache again
+    downloads, hits = ff.cached_downloads(requests, str(tmp_path), ttl=3600)
+    assert len(downloads) == 0
+    assert [hit['path'] for hit in hits] == [path]
+
+def test_resume_partial_download(server, tmp_path):
+    path = tmp_path / 'file'
+    with open(f'{path}.part', 'wb') as file:
+        file.write(body[:1000])
+    ff.write_meta(str(path), {'part': {'etag': etag, 'last_modified': last_modified}})
+
+    result = fetch(server, path)
+
+    assert result.status == 'resumed'
+    assert result.bytes == len(body) - 1000
+    assert server.requests[0]['Range'] == 'bytes=1000-'
+    assert server.requests[0]['If-Range'] == etag
+    assert path.read_bytes() == body
+
+def test_restart_unsatisfiable_range(server, tmp_path):
+    path = tmp_path / 'file'
+    with open(f'{path}.part', 'wb') as file:
+        file.write(body + b'stale')
+    ff.write_meta(str(path), {'part': {'etag': etag}})
+
+    result = fetch(server, path)
+
+    assert [request.get('Range') for request in server.requests] == [f'bytes={len(body) + 5}-', None]
+    assert result.status == 'downloaded'
+    assert path.read_bytes() == body
+
+def test_retry_busy_server(server, tmp_path):
+    path = tmp_path / 'file'
+    result = fetch(server, path, busy=2)
+
+    assert len(server.requests) == 3
+    assert result.status == 'downloaded'
+    assert path.read_bytes() == body
+
+def test_give_up_on_busy_server(server, tmp_path):
+    path = tmp_path / 'file'
+    result = fetch(server, path, busy=3)
+
+    assert len(server.requests) == 3
+    assert result.status == 'failed'
+    assert not os.path.exists(path)
+
+def test_failed_check_not_kept(server, tmp_path):
+    path = tmp_path / 'file'
+    result = fetch(server, path, check=lambda part: 'error in body')
+
+    assert len(server.requests) == 3
+    assert result.status == 'failed'
+    assert not os.path.exists(path)
+    assert not os.path.exists(f'{path}.part')
+    assert 'part' not in ff.read_meta(str(path))
+
+def test_host_limit(server, tmp_path):
+    server.requests.clear()
+    server.delay = 0.1
+    server.most_active = 0
+
+    try:
+        downloads = [{'url': f'{server_url(server)}?part={i}', 'path': str(tmp_path / f'file{i}')} for i in range(6)]
+        report = ff.fetch_files(downloads, limit=4, host_limits={f'127.0.0.1:{server.server_address[1]}': 2})
+    finally:
+        server.delay = 0
+
+    assert (report.status == 'downloaded').all()
+    assert server.most_active == 2
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from shapely.geometry import Point, LineString, MultiLineString, Polygon
+
+import geo_functions as gf
+
+lines = [
+    LineString([(0, 0), (10, 0), (10, 10)]),
+    LineString([(0, 0, 1), (4, 3, 2), (4, 3, 5), (4, 3, 5), (8, 0, 3)]),
+    LineString([(5, 5, 2), (5, 5, 2)]),
+    MultiLineString([[(0, 0, 0), (10, 0, 1)], [(10, 0, 1), (10, 0, 1)], [(20, 0, 2), (20, 10, 4), (30, 10, 6)]]),
+    MultiLineString([[(-5, -5), (-5, 5)], [(5, -5), (5, 5)]]),
+    Point(1, 1),
+    Polygon([(0, 0), (1, 0), (1, 1)]),
+    None
+]
+
+def part_ends(line):
+    """
+    The positions along a line of the end of each of its parts but the last
+    """
+    if line.geom_type != 'MultiLineString':
+        return np.array([])
+
+    return np.cumsum([part.length for part in line.geoms])[:-1]
+
+def test_locate_matches_shapely():
+    rng = np.random.default_rng(0)
+    store = gf.GeometryStore.from_geoms(lines)
+
+    # random points, every vertex, and points the same distance from two segments (on the corner
+    # bisector of the first line, and halfway between the two parts of the last multi-part line)
+    vertices = [coord[:2] for line in lines[:5] for part in getattr(line, 'geoms', [line]) for coord in part.coords]
+    points = np.concatenate([rng.uniform(-10, 35, (60, 2)), vertices, [(7, 3), (12, -2), (0, 0), (0, 3), (0, -7)]])
+
+    pt_i, line_i = [array.ravel() for array in np.meshgrid(np.arange(len(points)), np.arange(len(lines)))]
+
+    for max_segments in [2**21, 7, 1]:
+        dist, position, located = store.locate(points[pt_i], line_i, max_segments=max_segments)
+
+        for p, i, d, pos, xyz in zip(pt_i, line_i, dist, position, located):
+            line, point = lines[i], Point(points[p])
+
+            if line is None or line.geom_type not in ('LineString', 'MultiLineString'):
+                assert d == np.inf and np.isnan(pos) and np.isnan(xyz).all()
+                continue
+
+            assert d == pytest.approx(line.distance(point), abs=1e-12)
+            assert pos == pytest.approx(line.project(point), abs=1e-12)
+
+            # the closest point is on the line, at the same distance
+            assert Point(xyz[:2]).distance(point) == pytest.approx(d, abs=1e-12)
+            assert line.distance(Point(xyz[:2])) == pytest.approx(0, abs=1e-9)
+
+            # and is interpolate at that position, except at the gap between two parts (and the z
+            # of a vertex repeated with a different z)
+            if not np.isclose(part_ends(line), pos).any():
+                expected = np.asarray(line.interpolate(pos).coords[0])
+                np.testing.assert_allclose(xyz[:2], expected[:2], atol=1e-9)
+                assert np.isnan(xyz[2]) == (not line.has_z)
+                if line.has_z and not (tuple(xyz[:2]) == (4, 3) and i == 1):
+                    assert xyz[2] == pytest.approx(expected[2], abs=1e-9)
+
+def test_locate_repeated_vertex_z():
+    # the closest point at a vertex repeated with a different z takes the first z
+    store = gf.GeometryStore.from_geoms([lines[1]])
+    dist, position, located = store.locate(np.array([[4, 3], [4, 4]]), np.array([0, 0]))
+
+    np.testing.assert_allclose(located, [[4, 3, 2], [4, 3, 2]])
+    np.testing.assert_allclose(position, [5, 5])
+    assert lines[1].interpolate(5).coords[0] == (4, 3, 5)
+
+def test_locate_ties():
+    # the first of two equally close segments is taken, as in shapely
+    store = gf.GeometryStore.from_geoms([LineString([(0, 0), (10, 0), (10, 10)]), MultiLineString([[(-5, -5), (-5, 5)], [(5, -5), (5, 5)]])])
+
+    dist, position, located = store.locate(np.array([[7, 3], [0, 0]]), np.array([0, 1]))
+
+    np.testing.assert_allclose(dist, [3, 5])
+    np.testing.assert_allclose(position, [7, 5])
+    np.testing.assert_allclose(located[:, :2], [[7, 0], [-5, 0]])
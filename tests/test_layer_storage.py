@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from geopandas.testing import assert_geodataframe_equal
+import pytest
+from shapely.geometry import Point
+
+import io_functions as iof
+import synthetic_functions as sf
+
+@pytest.fixture(scope='module')
+def layer():
+    layer = sf.synthetic_network(40, seed=5)
+    layer['lanes'] = np.arange(len(layer)).astype('int32')
+    layer['one_way'] = layer['lanes'] % 3 == 0
+
+    return layer
+
+@pytest.fixture(scope='module')
+def typed_layer(layer):
+    # column types that GeoJSON cannot hold
+    layer = layer.copy()
+    layer['kind'] = pd.Categorical(np.where(layer['one_way'], 'one way', 'two way'))
+    layer['count'] = pd.array([None] + list(range(len(layer) - 1)), dtype='Int64')
+
+    return layer
+
+@pytest.mark.parametrize('storage', ['parquet', 'feather'])
+def test_columnar_round_trip(typed_layer, tmp_path, storage):
+    path = iof.write_layer(typed_layer, str(tmp_path / 'layer'), storage)
+    layer = iof.read_layer(path, storage)
+
+    # dtypes, crs and 3D geometry are kept exactly
+    assert_geodataframe_equal(layer, typed_layer.reset_index(drop=True))
+    assert layer.crs == typed_layer.crs
+    assert layer.geometry.has_z.all()
+
+def test_geojson_round_trip(layer, tmp_path):
+    path = iof.write_layer(layer, str(tmp_path / 'layer'), 'geojson')
+    read = iof.read_layer(path, 'geojson')
+
+    # GeoJSON puts the geometry last
+    assert read.crs == layer.crs
+    assert list(read.columns) == [col for col in layer.columns if col != 'geometry'] + ['geometry']
+    assert read['lanes'].dtype.kind == 'i'
+    assert read['one_way'].dtype == 'bool'
+    assert read.geometry.geom_equals_exact(layer.geometry, 1e-6).all()
+    assert read.geometry.has_z.all()
+
+    pd.testing.assert_frame_equal(pd.DataFrame(read.drop(columns='geometry')), pd.DataFrame(layer.drop(columns='geometry')), check_dtype=False)
+
+@pytest.mark.parametrize('storage', ['parquet', 'feather', 'geojson'])
+def test_read_columns(layer, tmp_path, storage):
+    path = iof.write_layer(layer, str(tmp_path / 'layer'), storage)
+    read = iof.read_layer(path, storage, columns=['TOID', 'lanes'])
+
+    assert sorted(read.columns) == ['TOID', 'geometry', 'lanes']
+    assert read['TOID'].tolist() == layer['TOID'].tolist()
+
+@pytest.mark.parametrize('storage', ['parquet', 'feather'])
+def test_table_round_trip(storage, tmp_path):
+    # tables without geometry can use the columnar backends
+    table = pd.DataFrame({'TOID': ['a', 'b', 'c'], 'betweenness': np.array([0.5, 0.25, 0], dtype='float32'), 'flag': np.array([1, 0, 1], dtype='uint8')})
+    path = iof.write_layer(table, str(tmp_path / 'table'), storage)
+
+    pd.testing.assert_frame_equal(iof.read_layer(path, storage), table)
+
+def test_missing_geometry_round_trip(tmp_path):
+    points = gpd.GeoDataFrame({'id': [1, 2, 3]}, geometry=[Point(1, 2), None, Point(3, 4)], crs='epsg:27700')
+
+    for storage in ['parquet', 'feather', 'geojson']:
+        read = iof.read_layer(iof.write_layer(points, str(tmp_path / 'points'), storage), storage)
+
+        assert read.geometry.isna().tolist() == [False, True, False]
+        assert read.crs == points.crs
@@ -0,0 +1,62 @@
+import numpy as np
+import geopandas as gpd
+import pytest
+from shapely.geometry import LineString, Point
+
+import geo_functions as gf
+
+def rowwise_nearest(pt_i, line_i, snap_dist, n_points, k):
+    """
+    The k closest lines of each point, sorting the pairs of each point in Python
+    """
+    best_line = np.full((n_points, k), -1, dtype='int64')
+    best_dist = np.full((n_points, k), np.inf)
+
+    for point in range(n_points):
+        pairs = sorted((dist, line) for p, line, dist in zip(pt_i, line_i, snap_dist) if p == point and np.isfinite(dist))
+        for rank, (dist, line) in enumerate(pairs[:k]):
+            best_line[point, rank] = line
+            best_dist[point, rank] = dist
+
+    return best_line, best_dist
+
+@pytest.mark.parametrize('k', [1, 3, 8])
+def test_nearest_k_candidates_match_rowwise(k):
+    rng = np.random.default_rng(k)
+    n_points, n_lines = 40, 25
+
+    # unique pairs in random order, with tied and infinite distances
+    pairs = rng.permutation(rng.choice(n_points * n_lines, 600, replace=False))
+    pt_i, line_i = pairs // n_lines, pairs % n_lines
+    snap_dist = rng.integers(0, 6, len(pairs)).astype('float64')
+    snap_dist[rng.random(len(pairs)) < 0.05] = np.inf
+
+    best_line, best_dist = gf.nearest_k_candidates(pt_i, line_i, snap_dist, n_points + 2, k=k)
+    expected_line, expected_dist = rowwise_nearest(pt_i, line_i, snap_dist, n_points + 2, k)
+
+    np.testing.assert_array_equal(best_line, expected_line)
+    np.testing.assert_array_equal(best_dist, expected_dist)
+
+def test_rank_beyond_uint8():
+    # one point with 300 lines at increasing distances
+    lines = gpd.GeoDataFrame({'TOID': np.arange(300)}, geometry=[LineString([(1 + i / 100, 0), (1 + i / 100, 10)]) for i in range(300)], crs='epsg:27700')
+    points = gpd.GeoDataFrame(geometry=[Point(0, 5)], crs='epsg:27700')
+
+    nearest = gf.match_point_to_nearest_lines(lines, points, k=300, buffer=5)
+
+    assert nearest['rank'].tolist() == list(range(1, 301))
+    assert nearest['TOID'].tolist() == list(range(300))
+
+def test_more_candidates_than_k():
+    # 10 lines for point 0, two at each distance and in no order, 2 lines for point 2 and none for point 1
+    line_i = np.array([7, 3, 9, 0, 5, 1, 8, 2, 6, 4, 4, 1])
+    pt_i = np.array([0] * 10 + [2, 2])
+    snap_dist = np.array([3, 1, 4, 2, 0, 3, 4, 1, 0, 2, 5, 5], dtype='float64')
+
+    order = np.random.default_rng(0).permutation(len(pt_i))
+    best_line, best_dist = gf.nearest_k_candidates(pt_i[order], line_i[order], snap_dist[order], 3, k=4)
+
+    # only k slots are kept, filled by distance then line position
+    assert best_line.shape == best_dist.shape == (3, 4)
+    assert best_line.tolist() == [[5, 6, 2, 3], [-1, -1, -1, -1], [1, 4, -1, -1]]
+    assert best_dist.tolist() == [[0, 0, 1, 1], [np.inf] * 4, [5, 5, np.inf, np.inf]]
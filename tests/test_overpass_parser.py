@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+
+import get_road_environment as gre
+
+# a recorded Overpass response, with tag values holding escaped quotes, brackets and separators,
+# and ways and relations mixed in with the nodes
+payload = r'''{
+  "version": 0.6,
+  "generator": "Overpass API 0.7.61.5 4133829e",
+  "osm3s": {
+    "timestamp_osm_base": "2023-05-02T10:21:39Z",
+    "copyright": "The data included in this document is from www.openstreetmap.org. The data is made available under ODbL."
+  },
+  "elements": [
+
+{
+  "type": "node",
+  "id": 25502401,
+  "lat": 51.5107206,
+  "lon": -0.1185917,
+  "tags": {
+    "crossing": "traffic_signals",
+    "crossing_ref": "pelican",
+    "highway": "crossing"
+  }
+},
+{
+  "type": "node",
+  "id": 26559743,
+  "lat": 51.5112468,
+  "lon": -0.1206003,
+  "tags": {
+    "crossing": "zebra",
+    "highway": "crossing",
+    "note": "the \"Strand\" crossing ] , {not} [closed]"
+  }
+},
+{
+  "type": "way",
+  "id": 4253185,
+  "nodes": [25502401, 26559743],
+  "geometry": [{"lat": 51.5107206, "lon": -0.1185917}, {"lat": 51.5112468, "lon": -0.1206003}],
+  "tags": {
+    "highway": "footway",
+    "name": "Savoy ] Steps \"]\""
+  }
+},
+{
+  "type": "node",
+  "id": 108022587,
+  "lat": 51.5098342,
+  "lon": -0.1171505
+},
+{
+  "type": "relation",
+  "id": 1536,
+  "members": [
+    {"type": "way", "ref": 4253185, "role": "outer"},
+    {"type": "node", "ref": 25502401, "role": ""}
+  ],
+  "tags": {"type": "multipolygon", "name": "]]\\"}
+},
+{
+  "type": "node",
+  "id": 9345106312,
+  "lat": 51.5121033,
+  "lon": -0.1220177,
+  "tags": {
+    "crossing": "uncontrolled",
+    "crossing_ref": "zebra \\\"]\\\" é",
+    "highway": "crossing"
+  }
+}
+
+  ]
+}
+'''
+
+tags = ['crossing', 'crossing_ref', 'note']
+
+def parse(chunk_size):
+    parser = gre.OverpassParser(tags)
+    for start in range(0, len(payload), chunk_size):
+        parser.feed(payload[start:start + chunk_size])
+
+    return parser.to_frame()
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 13, 97, len(payload)])
+def test_chunked_feed_equals_json(chunk_size):
+    nodes = parse(chunk_size)
+    expected = [element for element in json.loads(payload)['elements'] if element['type'] == 'node']
+
+    assert nodes['type'].tolist() == ['node'] * len(expected)
+    assert nodes['id'].tolist() == [element['id'] for element in expected]
+    np.testing.assert_array_equal(nodes.geometry.y, [element['lat'] for element in expected])
+    np.testing.assert_array_equal(nodes.geometry.x, [element['lon'] for element in expected])
+
+    for tag in tags:
+        assert nodes[tag].tolist() == [element.get('tags', {}).get(tag) for element in expected]
+
+def test_incomplete_response():
+    parser = gre.OverpassParser(tags)
+    parser.feed(payload[:payload.index('108022587')])
+
+    with pytest.raises(AssertionError):
+        parser.to_frame()
@@ -0,0 +1,64 @@
+import os
+import json
+
+import pytest
+
+import fetch_functions as ff
+import get_road_environment as gre
+
+query = '[out:json];node["highway"="crossing"]({bbox});out geom;'
+bounds = (51.5, -0.1, 51.6, 0.1)
+
+def write_response(path, elements, remark=None):
+    response = {'version': 0.6, 'elements': elements}
+    if remark is not None:
+        response['remark'] = remark
+
+    with open(path, 'w') as file:
+        json.dump(response, file)
+
+def node(id, lat, lon):
+    return {'type': 'node', 'id': id, 'lat': lat, 'lon': lon, 'tags': {'crossing': 'zebra'}}
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(gre, 'overpass_cache', str(tmp_path))
+    requests = gre.overpass_tile_requests(query, bounds)
+
+    return [ff.cache_path(str(tmp_path), request['url'], request['params']) for request in requests]
+
+def test_runtime_error_remark(tmp_path):
+    path = str(tmp_path / 'response.json')
+
+    write_response(path, [node(1, 51.5, 0.0)], remark='runtime error: Query timed out in "query" at line 1 after 180 seconds.')
+    assert 'Query timed out' in gre.overpass_runtime_error(path)
+
+    write_response(path, [node(1, 51.5, 0.0)], remark='runtime remark: Timeout is 180 and maxsize is 536870912.')
+    assert gre.overpass_runtime_error(path) is None
+
+    write_response(path, [node(1, 51.5, 0.0)])
+    assert gre.overpass_runtime_error(path) is None
+
+def test_tiles_merged(cache):
+    for i, path in enumerate(cache):
+        write_response(path, [node(i, 51.55, -0.05 + 0.1 * i), node(100, 51.55, 0.0)])
+
+    nodes = gre.get_overpass_tiles(query, bounds, tags=['crossing'], download=False)
+
+    assert nodes.id.tolist() == list(range(len(cache))) + [100]
+
+def test_missing_tile_raises(cache):
+    write_response(cache[0], [node(1, 51.55, -0.05)])
+
+    with pytest.raises(RuntimeError):
+        gre.get_overpass_tiles(query, bounds, tags=['crossing'], download=False)
+
+def test_failed_tile_raises_and_is_removed(cache):
+    for i, path in enumerate(cache):
+        write_response(path, [node(i, 51.55, -0.05 + 0.1 * i)], remark='runtime error: Query ran out of memory.' if i == 0 else None)
+
+    with pytest.raises(RuntimeError):
+        gre.get_overpass_tiles(query, bounds, tags=['crossing'], download=False)
+
+    assert not os.path.exists(cache[0])
+    assert all(os.path.exists(path) for path in cache[1:])
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+import geo_functions as gf
+import synthetic_functions as sf
+
+workers = 2
+tiles_per_worker = 4
+
+@pytest.fixture(scope='module')
+def network():
+    return sf.synthetic_network(1500, seed=7)
+
+def tile_edge_points(points, n_tiles, offsets=(-0.5, 0, 0.5), per_edge=40, seed=0):
+    """
+    Points on and either side of the edges between the tiles parallel_point_line_candidates splits
+    the points into
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = points.total_bounds
+    width, height = maxx - minx, maxy - miny
+    nx = max(int(round(np.sqrt(n_tiles * width / height))), 1)
+    ny = max(int(np.ceil(n_tiles / nx)), 1)
+
+    xy = []
+    for i in range(1, nx):
+        x = minx + width * i / nx
+        xy += [(x + offset, y) for offset in offsets for y in rng.uniform(miny, maxy, per_edge)]
+    for j in range(1, ny):
+        y = miny + height * j / ny
+        xy += [(x, y + offset) for offset in offsets for x in rng.uniform(minx, maxx, per_edge)]
+
+    return [Point(x, y) for x, y in xy]
+
+@pytest.fixture(scope='module')
+def points(network):
+    points = sf.synthetic_points(network, 3000, seed=8)
+    edges = tile_edge_points(points, workers * tiles_per_worker)
+
+    # an empty and a missing geometry, which can not be matched
+    geoms = list(points.geometry) + edges + [Point(), None]
+
+    return gpd.GeoDataFrame({'id': np.arange(len(geoms))}, geometry=geoms, crs=network.crs)
+
+@pytest.mark.parametrize('on_first', [True, False])
+@pytest.mark.parametrize('indexed', [False, True])
+def test_parallel_match_equals_serial(network, points, on_first, indexed):
+    lines = gf.RoadNetworkIndex.from_network(network) if indexed else network
+
+    serial = gf.match_point_to_line(lines, ['TOID', 'identifier'], points, buffer=15, on_first=on_first, workers=1)
+    parallel = gf.match_point_to_line(lines, ['TOID', 'identifier'], points, buffer=15, on_first=on_first, workers=workers)
+
+    assert len(serial) > 0
+    assert not serial['id'].isin(points['id'].iloc[-2:]).any()
+    pd.testing.assert_frame_equal(pd.DataFrame(serial), pd.DataFrame(parallel))
+
+def test_parallel_candidates_equal_serial(network, points):
+    serial = gf.point_line_candidates(network, points, buffer=15)
+    parallel = gf.parallel_point_line_candidates(network, points, buffer=15, workers=workers, tiles_per_worker=tiles_per_worker)
+
+    order = np.lexsort(serial[:2][::-1])
+    parallel_order = np.lexsort(parallel[:2][::-1])
+
+    for s, p in zip(serial, parallel):
+        np.testing.assert_array_equal(s[order], p[parallel_order])
+
+def test_parallel_match_with_only_missing_points(network):
+    points = gpd.GeoDataFrame({'id': [0, 1]}, geometry=[None, Point()], crs=network.crs)
+
+    matched = gf.match_point_to_line(network, ['TOID'], points, buffer=15, workers=workers)
+
+    assert len(matched) == 0
@@ -0,0 +1,102 @@
+import os
+
+import pandas as pd
+import pytest
+
+import pipeline_functions as pf
+
+def read_numbers(path):
+    return pd.read_csv(path)
+
+def scale(numbers, factor=1):
+    return numbers.assign(value=numbers['value'] * factor)
+
+def scale_again(numbers, factor=1):
+    return numbers.assign(value=numbers['value'] * factor * 1)
+
+def total(numbers, path=None):
+    with open(path, 'w') as file:
+        file.write(str(numbers['value'].sum()))
+
+def other(path):
+    return pd.DataFrame({'value': [len(path)]})
+
+@pytest.fixture
+def folder(tmp_path):
+    pd.DataFrame({'value': [1, 2, 3]}).to_csv(tmp_path / 'numbers.csv', index=False)
+
+    return tmp_path
+
+def stages(folder, factor=2, scale_function=scale):
+    numbers_file = str(folder / 'numbers.csv')
+    total_file = str(folder / 'total.txt')
+
+    return [
+        pf.Stage('numbers', read_numbers, files=[numbers_file], params={'path': numbers_file}),
+        pf.Stage('other', other, params={'path': numbers_file}),
+        pf.Stage('scaled', scale_function, inputs=['numbers'], params={'factor': factor}),
+        pf.Stage('total', total, inputs=['scaled'], params={'path': total_file}, outputs=[total_file]),
+    ]
+
+def run(folder, targets=('total', 'other'), **kwargs):
+    pipeline = pf.Pipeline(stages(folder, **kwargs), cache_dir=str(folder / 'cache'))
+    results, report = pipeline.run(targets=list(targets))
+
+    return report.set_index('stage')['status'].to_dict()
+
+def test_rerun_is_cached(folder):
+    assert run(folder) == {'numbers': 'run', 'other': 'run', 'scaled': 'run', 'total': 'run'}
+    assert run(folder) == {'numbers': 'not needed', 'other': 'cache hit', 'scaled': 'not needed', 'total': 'cache hit'}
+    assert open(folder / 'total.txt').read() == '12'
+
+def test_input_file_change(folder):
+    run(folder)
+
+    # the same content written again does not change the key
+    pd.DataFrame({'value': [1, 2, 3]}).to_csv(folder / 'numbers.csv', index=False)
+    assert run(folder)['total'] == 'cache hit'
+
+    pd.DataFrame({'value': [1, 2, 4]}).to_csv(folder / 'numbers.csv', index=False)
+    assert run(folder) == {'numbers': 'run', 'other': 'cache hit', 'scaled': 'run', 'total': 'run'}
+    assert open(folder / 'total.txt').read() == '14'
+
+def test_params_change(folder):
+    run(folder)
+
+    assert run(folder, factor=3) == {'numbers': 'cache hit', 'other': 'cache hit', 'scaled': 'run', 'total': 'run'}
+    assert open(folder / 'total.txt').read() == '18'
+
+    # keys from earlier params are replaced
+    assert len([file for file in os.listdir(folder / 'cache') if file.startswith('scaled-')]) == 1
+
+def test_function_source_change(folder):
+    run(folder)
+
+    assert run(folder, scale_function=scale_again) == {'numbers': 'cache hit', 'other': 'cache hit', 'scaled': 'run', 'total': 'run'}
+
+def test_missing_output_file(folder):
+    run(folder)
+    os.remove(folder / 'total.txt')
+
+    assert run(folder) == {'numbers': 'not needed', 'other': 'cache hit', 'scaled': 'cache hit', 'total': 'run'}
+    assert open(folder / 'total.txt').read() == '12'
+
+def test_uncached_stage(folder):
+    numbers_file = str(folder / 'numbers.csv')
+    calls = []
+
+    def count(numbers):
+        calls.append(1)
+        return numbers
+
+    stage_list = [
+        pf.Stage('numbers', read_numbers, files=[numbers_file], params={'path': numbers_file}, cache=False),
+        pf.Stage('counted', count, inputs=['numbers']),
+    ]
+
+    for i in range(2):
+        pf.Pipeline(stage_list, cache_dir=str(folder / 'cache')).run(targets=['counted'])
+
+    # only the cached stage is saved, and it is not run again
+    assert len(calls) == 1
+    assert not any(file.startswith('numbers-') for file in os.listdir(folder / 'cache'))
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point, LineString, MultiLineString, Polygon, MultiPoint, MultiPolygon, GeometryCollection
+
+import geo_functions as gf
+import synthetic_functions as sf
+
+def assert_same_geometry(got, expected, tolerance):
+    """
+    Check two GeoSeries hold the same geometry types, dimensions and coordinates (within tolerance),
+    with missing and empty geometries in the same places
+    """
+    assert got.crs == expected.crs
+    assert got.index.equals(expected.index)
+    assert got.isna().tolist() == expected.isna().tolist()
+
+    for a, b in zip(got, expected):
+        if b is None:
+            continue
+
+        assert (a.geom_type, a.is_empty, a.has_z) == (b.geom_type, b.is_empty, b.has_z)
+        if not b.is_empty:
+            assert len(gf.geometry_coords(a)) == len(gf.geometry_coords(b))
+            for coords_a, coords_b in zip(gf.geometry_coords(a), gf.geometry_coords(b)):
+                np.testing.assert_allclose(coords_a, coords_b, rtol=0, atol=tolerance)
+
+@pytest.fixture(scope='module')
+def network():
+    network = sf.synthetic_network(50, seed=9)
+
+    # 3D lines, as well as the 3D multi-part lines of the network
+    lines = network.iloc[:10].copy()
+    lines['geometry'] = [geom.geoms[0] for geom in lines.geometry]
+
+    return pd.concat([network, lines], ignore_index=True)
+
+@pytest.fixture(scope='module')
+def mixed():
+    x, y = 529000, 181000
+    square = Polygon([(x, y), (x + 50, y), (x + 50, y + 50), (x, y + 50)], [[(x + 10, y + 10), (x + 20, y + 10), (x + 20, y + 20)]])
+    geoms = [
+        Point(x, y),
+        Point(x, y, 12.5),
+        LineString([(x, y), (x + 30, y + 40)]),
+        LineString([(x, y, 1), (x + 30, y + 40, 2)]),
+        MultiLineString([[(x, y), (x + 5, y)], [(x, y + 5), (x + 5, y + 5)]]),
+        square,
+        MultiPolygon([square, Polygon([(x - 100, y), (x - 90, y), (x - 90, y + 10)])]),
+        MultiPoint([(x, y), (x + 1, y + 1)]),
+        GeometryCollection([Point(x, y), LineString([(x, y), (x + 1, y)])]),
+        None,
+        LineString(),
+        Point(),
+    ]
+
+    return gpd.GeoDataFrame({'id': np.arange(len(geoms))}, geometry=geoms, crs=gf.ukgrid, index=np.arange(len(geoms)) * 3)
+
+@pytest.mark.parametrize('crs', [gf.latlong, 'epsg:3857'])
+def test_3d_lines_match_to_crs(network, crs):
+    got = gf.reproject(network, crs)
+    expected = network.to_crs(crs)
+
+    assert list(got.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(pd.DataFrame(got.drop(columns='geometry')), pd.DataFrame(expected.drop(columns='geometry')))
+    assert_same_geometry(got.geometry, expected.geometry, 1e-9 if crs == gf.latlong else 1e-6)
+
+    # and back again (the transformations are not exact inverses, so compare with to_crs again)
+    assert_same_geometry(gf.reproject(got, gf.ukgrid).geometry, expected.to_crs(gf.ukgrid).geometry, 1e-6)
+
+def test_mixed_geometry_matches_to_crs(mixed):
+    got = gf.reproject(mixed, gf.latlong)
+
+    assert_same_geometry(got.geometry, mixed.to_crs(gf.latlong).geometry, 1e-9)
+    assert got['id'].tolist() == mixed['id'].tolist()
+
+    # a GeoSeries is reprojected in the same way
+    assert_same_geometry(gf.reproject(mixed.geometry, gf.latlong), mixed.geometry.to_crs(gf.latlong), 1e-9)
+
+def test_missing_and_empty_only():
+    layer = gpd.GeoDataFrame({'id': [1, 2]}, geometry=[None, LineString()], crs=gf.ukgrid)
+    got = gf.reproject(layer, gf.latlong)
+
+    assert got.crs == layer.to_crs(gf.latlong).crs
+    assert got.geometry.isna().tolist() == [True, False]
+    assert got.geometry.iloc[1].is_empty
+
+def test_same_crs_returned_unchanged(network):
+    assert gf.reproject(network, gf.ukgrid) is network
+    assert gf.reproject(network, 'EPSG:27700') is network
+    assert gf.reproject(network.geometry, gf.ukgrid) is network.geometry
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import LineString
+
+import network_functions as nf
+
+# two components: a square with a diagonal and a spur, and a separate path of two links. The
+# lengths are chosen so every shortest path is unique
+nodes = {0: (0, 0), 1: (100, 0), 2: (100, 100), 3: (0, 100), 4: (200, 0), 5: (500, 500), 6: (600, 500), 7: (700, 500)}
+links = [(0, 1, 10), (1, 2, 12), (2, 3, 7), (3, 0, 20), (0, 2, 23), (1, 4, 5), (5, 6, 3), (6, 7, 4)]
+
+# networkx.edge_betweenness_centrality(weight='weight') and the mean closeness_centrality(distance='weight') of the link ends
+expected_betweenness = np.array([3, 5, 3, 1, 0, 4, 2, 2]) / 28
+expected_closeness = [0.04190229, 0.044549154, 0.036030964, 0.0333841, 0.036762003, 0.043580083, 0.069387755, 0.066790353]
+
+# the same from the shortest paths of the sources sampled with seed 3 (nodes 0, 3, 4 and 7)
+sampled_betweenness = np.array([4, 5, 4, 2, 0, 6, 1, 2]) / 28
+sampled_closeness = [0.052135854, 0.057544757, 0.039608037, 0.034199134, 0.043504141, 0.050182252, 0.049107143, 0.03125]
+
+@pytest.fixture(scope='module')
+def graph():
+    lines = gpd.GeoDataFrame(
+        {'TOID': [f'link{i}' for i in range(len(links))], 'length': [length for u, v, length in links]},
+        geometry=[LineString([nodes[u], nodes[v]]) for u, v, length in links],
+        crs='epsg:27700'
+    )
+
+    return nf.RoadGraph.from_lines(lines)
+
+def test_graph(graph):
+    assert graph.n_nodes == len(nodes)
+    assert graph.n_links == len(links)
+    assert len(graph.indices) == 2 * len(links)
+
+def test_centrality(graph):
+    centrality = graph.centrality()
+
+    assert centrality['TOID'].tolist() == [f'link{i}' for i in range(len(links))]
+    np.testing.assert_allclose(centrality['betweenness'], expected_betweenness, rtol=1e-6)
+    np.testing.assert_allclose(centrality['closeness'], expected_closeness, rtol=1e-6)
+
+def test_sampled_centrality(graph):
+    centrality = graph.centrality(samples=4, seed=3)
+
+    np.testing.assert_allclose(centrality['betweenness'], sampled_betweenness, rtol=1e-6)
+    np.testing.assert_allclose(centrality['closeness'], sampled_closeness, rtol=1e-6)
+
+    pd.testing.assert_frame_equal(graph.centrality(samples=4, seed=3), centrality)
+
+@pytest.mark.parametrize('samples', [None, 4])
+def test_workers_equal_serial(graph, samples):
+    serial = graph.centrality(samples=samples, seed=3, batch_size=3)
+    parallel = graph.centrality(samples=samples, seed=3, workers=2, batch_size=3)
+
+    pd.testing.assert_frame_equal(parallel, serial)
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from rtree import index as rtree_index
+
+import geo_functions as gf
+import synthetic_functions as sf
+
+def random_boxes(rng, n, extent=100, size=8, decimals=0):
+    """
+    Boxes (minx, miny, maxx, maxy) of random size, rounded so many of them touch or share edges
+    """
+    xy = np.round(rng.uniform(-extent * 0.1, extent, (n, 2)), decimals)
+    wh = np.round(rng.exponential(size, (n, 2)), decimals)
+    wh[rng.random(n) < 0.1] = 0
+
+    return np.column_stack([xy, xy + wh])
+
+def rtree_pairs(bounds, boxes):
+    """
+    Every box and item pair whose bounds intersect, from one R-tree query per box
+    """
+    tree = rtree_index.Index(gf.RoadNetworkIndex.tree_stream(bounds))
+    pairs = [(i, j) for i, box in enumerate(boxes) if np.isfinite(box).all() for j in sorted(tree.intersection(tuple(box)))]
+
+    return np.array(pairs, dtype='int64').reshape(-1, 2)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_bounds_grid_matches_rtree(seed):
+    rng = np.random.default_rng(seed)
+    bounds = random_boxes(rng, 400)
+    boxes = random_boxes(rng, 300, extent=130, size=4)
+
+    # missing geometries and points
+    bounds[rng.choice(len(bounds), 10, replace=False)] = np.nan
+    boxes[rng.choice(len(boxes), 10, replace=False)] = np.nan
+
+    expected = rtree_pairs(bounds, boxes)
+
+    for cell_size in [None, 0.5, 50, 1000]:
+        box_i, item_i = gf.BoundsGrid(bounds, cell_size=cell_size).query(boxes, chunk_size=77)
+        np.testing.assert_array_equal(np.column_stack([box_i, item_i]), expected)
+
+def test_bounds_grid_edges():
+    # boxes that only touch at an edge or a corner intersect, as in the R-tree
+    bounds = np.array([[0, 0, 10, 10], [10, 0, 20, 10], [20, 20, 20, 20], [np.nan] * 4])
+    boxes = np.array([[10, 10, 10, 10], [20, 20, 30, 30], [-5, -5, -1, -1], [5, 5, 15, 5], [np.nan] * 4])
+
+    box_i, item_i = gf.BoundsGrid(bounds).query(boxes)
+
+    np.testing.assert_array_equal(np.column_stack([box_i, item_i]), rtree_pairs(bounds, boxes))
+    assert list(zip(box_i, item_i)) == [(0, 0), (0, 1), (1, 2), (3, 0), (3, 1)]
+
+def test_empty_bounds_grid():
+    box_i, item_i = gf.BoundsGrid(np.full((3, 4), np.nan)).query(np.array([[0, 0, 1, 1]]))
+
+    assert len(box_i) == 0 and len(item_i) == 0
+
+@pytest.fixture(scope='module')
+def network():
+    return sf.synthetic_network(300, seed=11)
+
+def test_index_round_trip(network, tmp_path):
+    network_index = gf.RoadNetworkIndex.from_network(network)
+    network_index.save(str(tmp_path / 'index'))
+    loaded = gf.RoadNetworkIndex.load(str(tmp_path / 'index'))
+
+    # the geometry is memory-mapped from disk
+    assert isinstance(loaded.store.coords, np.memmap)
+    assert isinstance(loaded.bounds, np.memmap)
+    assert loaded.crs == network.crs
+
+    pd.testing.assert_frame_equal(loaded.attributes, network_index.attributes)
+    np.testing.assert_array_equal(loaded.bounds, network.geometry.bounds.to_numpy())
+
+    restored = loaded.network
+    assert list(restored.columns) == list(network.columns)
+    assert restored.geometry.geom_equals_exact(network.geometry, 0).all()
+    assert restored.geometry.has_z.all()
+
+    boxes = network.geometry.centroid.buffer(60).bounds.to_numpy()
+    for got, expected in zip(loaded.query_bulk(boxes), network_index.query_bulk(boxes)):
+        np.testing.assert_array_equal(got, expected)
+
+    # the saved R-tree holds the same bounds
+    assert sorted(loaded.tree.intersection(tuple(boxes[0]))) == sorted(network_index.tree.intersection(tuple(boxes[0])))
+
+def test_index_rebuilt_for_new_version(network, tmp_path, monkeypatch):
+    network_file = str(tmp_path / 'network.geojson')
+    cache_dir = str(tmp_path / 'cache')
+    network.to_file(network_file, driver='GeoJSON')
+
+    gf.RoadNetworkIndex.from_file(network_file, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # the saved index is loaded while the layout is unchanged
+    built = []
+    from_network = gf.RoadNetworkIndex.from_network.__func__
+    monkeypatch.setattr(gf.RoadNetworkIndex, 'from_network', classmethod(lambda cls, network: built.append(1) or from_network(cls, network)))
+
+    loaded = gf.RoadNetworkIndex.from_file(network_file, cache_dir=cache_dir)
+    assert len(built) == 0
+    assert isinstance(loaded.store.coords, np.memmap)
+
+    # and rebuilt once the layout changes
+    monkeypatch.setattr(gf.RoadNetworkIndex, 'version', gf.RoadNetworkIndex.version + 1)
+    rebuilt = gf.RoadNetworkIndex.from_file(network_file, cache_dir=cache_dir)
+
+    assert len(built) == 1
+    assert len(os.listdir(cache_dir)) == 2
+    pd.testing.assert_frame_equal(rebuilt.attributes, loaded.attributes)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+
+import geo_functions as gf
+import synthetic_functions as sf
+
+line_columns = ['TOID', 'identifier', 'routeHierarchy']
+
+@pytest.fixture(scope='module')
+def network():
+    return sf.synthetic_network(400, seed=3)
+
+@pytest.fixture(scope='module')
+def points(network):
+    points = sf.synthetic_points(network, 700, seed=4)
+
+    # columns that are all missing in the first chunk
+    points['ref'] = [None] * 250 + [f'ref{i}' for i in range(450)]
+    points['count'] = pd.array([None] * 250 + list(range(450)), dtype='Int64')
+
+    return points
+
+@pytest.mark.parametrize('crs', [gf.ukgrid, gf.latlong])
+def test_chunked_match_equals_full_match(network, points, tmp_path, crs):
+    point_file = str(tmp_path / 'points.gpkg')
+    out_file = str(tmp_path / 'matched.gpkg')
+    gf.reproject(points, crs).to_file(point_file, driver='GPKG')
+
+    count = gf.match_point_file_to_line(network, line_columns, point_file, out_file, chunk_size=250)
+    streamed = gpd.read_file(out_file)
+
+    # the same points read in one go
+    full = gf.reproject(gpd.read_file(point_file), network.crs)
+    expected = gf.match_point_to_line(network, line_columns, full).reset_index(drop=True)
+
+    assert count == len(expected)
+    assert streamed.crs == network.crs
+    assert list(streamed.columns) == list(expected.columns)
+
+    pd.testing.assert_frame_equal(pd.DataFrame(streamed.drop(columns='geometry')), pd.DataFrame(expected.drop(columns='geometry')), check_dtype=False)
+    np.testing.assert_allclose(np.array([p.coords[0] for p in streamed.geometry]), np.array([p.coords[0] for p in expected.geometry]))
+
+def test_schema_from_point_file(network, points, tmp_path):
+    point_file = str(tmp_path / 'points.gpkg')
+    points.to_file(point_file, driver='GPKG')
+
+    schema = gf.match_file_schema(network, line_columns, point_file)
+
+    assert schema['geometry'] == '3D Point'
+    assert schema['properties']['ref'].startswith('str')
+    assert schema['properties']['count'].startswith('int')
+    assert [schema['properties'][col] for col in line_columns] == ['str', 'str', 'str']
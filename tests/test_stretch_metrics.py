@@ -0,0 +1,117 @@
+import math
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString, MultiLineString, Point, Polygon
+
+import geo_functions as gf
+import synthetic_functions as sf
+
+def rowwise_metrics(network):
+    key_coords = network.apply(gf.stretch_key_coords, axis=1)
+
+    return pd.DataFrame({
+        'gradient': network.apply(lambda row: gf.stretch_gradient(row, 'length'), axis=1),
+        'sinuosity': network.apply(lambda row: gf.stretch_sinuosity(row, 'length'), axis=1),
+        'bearing': network.apply(gf.stretch_bearing, axis=1),
+        'relative_location': network.apply(gf.stretch_location, axis=1),
+        'start_x': key_coords.str[0],
+        'end_x': key_coords.str[1],
+        'start_y': key_coords.str[2],
+        'end_y': key_coords.str[3]
+    }, index=network.index)
+
+def tie_network(n=2000, seed=0):
+    """
+    Straight stretches whose gradient, sinuosity and end coordinates land on or next to rounding ties
+    """
+    rng = np.random.default_rng(seed)
+    length = rng.choice([1.0, 3.0, 10.0, 20.0, 100.0], n)
+    rise = np.round(rng.uniform(-5, 5, n), 2) * length / 100
+    x1 = np.round(rng.uniform(529000, 530000, n), 1) + 0.5 * rng.integers(0, 2, n)
+    y1 = np.round(rng.uniform(181000, 182000, n), 1)
+    run = length / np.round(rng.uniform(1, 2, n), 3)
+
+    geoms = [MultiLineString([LineString([(x, y, 10 + dz), (x + r, y, 10)])]) for x, y, dz, r in zip(x1, y1, rise, run)]
+
+    return gpd.GeoDataFrame({'TOID': np.arange(n).astype(str), 'length': length}, geometry=geoms, crs=gf.ukgrid)
+
+def test_python_round_matches_round():
+    rng = np.random.default_rng(1)
+
+    for decimals in [0, 1, 2]:
+        values = np.concatenate([rng.uniform(-100, 100, 10000), np.round(rng.uniform(-100, 100, 10000), decimals + 1), [0.15, 1.15, 2.675, 0.25, 2.5]])
+        expected = np.array([round(float(value), decimals) for value in values])
+
+        np.testing.assert_array_equal(gf.python_round(values, decimals), expected)
+
+def test_stretch_metrics_match_rowwise_functions():
+    network = pd.concat([sf.synthetic_network(500, seed=2), tie_network()], ignore_index=True)
+    network = gpd.GeoDataFrame(network, geometry='geometry', crs=gf.ukgrid)
+
+    expected = rowwise_metrics(network)
+    result = gf.compute_stretch_metrics(network)
+
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+
+def test_tie_network_needs_python_rounding():
+    # the gradients of the tie network are not all rounded the same way by np.round
+    network = tie_network()
+    expected = rowwise_metrics(network)['gradient']
+    rise = np.array([geom.geoms[0].coords[0][2] - geom.geoms[0].coords[-1][2] for geom in network.geometry])
+
+    assert (np.round(100 * rise / network['length'].values, 1) != expected.values).any()
+
+def rowwise_profile(geom):
+    """
+    The profile metrics of one stretch, segment by segment along each part with shapely
+    """
+    if geom is None or geom.is_empty or geom.geom_type not in ('LineString', 'MultiLineString'):
+        return [np.nan] * 4
+
+    gradients, rises, runs, angles, curvatures = [], [], [], [], []
+    for part in getattr(geom, 'geoms', [geom]):
+        # segments between consecutive vertices, leaving out repeated vertices
+        coords = [c if len(c) == 3 else (*c, np.nan) for c in part.coords]
+        segments = [(b[0] - a[0], b[1] - a[1], b[2] - a[2]) for a, b in zip(coords[:-1], coords[1:]) if math.hypot(b[0] - a[0], b[1] - a[1]) > 0]
+
+        for dx, dy, dz in segments:
+            runs.append(math.hypot(dx, dy))
+            rises.append(abs(dz))
+            gradients.append(100 * abs(dz) / math.hypot(dx, dy))
+
+        for before, after in zip(segments[:-1], segments[1:]):
+            angle = abs(math.atan2(before[0] * after[1] - before[1] * after[0], before[0] * after[0] + before[1] * after[1]))
+            angles.append(angle)
+            curvatures.append(angle / ((math.hypot(*before[:2]) + math.hypot(*after[:2])) / 2))
+
+    if len(runs) == 0:
+        return [np.nan] * 4
+
+    return [np.nanmax(gradients) if not np.isnan(gradients).all() else np.nan, 100 * sum(rises) / sum(runs), math.degrees(sum(angles)), max(curvatures, default=0.0)]
+
+def test_profile_metrics_match_rowwise():
+    geoms = [
+        LineString([(0, 0), (30, 40), (60, 40), (60, 0)]),
+        LineString([(0, 0, 10), (10, 0, 11), (10, 0, 11), (10, 10, 12), (10, 10, 15), (0, 20, 14)]),
+        LineString([(5, 5, 1), (5, 5, 2)]),
+        MultiLineString([[(0, 0, 0), (10, 0, 1), (20, 5, 1)], [(100, 100, 5), (100, 120, 3), (110, 130, 4)], [(50, 50, 1), (50, 50, 1)]]),
+        MultiLineString([[(0, 0), (0, 10)], [(0, 10), (5, 15), (0, 20)]]),
+        Point(1, 2, 3),
+        Polygon([(0, 0), (10, 0), (10, 10)]),
+        None,
+        LineString()
+    ]
+    network = pd.concat([
+        gpd.GeoDataFrame({'TOID': [f'edge{i}' for i in range(len(geoms))]}, geometry=geoms, crs=gf.ukgrid),
+        sf.synthetic_network(200, seed=4)[['TOID', 'geometry']]
+    ], ignore_index=True)
+
+    expected = pd.DataFrame([rowwise_profile(geom) for geom in network.geometry], columns=['max_gradient', 'mean_gradient', 'turning_angle', 'max_curvature'], index=network.index)
+    result = gf.compute_profile_metrics(network)
+
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-9)
+
+    # the index gives the same metrics
+    pd.testing.assert_frame_equal(gf.compute_profile_metrics(gf.RoadNetworkIndex.from_network(network)), result)